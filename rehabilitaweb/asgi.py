@@ -5,6 +5,15 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+The live state stream (/stream_estado/) and the device long-polls are async
+views. Served through this module with an ASGI server (e.g. ``pip install
+uvicorn`` and ``uvicorn rehabilitaweb.asgi:application``) they wait for events
+without holding a thread. Under WSGI (runserver, sync gunicorn) the stream
+falls back to a synchronous generator that polls the event bus and closes
+every ESTADO_STREAM_WSGI_DURACION seconds, so each open dashboard occupies a
+worker thread while connected; the dashboard also falls back to 500 ms polling
+if the stream does not deliver its first event.
 """
 
 import os
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'usuarios.metricas.MetricasMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,12 +77,64 @@ WSGI_APPLICATION = 'rehabilitaweb.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+#
+# Perfil elegido con la variable de entorno DB_PERFIL:
+#   sqlite       -> SQLite con la configuración por defecto (desarrollo)
+#   sqlite_prod  -> SQLite en modo WAL: las lecturas de los dashboards no
+#                   bloquean las escrituras de las ESP32
+#   postgres     -> PostgreSQL con pool de conexiones (pip install "psycopg[pool]")
+# Comparar perfiles con: DB_PERFIL=<perfil> python manage.py bench_bd
+
+DB_PERFIL = os.environ.get('DB_PERFIL', 'sqlite')
+SQLITE_RUTA = os.environ.get('SQLITE_RUTA', BASE_DIR / 'db.sqlite3')
+
+if DB_PERFIL == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'rehabilitatec'),
+            'USER': os.environ.get('POSTGRES_USER', 'rehabilitatec'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Con pool, Django exige CONN_MAX_AGE = 0: el pool reutiliza las conexiones
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('POSTGRES_POOL_MIN', 2)),
+                    'max_size': int(os.environ.get('POSTGRES_POOL_MAX', 20)),
+                },
+            },
+        }
+    }
+elif DB_PERFIL == 'sqlite_prod':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': SQLITE_RUTA,
+            'CONN_MAX_AGE': 600,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA busy_timeout=5000;'
+                    'PRAGMA mmap_size=134217728;'
+                    'PRAGMA cache_size=-20000;'
+                ),
+                # Toma el lock de escritura al abrir la transacción: evita
+                # "database is locked" al promover una lectura a escritura
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 5,
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': SQLITE_RUTA,
+        }
     }
-}
 
 
 # Password validation
@@ -133,3 +188,107 @@ CSRF_TRUSTED_ORIGINS = [
     'http://localhost:8000',
 ]
 
+
+# Segundos entre latidos del stream SSE de estado (/stream_estado/)
+ESTADO_STREAM_LATIDO = 15
+
+# Bajo WSGI el stream se sirve sondeando el bus y se corta a los N segundos
+# (EventSource reconecta solo), para no dejar un worker ocupado indefinidamente
+ESTADO_STREAM_WSGI_DURACION = 25
+
+# Máximo de segundos que una ESP32 puede dejar abierta una petición de long-poll
+# (?espera= en /controlar_sesion/ y /comando_esp/)
+ESP32_LONG_POLL_MAX = 30
+
+# Máximo de muestras aceptadas por POST en /recibir_datos_esp/lote/
+LOTE_MAX_MUESTRAS = 1000
+
+# Hilos de los trabajos periódicos (usuarios/tareas.py: vaciados a BD, barridos,
+# compactación). Apagados en "manage.py test": su vaciado final al salir correría
+# con la BD de pruebas ya destruida y escribiría en la real.
+TAREAS_SEGUNDO_PLANO = sys.argv[1:2] != ["test"]
+
+# Buffer write-behind del histórico de telemetría: se vacía al juntar
+# TELEMETRIA_BUFFER_MAX muestras o cada TELEMETRIA_BUFFER_EDAD segundos
+TELEMETRIA_BUFFER_MAX = 500
+TELEMETRIA_BUFFER_EDAD = 2.0
+
+# Compactación del histórico (usuarios/compactacion.py): segundos que se conserva
+# cada nivel (None = siempre); las muestras crudas solo se borran ya agregadas.
+# Cada TELEMETRIA_COMPACTAR_CADA segundos cada worker compacta en segundo plano
+# (el cursor bloqueado evita que se pisen). Con None hay que programar
+# "python manage.py compactar_telemetria" con cron: sin compactar, las consultas
+# de /api/maquinas/<numero>/telemetria/ leen toda la cola cruda (hasta su tope).
+TELEMETRIA_RETENCION = {"crudo": 7 * 86400, "segundo": 30 * 86400, "minuto": None}
+TELEMETRIA_COMPACTAR_CADA = 60
+# Máximo de puntos por respuesta de /api/maquinas/<numero>/telemetria/
+TELEMETRIA_SERIE_MAX_PUNTOS = 5000
+
+# Segundos que se cachea el total de pacientes (por búsqueda) de /api/pacientes/
+PACIENTES_TOTAL_TTL = 30
+
+# Máximo de filas por archivo en /api/pacientes/importar/ (el comando importar_pacientes no tiene tope)
+IMPORTACION_MAX_FILAS = 10000
+
+# Segundos entre volcados a EstadoMaquina del último contacto de cada máquina
+# (los sondeos solo lo anotan en memoria, ver usuarios/latidos.py); una máquina
+# ya volcada hace menos de LATIDOS_RESOLUCION segundos no se reescribe
+LATIDOS_INTERVALO = 5
+LATIDOS_RESOLUCION = 15
+
+# Segundos entre barridos del monitor de conectividad (usuarios/conectividad.py)
+CONECTIVIDAD_BARRIDO = 5
+
+# Máximo de máquinas en la caché numero → máquina de cada proceso (usuarios/registro.py)
+REGISTRO_MAQUINAS_MAX = 2000
+
+# Almacén del estado en vivo de las máquinas (ver usuarios/estado.py).
+# Con AlmacenMemoria los avisos de comandos y de estado (usuarios/eventos.py)
+# no salen del proceso: con más de un worker usar usuarios.estado.AlmacenRedis,
+# que además los reenvía por pub/sub a los long-polls y streams de los demás, p. ej.:
+#   {"BACKEND": "usuarios.estado.AlmacenRedis", "OPCIONES": {"url": "redis://localhost:6379/0"}}
+ESTADO_ALMACEN = {
+    "BACKEND": "usuarios.estado.AlmacenMemoria",
+    "OPCIONES": {"ttl_conexion": 60},
+}
+
+# Sesiones de terapia (usuarios/sesiones.py): segundos sin muestras para cerrar
+# una sesión, duración a partir de la cual se cierra aunque nadie la siga, y
+# segundos entre volcados del avance a SesionTerapia
+SESIONES_INACTIVIDAD = 300
+SESIONES_DURACION_MAX = 4 * 3600
+SESIONES_VOLCADO = 5
+
+# Segundos que se guarda el análisis de una sesión (usuarios/analisis.py, requiere
+# numpy); None = hasta que lo desaloje la caché. Se recalcula si llegan muestras.
+ANALISIS_CACHE_TTL = None
+
+# Cola de comandos (usuarios/cola.py): segundos que un comando reclamado espera
+# su confirmación antes de reintentarse, intentos máximos y vigencia del comando
+COLA_VISIBILIDAD = 30
+COLA_MAX_INTENTOS = 3
+COLA_COMANDO_TTL = 600
+
+# Máximo de máquinas por envío en /api/comandos/envios/
+ENVIO_MAX_MAQUINAS = 5000
+
+# Máximo de series (pasos × series) de un programa de terapia: el plan viaja entero a la ESP32
+PROGRAMA_MAX_SERIES = 100
+
+# Métricas (usuarios/metricas.py, expuestas en /metrics). Con varios workers,
+# METRICAS_DIR es un directorio compartido donde cada proceso vuelca su snapshot;
+# los que no se actualizan en METRICAS_EXPIRA segundos (workers muertos) se borran.
+# METRICAS_TOKEN exige "Authorization: Bearer <token>" para leer /metrics; sin
+# token solo responde a localhost. METRICAS_CABECERA agrega X-Consultas-BD a
+# cada respuesta.
+METRICAS_DIR = os.environ.get("METRICAS_DIR")
+METRICAS_EXPIRA = 60
+METRICAS_TOKEN = os.environ.get("METRICAS_TOKEN")
+METRICAS_CABECERA = DEBUG
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"consola": {"class": "logging.StreamHandler"}},
+    "loggers": {"usuarios": {"handlers": ["consola"], "level": "INFO"}},
+}
@@ -31,14 +31,32 @@ urlpatterns = [
     path('doctor/dashboard/', views.dashboard_doctor, name='dashboard_doctor'),
     path('doctor/gestion_pacientes/', views.gestion_pacientes, name='gestion_pacientes'),
     path('api/pacientes/', views.lista_pacientes, name='lista_pacientes'),
+    path('api/pacientes/exportar/', views.exportar_datos, {'tipo': 'pacientes'}, name='exportar_pacientes'),
+    path('api/pacientes/<int:paciente_id>/analitica/', views.analitica_paciente, name='analitica_paciente'),
+    path('api/sesiones/exportar/', views.exportar_datos, {'tipo': 'sesiones'}, name='exportar_sesiones'),
+    path('api/sesiones/<int:sesion_id>/analisis/', views.analisis_sesion, name='analisis_sesion'),
     path('estado_arduino/', views.estado_arduino, name='estado_arduino'),
     path('lista_maquinas/', views.lista_maquinas, name='lista_maquinas'),
+    path('maquinas_estado/', views.listar_maquinas_estado, name='listar_maquinas_estado'),
+    path('api/maquinas/<str:numero>/telemetria/', views.telemetria_maquina, name='telemetria_maquina'),
+    path('api/graficas/grados/', views.grafica_grados, name='grafica_grados'),
+    path('api/comandos/envios/', views.crear_envio_comandos, name='crear_envio_comandos'),
+    path('api/comandos/envios/<int:envio_id>/', views.estado_envio_comandos, name='estado_envio_comandos'),
+    path('api/programas/', views.programas_terapia, name='programas_terapia'),
+    path('api/programas/<int:programa_id>/enviar/', views.enviar_programa, name='enviar_programa'),
+    path('api/programas/ejecuciones/<int:ejecucion_id>/', views.ejecucion_programa, name='ejecucion_programa'),
     path('agregar_paciente/', views.agregar_paciente, name='agregar_paciente'),
+    path('api/pacientes/importar/', views.importar_pacientes, name='importar_pacientes'),
     path("estado_arduino/", views.estado_arduino, name="estado_arduino"),
+    path("stream_estado/", views.stream_estado, name="stream_estado"),
     path("controlar_sesion/", views.controlar_sesion, name="controlar_sesion"),
+    path("confirmar_comando/", views.confirmar_comando, name="confirmar_comando"),
     path('recibir_datos/', views.recibir_datos, name='recibir_datos'),
     path('lista_maquinas_json/', lista_maquinas_json, name='lista_maquinas_json'),
     path("recibir_datos_esp/", views.recibir_datos_esp, name="recibir_datos_esp"),
+    path("recibir_datos_esp/lote/", views.recibir_datos_esp_lote, name="recibir_datos_esp_lote"),
     path('comando_esp/', views.comando_esp, name='comando_esp'),
+    path("progreso_programa/", views.progreso_programa, name="progreso_programa"),
+    path('metrics', views.metricas_prometheus, name='metricas'),
 
 ]
@@ -1,7 +1,12 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from .forms import UsuarioCreationForm
-from .models import Usuario, Maquinas, EstadoMaquina, ComandoMaquina, SesionTerapia
+from .models import (
+    Usuario, Maquinas, EstadoMaquina, ComandoMaquina, EnvioComandos, SesionTerapia,
+    ProgramaTerapia, PasoPrograma, EjecucionPrograma, TelemetriaMaquina,
+    TelemetriaSegundo, TelemetriaMinuto, TelemetriaSesion, CursorCompactacion,
+    ResumenPaciente, ResumenSemanalPaciente,
+)
 
 class UsuarioAdmin(BaseUserAdmin):
     add_form = UsuarioCreationForm
@@ -49,12 +54,64 @@ class EstadoMaquinaAdmin(admin.ModelAdmin):
 
 @admin.register(ComandoMaquina)
 class ComandoMaquinaAdmin(admin.ModelAdmin):
-    list_display = ('maquina', 'accion', 'grados', 'repeticiones', 'ejecutado', 'usuario', 'timestamp_creacion')
-    list_filter = ('ejecutado', 'accion', 'maquina')
+    list_display = ('maquina', 'accion', 'grados', 'repeticiones', 'ejecutado', 'intentos', 'descartado', 'usuario', 'timestamp_creacion')
+    list_filter = ('ejecutado', 'descartado', 'accion', 'maquina')
     search_fields = ('maquina__numero', 'usuario__nombre')
 
+@admin.register(EnvioComandos)
+class EnvioComandosAdmin(admin.ModelAdmin):
+    list_display = ('id', 'accion', 'selector', 'total', 'creado_por', 'timestamp_creacion')
+    list_filter = ('accion', 'selector')
+
+class PasoProgramaInline(admin.TabularInline):
+    model = PasoPrograma
+    extra = 1
+
+@admin.register(ProgramaTerapia)
+class ProgramaTerapiaAdmin(admin.ModelAdmin):
+    list_display = ('id', 'nombre', 'creado_por', 'fecha_creacion')
+    search_fields = ('nombre',)
+    inlines = [PasoProgramaInline]
+
+@admin.register(EjecucionPrograma)
+class EjecucionProgramaAdmin(admin.ModelAdmin):
+    list_display = ('id', 'programa', 'maquina', 'usuario', 'estado', 'paso_actual', 'timestamp_inicio')
+    list_filter = ('estado',)
+
 @admin.register(SesionTerapia)
 class SesionTerapiaAdmin(admin.ModelAdmin):
     list_display = ('maquina', 'usuario', 'fecha_inicio', 'grados_objetivo', 'repeticiones_objetivo', 'repeticiones_completadas', 'completada')
     list_filter = ('completada', 'maquina', 'usuario')
-    search_fields = ('maquina__numero', 'usuario__nombre')
\ No newline at end of file
+    search_fields = ('maquina__numero', 'usuario__nombre')
+
+
+@admin.register(TelemetriaMaquina)
+class TelemetriaMaquinaAdmin(admin.ModelAdmin):
+    list_display = ('maquina', 'sesion', 'ts', 'grados', 'repeticiones', 'activo')
+    list_filter = ('activo', 'maquina')
+    search_fields = ('maquina__numero',)
+
+@admin.register(TelemetriaSegundo, TelemetriaMinuto)
+class AgregadoTelemetriaAdmin(admin.ModelAdmin):
+    list_display = ('maquina', 'inicio', 'muestras', 'grados_min', 'grados_max', 'segundos_activos')
+    list_filter = ('maquina',)
+    search_fields = ('maquina__numero',)
+
+@admin.register(TelemetriaSesion)
+class TelemetriaSesionAdmin(admin.ModelAdmin):
+    list_display = ('sesion', 'ts_inicio', 'ts_fin', 'muestras', 'grados_min', 'grados_max', 'segundos_activos')
+
+@admin.register(CursorCompactacion)
+class CursorCompactacionAdmin(admin.ModelAdmin):
+    list_display = ('nombre', 'ultimo_id')
+
+@admin.register(ResumenPaciente)
+class ResumenPacienteAdmin(admin.ModelAdmin):
+    list_display = ('usuario', 'sesiones', 'sesiones_completadas', 'repeticiones_completadas', 'grados_max', 'ultima_sesion')
+    search_fields = ('usuario__nombre',)
+
+@admin.register(ResumenSemanalPaciente)
+class ResumenSemanalPacienteAdmin(admin.ModelAdmin):
+    list_display = ('usuario', 'semana', 'sesiones', 'sesiones_completadas', 'repeticiones_completadas', 'grados_max')
+    list_filter = ('semana',)
+    search_fields = ('usuario__nombre',)
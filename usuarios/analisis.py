@@ -0,0 +1,192 @@
+"""Análisis de calidad de una sesión a partir de la serie de ángulos.
+
+La ESP32 solo manda ``grados_actuales`` y un contador; aquí se reconstruye
+cada repetición de la serie (ts, grados) de TelemetriaMaquina y se calculan,
+en lote con NumPy:
+
+- por repetición: flexión máxima, extensión, rango de movimiento (ROM),
+  velocidad angular máxima de subida y bajada, tiempo sostenido cerca del
+  pico y suavidad (jerk RMS y jerk adimensional en escala log, LDLJ);
+- por sesión: tendencia del ROM y de la velocidad por repetición, e índice de
+  fatiga (caída del ROM del último tercio respecto del primero).
+
+Las repeticiones se separan con histéresis sobre la serie suavizada: hay que
+cruzar el umbral alto para contar una subida y el bajo para contar una bajada,
+así el ruido cerca de un umbral no genera repeticiones falsas. Solo los bucles
+por repetición son Python; todo lo que recorre muestras es vectorizado.
+
+El resultado se cachea por sesión con la versión de sus muestras (cantidad e
+id máximo): solo se recalcula si llegan muestras nuevas.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count, Max
+
+from .models import TelemetriaMaquina
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+VENTANA_SUAVIZADO = 5       # muestras de la media móvil
+ROM_MINIMO = 10.0           # grados: oscilaciones menores no cuentan como repetición
+TOLERANCIA_SOSTEN = 5.0     # grados bajo el pico que todavía cuentan como "sostener"
+
+
+def disponible():
+    return np is not None
+
+
+def _suavizar(grados):
+    if len(grados) < 2 * VENTANA_SUAVIZADO:
+        return grados
+    borde = VENTANA_SUAVIZADO // 2
+    extendida = np.pad(grados, (borde, VENTANA_SUAVIZADO - 1 - borde), mode="edge")
+    return np.convolve(extendida, np.ones(VENTANA_SUAVIZADO) / VENTANA_SUAVIZADO, mode="valid")
+
+
+def _tramos(grados):
+    """Inicio y sentido (True = arriba) de cada tramo entre cruces de umbral, con histéresis."""
+    bajo, alto = np.percentile(grados, [5, 95])
+    amplitud = alto - bajo
+    if amplitud < ROM_MINIMO:
+        return None, None
+    medio = (alto + bajo) / 2
+    margen = max(ROM_MINIMO, 0.3 * amplitud) / 2
+    arriba = grados > medio + margen
+    eventos = np.flatnonzero(arriba | (grados < medio - margen))
+    if len(eventos) == 0:
+        return None, None
+    sentidos = arriba[eventos]
+    cambios = np.flatnonzero(np.diff(sentidos.astype(np.int8))) + 1
+    indices = np.concatenate(([0], cambios))
+    # Cada tramo empieza justo después del cruce anterior, para contener su extremo completo
+    inicios = np.concatenate(([0], eventos[cambios - 1] + 1))
+    return inicios, sentidos[indices]
+
+
+def _extremos(grados, inicios, sentidos):
+    """Índice del pico de cada tramo alto y del valle de cada tramo bajo."""
+    fines = np.append(inicios[1:], len(grados))
+    picos, valles = [], []
+    for inicio, fin, sube in zip(inicios, fines, sentidos):
+        tramo = grados[inicio:fin]
+        if sube:
+            picos.append(inicio + int(np.argmax(tramo)))
+        else:
+            valles.append(inicio + int(np.argmin(tramo)))
+    return np.array(picos, dtype=int), np.array(valles, dtype=int)
+
+
+def _pendiente(valores):
+    """Cambio medio por repetición (mínimos cuadrados)."""
+    return np.polyfit(np.arange(len(valores)), valores, 1)[0]
+
+
+def _requiere_numpy():
+    if np is None:
+        raise ImproperlyConfigured("El análisis de sesiones requiere el paquete 'numpy' (pip install numpy)")
+
+
+def analizar(tiempos, grados):
+    """Métricas por repetición y de la sesión para una serie (segundos, grados)."""
+    _requiere_numpy()
+    t = np.asarray(tiempos, dtype=float)
+    g = np.asarray(grados, dtype=float)
+    orden = np.argsort(t, kind="stable")
+    t, g = t[orden], g[orden]
+    t, unicos = np.unique(t, return_index=True)   # np.gradient no admite tiempos repetidos
+    g = g[unicos]
+    resultado = {"muestras": int(len(t)), "repeticiones": [], "resumen": None}
+    if len(t) < 3:
+        return resultado
+
+    suave = _suavizar(g)
+    velocidad = np.gradient(suave, t)
+    jerk = np.gradient(np.gradient(velocidad, t), t)
+    dt = np.gradient(t)
+
+    inicios, sentidos = _tramos(suave)
+    if inicios is None:
+        return resultado
+    picos, valles = _extremos(suave, inicios, sentidos)
+    # Una repetición va de un valle al siguiente (o al final) pasando por un pico
+    valles = valles[valles < (picos.max() if len(picos) else -1)]
+    if len(valles) == 0:
+        return resultado
+    fines = np.append(valles[1:], len(t) - 1)
+    picos = picos[np.searchsorted(picos, valles)]
+
+    # reduceat sobre los valles: ventana i = [valle i, valle i+1), la última hasta el final
+    limites = np.append(valles, len(t))
+    por_rep = lambda ufunc, valores: ufunc.reduceat(valores, valles)
+    flexion = suave[picos]
+    extension = suave[valles]
+    rom = flexion - extension
+    vel_subida = por_rep(np.maximum, velocidad)
+    vel_bajada = -por_rep(np.minimum, velocidad)
+    # Muestra -> repetición a la que pertenece, para comparar cada una con su propio pico
+    numero_rep = np.repeat(np.arange(len(valles)), np.diff(limites))
+    cerca_pico = suave[valles[0]:] >= flexion[numero_rep] - TOLERANCIA_SOSTEN
+    sosten = np.add.reduceat(np.where(cerca_pico, dt[valles[0]:], 0.0), valles - valles[0])
+    duracion = t[fines] - t[valles]
+    jerk2 = por_rep(np.add, jerk ** 2 * dt)
+    muestras_rep = np.diff(limites)
+    jerk_rms = np.sqrt(por_rep(np.add, jerk ** 2) / muestras_rep)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ldlj = -np.log(duracion ** 5 / np.maximum(rom, 1e-9) ** 2 * jerk2)
+
+    redondear = lambda x, d=1: None if not np.isfinite(x) else round(float(x), d) + 0.0  # sin -0.0
+    for i in range(len(valles)):
+        resultado["repeticiones"].append({
+            "numero": i + 1,
+            "inicio": round(float(t[valles[i]]), 3),
+            "duracion": redondear(duracion[i], 2),
+            "flexion_max": redondear(flexion[i]),
+            "extension": redondear(extension[i]),
+            "rom": redondear(rom[i]),
+            "velocidad_subida": redondear(vel_subida[i]),
+            "velocidad_bajada": redondear(vel_bajada[i]),
+            "sosten": redondear(sosten[i], 2),
+            "jerk_rms": redondear(jerk_rms[i]),
+            "ldlj": redondear(ldlj[i], 2),
+        })
+
+    tercio = max(1, len(rom) // 3)
+    tendencia = len(rom) >= 3
+    ldlj_validos = ldlj[np.isfinite(ldlj)]
+    resultado["resumen"] = {
+        "repeticiones": int(len(rom)),
+        "rom_medio": redondear(rom.mean()),
+        "rom_max": redondear(rom.max()),
+        "flexion_max": redondear(flexion.max()),
+        "velocidad_media": redondear(vel_subida.mean()),
+        "sosten_medio": redondear(sosten.mean(), 2),
+        "ldlj_medio": redondear(ldlj_validos.mean(), 2) if len(ldlj_validos) else None,
+        "tendencia_rom": redondear(_pendiente(rom), 2) if tendencia else None,
+        "tendencia_velocidad": redondear(_pendiente(vel_subida), 2) if tendencia else None,
+        "indice_fatiga": redondear(1 - rom[-tercio:].mean() / rom[:tercio].mean(), 3) if tendencia else None,
+    }
+    return resultado
+
+
+def analisis_sesion(sesion_id):
+    """Análisis de la sesión, recalculado solo si cambió su telemetría.
+
+    Si la retención ya borró las muestras crudas se devuelve el último
+    análisis calculado.
+    """
+    version = TelemetriaMaquina.objects.filter(sesion_id=sesion_id).aggregate(n=Count("id"), ultimo=Max("id"))
+    clave = f"analisis_sesion:{sesion_id}"
+    guardado = cache.get(clave)
+    actual = (version["n"], version["ultimo"])
+    if guardado is not None and (guardado[0] == actual or version["n"] == 0):
+        return guardado[1]
+    _requiere_numpy()
+    filas = TelemetriaMaquina.objects.filter(sesion_id=sesion_id).values_list("ts", "grados")
+    serie = np.array(list(filas), dtype=float).reshape(-1, 2)
+    resultado = analizar(serie[:, 0], serie[:, 1])
+    cache.set(clave, (actual, resultado), getattr(settings, "ANALISIS_CACHE_TTL", None))
+    return resultado
@@ -0,0 +1,163 @@
+"""Analítica por paciente sobre agregados mantenidos de forma incremental.
+
+Cada vez que una SesionTerapia se cierra (ver signals.py) se suman sus números
+a ResumenPaciente y a la fila de su semana en ResumenSemanalPaciente; las
+consultas del dashboard solo leen esas filas, sin importar cuántas sesiones
+tenga el paciente.
+"""
+import datetime
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from .models import ResumenPaciente, ResumenSemanalPaciente, SesionTerapia
+
+CONTADORES = (
+    "sesiones", "sesiones_completadas", "repeticiones_objetivo",
+    "repeticiones_completadas", "suma_grados", "grados_max",
+)
+
+
+def lunes_de(fecha):
+    fecha = timezone.localdate(fecha) if isinstance(fecha, datetime.datetime) else fecha
+    return fecha - datetime.timedelta(days=fecha.weekday())
+
+
+def _aporte(sesion):
+    grados = sesion.grados_alcanzados
+    if grados is None:
+        # Sin telemetría de la sesión se toma el objetivo si se completó
+        grados = sesion.grados_objetivo if sesion.completada else 0
+    return {
+        "sesiones": 1,
+        "sesiones_completadas": int(sesion.completada),
+        "repeticiones_objetivo": max(sesion.repeticiones_objetivo or 0, 0),
+        "repeticiones_completadas": max(sesion.repeticiones_completadas or 0, 0),
+        "suma_grados": grados,
+        "grados_max": grados,
+    }
+
+
+def registrar_cierre(sesion):
+    """Suma una sesión cerrada a los agregados del paciente (2 filas, con F())."""
+    aporte = _aporte(sesion)
+    incrementos = {
+        campo: F(campo) + valor for campo, valor in aporte.items() if campo != "grados_max"
+    }
+    incrementos["grados_max"] = Greatest(F("grados_max"), aporte["grados_max"])
+
+    with transaction.atomic():
+        ResumenPaciente.objects.get_or_create(usuario_id=sesion.usuario_id)
+        ResumenPaciente.objects.filter(usuario_id=sesion.usuario_id).update(
+            **incrementos,
+            primera_sesion=Least(F("primera_sesion"), sesion.fecha_inicio),
+            ultima_sesion=Greatest(F("ultima_sesion"), sesion.fecha_inicio),
+        )
+        # Least/Greatest con NULL dan NULL en SQLite: la primera sesión se fija aparte
+        ResumenPaciente.objects.filter(usuario_id=sesion.usuario_id, primera_sesion__isnull=True).update(
+            primera_sesion=sesion.fecha_inicio, ultima_sesion=sesion.fecha_inicio
+        )
+
+        semana = lunes_de(sesion.fecha_inicio)
+        ResumenSemanalPaciente.objects.get_or_create(usuario_id=sesion.usuario_id, semana=semana)
+        ResumenSemanalPaciente.objects.filter(usuario_id=sesion.usuario_id, semana=semana).update(
+            **incrementos
+        )
+
+
+def recalcular(usuario_ids=None):
+    """Reconstruye los agregados desde SesionTerapia (para datos previos o reparar)."""
+    sesiones = SesionTerapia.objects.exclude(completada=False, fecha_fin__isnull=True)
+    resumenes = ResumenPaciente.objects.all()
+    semanales = ResumenSemanalPaciente.objects.all()
+    if usuario_ids is not None:
+        sesiones = sesiones.filter(usuario_id__in=usuario_ids)
+        resumenes = resumenes.filter(usuario_id__in=usuario_ids)
+        semanales = semanales.filter(usuario_id__in=usuario_ids)
+
+    totales, por_semana = {}, {}
+    for sesion in sesiones.iterator(chunk_size=2000):
+        aporte = _aporte(sesion)
+        for clave, tabla in (
+            (sesion.usuario_id, totales),
+            ((sesion.usuario_id, lunes_de(sesion.fecha_inicio)), por_semana),
+        ):
+            fila = tabla.setdefault(clave, dict.fromkeys(CONTADORES, 0))
+            for campo in CONTADORES:
+                if campo == "grados_max":
+                    fila[campo] = max(fila[campo], aporte[campo])
+                else:
+                    fila[campo] += aporte[campo]
+            if tabla is totales:
+                fila["primera_sesion"] = min(filter(None, (fila.get("primera_sesion"), sesion.fecha_inicio)))
+                fila["ultima_sesion"] = max(filter(None, (fila.get("ultima_sesion"), sesion.fecha_inicio)))
+
+    with transaction.atomic():
+        resumenes.delete()
+        semanales.delete()
+        ResumenPaciente.objects.bulk_create(
+            [ResumenPaciente(usuario_id=u, **fila) for u, fila in totales.items()], batch_size=1000
+        )
+        ResumenSemanalPaciente.objects.bulk_create(
+            [ResumenSemanalPaciente(usuario_id=u, semana=s, **fila) for (u, s), fila in por_semana.items()],
+            batch_size=1000,
+        )
+    return len(totales)
+
+
+def _proporcion(parte, total):
+    return round(parte / total, 3) if total else None
+
+
+def _metricas(fila):
+    return {
+        "sesiones": fila.sesiones,
+        "sesiones_completadas": fila.sesiones_completadas,
+        "repeticiones_objetivo": fila.repeticiones_objetivo,
+        "repeticiones_completadas": fila.repeticiones_completadas,
+        "grados_promedio": round(fila.suma_grados / fila.sesiones, 1) if fila.sesiones else None,
+        "grados_max": fila.grados_max,
+        "adherencia_sesiones": _proporcion(fila.sesiones_completadas, fila.sesiones),
+        "adherencia_repeticiones": _proporcion(fila.repeticiones_completadas, fila.repeticiones_objetivo),
+    }
+
+
+def _pendiente(puntos):
+    """Pendiente (mínimos cuadrados) de [(x, y)], en unidades de y por semana."""
+    if len(puntos) < 2:
+        return None
+    n = len(puntos)
+    mx = sum(x for x, _ in puntos) / n
+    my = sum(y for _, y in puntos) / n
+    var = sum((x - mx) ** 2 for x, _ in puntos)
+    return round(sum((x - mx) * (y - my) for x, y in puntos) / var, 2) if var else None
+
+
+def analitica_paciente(usuario_id, semanas=12):
+    """Totales, adherencia, tendencia de rango de movimiento y resumen semanal."""
+    resumen = ResumenPaciente.objects.filter(usuario_id=usuario_id).first()
+    desde = lunes_de(timezone.localdate()) - datetime.timedelta(weeks=semanas - 1)
+    filas = list(
+        ResumenSemanalPaciente.objects.filter(usuario_id=usuario_id, semana__gte=desde).order_by("semana")
+    )
+
+    por_semana = []
+    for fila in filas:
+        datos = _metricas(fila)
+        datos["semana"] = fila.semana.isoformat()
+        por_semana.append(datos)
+
+    tendencia = _pendiente([
+        ((fila.semana - desde).days / 7, fila.suma_grados / fila.sesiones)
+        for fila in filas if fila.sesiones
+    ])
+    return {
+        "paciente": usuario_id,
+        "totales": _metricas(resumen) if resumen else _metricas(ResumenPaciente()),
+        "primera_sesion": resumen.primera_sesion if resumen else None,
+        "ultima_sesion": resumen.ultima_sesion if resumen else None,
+        "tendencia_grados_por_semana": tendencia,
+        "semanas": por_semana,
+    }
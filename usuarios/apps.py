@@ -5,3 +5,5 @@ class UsuariosConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'usuarios'
 
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,185 @@
+"""Cola de comandos por máquina con reclamo atómico.
+
+Un comando pendiente (``ejecutado=False``) se *reclama* con un UPDATE
+condicional: solo la petición cuyo UPDATE encuentre la fila todavía libre se
+queda con ella, así dos sondeos simultáneos nunca entregan el mismo comando.
+Si la máquina no confirma dentro de ``visibilidad`` segundos el comando vuelve
+a estar disponible, hasta ``COLA_MAX_INTENTOS`` veces; los comandos vencidos o
+sin intentos restantes se descartan.
+
+Un envío (EnvioComandos) encola el mismo comando en muchas máquinas con un
+solo bulk_create; su estado por máquina se deduce de las filas de la cola.
+"""
+import time
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from .eventos import bus_comandos
+from .models import ComandoMaquina, EnvioComandos
+from .tareas import TareaPeriodica
+
+
+def _visibilidad():
+    return getattr(settings, "COLA_VISIBILIDAD", 30)
+
+
+def _max_intentos():
+    return getattr(settings, "COLA_MAX_INTENTOS", 3)
+
+
+def _libres(ahora, visibilidad):
+    """Condición de "se puede reclamar" (se repite en el UPDATE a propósito)."""
+    return (
+        Q(ejecutado=False, intentos__lt=_max_intentos())
+        & (Q(timestamp_reclamo__isnull=True) | Q(timestamp_reclamo__lt=ahora - visibilidad))
+        & (Q(expira__isnull=True) | Q(expira__gt=ahora))
+    )
+
+
+def encolar(maquina, accion, grados=None, repeticiones=None, usuario=None, ttl=None, plan=None):
+    """Agrega un comando a la cola de la máquina (avisa al long-poll por signal)."""
+    ahora = time.time()
+    return ComandoMaquina.objects.create(
+        maquina=maquina,
+        accion=accion,
+        grados=grados,
+        repeticiones=repeticiones,
+        usuario=usuario,
+        timestamp_creacion=ahora,
+        expira=_expira(ahora, ttl),
+        plan=plan,
+    )
+
+
+def _expira(ahora, ttl):
+    ttl = getattr(settings, "COLA_COMANDO_TTL", 600) if ttl is None else ttl
+    return ahora + ttl if ttl else None
+
+
+def encolar_envio(maquinas, accion, grados=None, repeticiones=None, pacientes=None,
+                  selector="maquinas", creado_por=None, ttl=None):
+    """Encola el mismo comando en varias máquinas en una transacción.
+
+    ``maquinas`` son pares (id, numero) y ``pacientes`` un dict opcional
+    maquina_id -> paciente_id. bulk_create no dispara post_save, así que los
+    long-polls se despiertan aquí, tras el commit.
+    """
+    ahora = time.time()
+    pacientes = pacientes or {}
+    with transaction.atomic():
+        envio = EnvioComandos.objects.create(
+            accion=accion,
+            grados=grados,
+            repeticiones=repeticiones,
+            selector=selector,
+            total=len(maquinas),
+            creado_por=creado_por,
+            timestamp_creacion=ahora,
+        )
+        comandos = ComandoMaquina.objects.bulk_create([
+            ComandoMaquina(
+                maquina_id=maquina_id,
+                accion=accion,
+                grados=grados,
+                repeticiones=repeticiones,
+                usuario_id=pacientes.get(maquina_id),
+                timestamp_creacion=ahora,
+                expira=_expira(ahora, ttl),
+                envio=envio,
+            )
+            for maquina_id, _ in maquinas
+        ])
+        avisos = [(numero, comando.pk) for (_, numero), comando in zip(maquinas, comandos)]
+        transaction.on_commit(lambda: [bus_comandos.publicar(n, {"id": pk}, tipo="comando") for n, pk in avisos])
+    return envio
+
+
+def estado_comando(ejecutado, descartado, timestamp_reclamo):
+    if descartado:
+        return "descartado"
+    if ejecutado:
+        return "ejecutado"
+    # Reclamado por la máquina pero todavía sin confirmar (o a la espera de reintento)
+    return "entregado" if timestamp_reclamo is not None else "pendiente"
+
+
+def estado_envio(envio_id, detalle=True):
+    """Conteo por estado y, con ``detalle``, el estado de cada máquina (una consulta cada uno)."""
+    comandos = ComandoMaquina.objects.filter(envio_id=envio_id)
+    conteo = comandos.aggregate(
+        ejecutados=Count("id", filter=Q(ejecutado=True, descartado=False)),
+        descartados=Count("id", filter=Q(descartado=True)),
+        entregados=Count("id", filter=Q(ejecutado=False, timestamp_reclamo__isnull=False)),
+        pendientes=Count("id", filter=Q(ejecutado=False, timestamp_reclamo__isnull=True)),
+    )
+    resultado = {"resumen": conteo}
+    if detalle:
+        filas = comandos.order_by("id").values_list(
+            "id", "maquina__numero", "ejecutado", "descartado", "timestamp_reclamo", "timestamp_ejecucion", "intentos"
+        )
+        resultado["maquinas"] = [
+            {
+                "comando": pk,
+                "maquina": numero,
+                "estado": estado_comando(ejecutado, descartado, reclamo),
+                "intentos": intentos,
+                "timestamp_ejecucion": ejecucion,
+            }
+            for pk, numero, ejecutado, descartado, reclamo, ejecucion, intentos in filas
+        ]
+    return resultado
+
+
+def reclamar(maquina, limite=1, visibilidad=None, filtro=None):
+    """Reclama hasta ``limite`` comandos, del más antiguo al más nuevo.
+
+    ``filtro`` (un Q) restringe qué comandos se pueden reclamar.
+    Devuelve ``(token, comandos)``; el token sirve para confirmarlos.
+    """
+    ahora = time.time()
+    visibilidad = _visibilidad() if visibilidad is None else visibilidad
+    libres = _libres(ahora, visibilidad)
+    pendientes = ComandoMaquina.objects.filter(libres, maquina=maquina)
+    if filtro is not None:
+        pendientes = pendientes.filter(filtro)
+    candidatos = list(pendientes.order_by("timestamp_creacion").values_list("id", flat=True)[:limite])
+    if not candidatos:
+        _tarea_descartar.iniciar()
+        return None, []
+
+    token = uuid.uuid4().hex
+    ComandoMaquina.objects.filter(libres, id__in=candidatos).update(
+        token_reclamo=token,
+        timestamp_reclamo=ahora,
+        intentos=F("intentos") + 1,
+    )
+    comandos = list(
+        ComandoMaquina.objects.filter(id__in=candidatos, token_reclamo=token)
+        .order_by("timestamp_creacion")
+    )
+    return (token, comandos) if comandos else (None, [])
+
+
+def confirmar(token, maquina=None):
+    """Marca como ejecutados los comandos reclamados con ``token``."""
+    if not token:
+        return 0
+    comandos = ComandoMaquina.objects.filter(token_reclamo=token, ejecutado=False)
+    if maquina is not None:
+        comandos = comandos.filter(maquina=maquina)
+    return comandos.update(ejecutado=True, timestamp_ejecucion=time.time())
+
+
+def descartar_vencidos():
+    """Cierra los comandos vencidos o sin intentos para que no ocupen la cola."""
+    ahora = time.time()
+    return ComandoMaquina.objects.filter(ejecutado=False).filter(
+        Q(expira__lte=ahora)
+        | Q(intentos__gte=_max_intentos(), timestamp_reclamo__lt=ahora - _visibilidad())
+    ).update(ejecutado=True, descartado=True)
+
+
+_tarea_descartar = TareaPeriodica(descartar_vencidos, 60, "cola-descartar")
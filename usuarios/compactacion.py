@@ -0,0 +1,278 @@
+"""Agregados del histórico de telemetría y retención de las muestras crudas.
+
+``compactar()`` suma las filas nuevas de TelemetriaMaquina (id mayor que el
+cursor) a tres niveles: por segundo, por minuto y por sesión. Los agregados son
+combinables (mín/máx/suma/conteo), así que las muestras que llegan tarde, p. ej.
+un lote que la ESP32 tenía en su buffer, se suman al intervalo que les toca sin
+recalcular nada. Cada lote avanza el cursor en la misma transacción; con el
+cursor bloqueado (select_for_update) dos compactaciones no se pisan.
+
+``purgar()`` borra por bloques lo que ya está agregado y salió de la retención.
+``serie()`` responde rangos eligiendo el nivel más grueso que sirve para la
+resolución pedida y completa con las muestras crudas aún sin compactar.
+"""
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import (
+    CursorCompactacion, TelemetriaMaquina, TelemetriaMinuto, TelemetriaSegundo, TelemetriaSesion,
+)
+from .tareas import TareaPeriodica
+
+CURSOR = "telemetria"
+CAMPOS = (
+    "muestras", "grados_min", "grados_max", "suma_grados",
+    "repeticiones_min", "repeticiones_max", "segundos_activos",
+)
+
+Nivel = namedtuple("Nivel", "nombre ancho modelo")
+NIVELES = (
+    Nivel("crudo", 0, TelemetriaMaquina),
+    Nivel("segundo", 1, TelemetriaSegundo),
+    Nivel("minuto", 60, TelemetriaMinuto),
+)
+
+
+def retencion():
+    """Segundos que se conserva cada nivel (None = para siempre)."""
+    config = {"crudo": 7 * 86400, "segundo": 30 * 86400, "minuto": None}
+    config.update(getattr(settings, "TELEMETRIA_RETENCION", {}))
+    return config
+
+
+# -------------------------------
+# Agregados en memoria
+# -------------------------------
+
+def _agregado(grados, repeticiones):
+    return {
+        "muestras": 1, "grados_min": grados, "grados_max": grados, "suma_grados": float(grados),
+        "repeticiones_min": repeticiones, "repeticiones_max": repeticiones, "segundos_activos": 0,
+    }
+
+
+def _combinar(acumulado, otro):
+    """Suma ``otro`` sobre ``acumulado`` (dict u objeto de modelo)."""
+    obtener = (lambda o, c: o[c]) if isinstance(acumulado, dict) else getattr
+    fijar = acumulado.__setitem__ if isinstance(acumulado, dict) else (lambda c, v: setattr(acumulado, c, v))
+    fijar("muestras", obtener(acumulado, "muestras") + otro["muestras"])
+    fijar("suma_grados", obtener(acumulado, "suma_grados") + otro["suma_grados"])
+    fijar("segundos_activos", obtener(acumulado, "segundos_activos") + otro["segundos_activos"])
+    for campo in ("grados_min", "repeticiones_min"):
+        fijar(campo, min(obtener(acumulado, campo), otro[campo]))
+    for campo in ("grados_max", "repeticiones_max"):
+        fijar(campo, max(obtener(acumulado, campo), otro[campo]))
+
+
+def _acumular(tabla, clave, agregado):
+    if clave in tabla:
+        _combinar(tabla[clave], agregado)
+    else:
+        tabla[clave] = dict(agregado)
+
+
+def _como_dict(obj):
+    return {campo: getattr(obj, campo) for campo in CAMPOS}
+
+
+# -------------------------------
+# Compactación
+# -------------------------------
+
+def _existentes(modelo, claves):
+    """Filas ya guardadas para las claves (maquina, inicio), una consulta por máquina."""
+    por_maquina = defaultdict(list)
+    for maquina, inicio in claves:
+        por_maquina[maquina].append(inicio)
+    existentes = {}
+    for maquina, inicios in por_maquina.items():
+        for obj in modelo.objects.filter(maquina_id=maquina, inicio__gte=min(inicios), inicio__lte=max(inicios)):
+            existentes[(maquina, obj.inicio)] = obj
+    return existentes
+
+
+def _guardar(modelo, nuevos, existentes, constructor):
+    crear, actualizar = [], []
+    for clave, agregado in nuevos.items():
+        obj = existentes.get(clave)
+        if obj is None:
+            crear.append(constructor(clave, agregado))
+        else:
+            _combinar(obj, agregado)
+            actualizar.append(obj)
+    modelo.objects.bulk_create(crear, batch_size=1000)
+    modelo.objects.bulk_update(actualizar, CAMPOS + (("ts_inicio", "ts_fin") if modelo is TelemetriaSesion else ()),
+                               batch_size=1000)
+
+
+def _sumar_lote(filas):
+    segundos, minutos, sesiones = {}, {}, {}
+    activos = defaultdict(set)   # (maquina, segundo) -> sesiones con muestras activas
+    for _, maquina, sesion, ts, grados, repeticiones, activo in filas:
+        segundo = int(ts)
+        agregado = _agregado(grados, repeticiones)
+        _acumular(segundos, (maquina, segundo), agregado)
+        _acumular(minutos, (maquina, segundo - segundo % 60), agregado)
+        if sesion is not None:
+            _acumular(sesiones, sesion, agregado)
+            rango = sesiones[sesion].setdefault("ts", [ts, ts])
+            rango[0], rango[1] = min(rango[0], ts), max(rango[1], ts)
+        if activo:
+            activos[(maquina, segundo)].add(sesion)
+
+    # Tiempo activo = segundos con alguna muestra activa. Un segundo solo suma
+    # a su minuto y a su sesión la primera vez que pasa a activo.
+    previos = _existentes(TelemetriaSegundo, segundos)
+    for clave, sesiones_activas in activos.items():
+        if clave in previos and previos[clave].segundos_activos:
+            continue
+        segundos[clave]["segundos_activos"] = 1
+        maquina, segundo = clave
+        minutos[(maquina, segundo - segundo % 60)]["segundos_activos"] += 1
+        for sesion in sesiones_activas - {None}:
+            sesiones[sesion]["segundos_activos"] += 1
+
+    _guardar(TelemetriaSegundo, segundos, previos,
+             lambda clave, a: TelemetriaSegundo(maquina_id=clave[0], inicio=clave[1], **a))
+    _guardar(TelemetriaMinuto, minutos, _existentes(TelemetriaMinuto, minutos),
+             lambda clave, a: TelemetriaMinuto(maquina_id=clave[0], inicio=clave[1], **a))
+
+    rangos = {sesion: agregado.pop("ts") for sesion, agregado in sesiones.items()}
+    previas = {obj.sesion_id: obj for obj in TelemetriaSesion.objects.filter(sesion_id__in=list(sesiones))}
+    for sesion, obj in previas.items():
+        obj.ts_inicio = min(obj.ts_inicio, rangos[sesion][0])
+        obj.ts_fin = max(obj.ts_fin, rangos[sesion][1])
+    _guardar(TelemetriaSesion, sesiones, previas,
+             lambda sesion, a: TelemetriaSesion(sesion_id=sesion, ts_inicio=rangos[sesion][0],
+                                                ts_fin=rangos[sesion][1], **a))
+
+
+def compactar(lote=20000, max_lotes=None):
+    """Agrega las muestras nuevas, ``lote`` filas por transacción. Devuelve cuántas procesó."""
+    CursorCompactacion.objects.get_or_create(nombre=CURSOR)
+    total, lotes = 0, 0
+    while max_lotes is None or lotes < max_lotes:
+        with transaction.atomic():
+            cursor = CursorCompactacion.objects.select_for_update().get(nombre=CURSOR)
+            filas = list(
+                TelemetriaMaquina.objects.filter(pk__gt=cursor.ultimo_id).order_by("pk").values_list(
+                    "pk", "maquina_id", "sesion_id", "ts", "grados", "repeticiones", "activo"
+                )[:lote]
+            )
+            if not filas:
+                break
+            _sumar_lote(filas)
+            cursor.ultimo_id = filas[-1][0]
+            cursor.save(update_fields=["ultimo_id"])
+        total += len(filas)
+        lotes += 1
+        if len(filas) < lote:
+            break
+    return total
+
+
+def _borrar_por_bloques(consulta, lote):
+    borradas = 0
+    while True:
+        ids = list(consulta.order_by("pk").values_list("pk", flat=True)[:lote])
+        if not ids:
+            return borradas
+        consulta.model.objects.filter(pk__in=ids).delete()
+        borradas += len(ids)
+
+
+def purgar(lote=5000, ahora=None):
+    """Borra lo que salió de la retención; las muestras crudas solo si ya están agregadas."""
+    ahora = ahora or time.time()
+    dias = retencion()
+    cursor = CursorCompactacion.objects.filter(nombre=CURSOR).values_list("ultimo_id", flat=True).first() or 0
+    borradas = {}
+    if dias["crudo"] is not None:
+        borradas["crudo"] = _borrar_por_bloques(
+            TelemetriaMaquina.objects.filter(pk__lte=cursor, ts__lt=ahora - dias["crudo"]), lote
+        )
+    for nivel in NIVELES[1:]:
+        if dias[nivel.nombre] is not None:
+            borradas[nivel.nombre] = _borrar_por_bloques(
+                nivel.modelo.objects.filter(inicio__lt=ahora - dias[nivel.nombre]), lote
+            )
+    return borradas
+
+
+def compactar_y_purgar():
+    compactar()
+    purgar()
+
+
+_intervalo = getattr(settings, "TELEMETRIA_COMPACTAR_CADA", 60)
+_tarea_compactar = TareaPeriodica(compactar_y_purgar, _intervalo, "telemetria-compactar") if _intervalo else None
+
+
+def programar():
+    """Arranca la compactación periódica en este proceso salvo con TELEMETRIA_COMPACTAR_CADA = None."""
+    if _tarea_compactar is not None:
+        _tarea_compactar.iniciar()
+
+
+# -------------------------------
+# Consultas por rango
+# -------------------------------
+
+def elegir_nivel(resolucion, desde, ahora=None):
+    """Nivel más grueso cuyo intervalo no supera ``resolucion`` y que aún cubre ``desde``."""
+    ahora = ahora or time.time()
+    dias = retencion()
+    indice = max(i for i, nivel in enumerate(NIVELES) if nivel.ancho <= max(resolucion, 0))
+    while indice < len(NIVELES) - 1:
+        vigencia = dias[NIVELES[indice].nombre]
+        if vigencia is None or desde >= ahora - vigencia:
+            break
+        indice += 1
+    return NIVELES[indice]
+
+
+def serie(maquina_id, desde, hasta, resolucion, limite=None):
+    """Puntos agregados cada ``resolucion`` segundos entre ``desde`` y ``hasta``.
+
+    Devuelve ``(nivel, puntos)``. Cada punto lleva "t" (inicio del intervalo)
+    y los campos del agregado más "grados_media". ``limite`` acota las muestras
+    crudas leídas, también la cola aún sin compactar de los niveles agregados.
+    """
+    nivel = elegir_nivel(resolucion, desde)
+    puntos = {}
+
+    def agregar(t, agregado):
+        clave = t - t % resolucion if resolucion else t
+        _acumular(puntos, clave, agregado)
+
+    if nivel.ancho:
+        # Incluye el intervalo del nivel que contiene a ``desde``
+        desde = int(desde) - int(desde) % nivel.ancho
+    crudas = TelemetriaMaquina.objects.filter(maquina_id=maquina_id, ts__gte=desde, ts__lt=hasta)
+    if nivel.ancho:
+        for obj in nivel.modelo.objects.filter(maquina_id=maquina_id, inicio__gte=desde, inicio__lt=hasta):
+            agregar(obj.inicio, _como_dict(obj))
+        # Muestras todavía sin compactar: se agregan al vuelo
+        cursor = CursorCompactacion.objects.filter(nombre=CURSOR).values_list("ultimo_id", flat=True).first() or 0
+        # Con la compactación al día son los últimos segundos; si va atrasada,
+        # el tope evita recorrer toda la cola
+        crudas = crudas.filter(pk__gt=cursor).order_by("pk")[:limite]
+    else:
+        crudas = crudas.order_by("ts")[:limite]
+
+    for ts, grados, repeticiones, activo in crudas.values_list("ts", "grados", "repeticiones", "activo"):
+        inicio = int(ts) - int(ts) % nivel.ancho if nivel.ancho else ts
+        agregado = _agregado(grados, repeticiones)
+        agregado["segundos_activos"] = int(activo and nivel.ancho > 0)
+        agregar(inicio, agregado)
+
+    resultado = []
+    for t in sorted(puntos):
+        punto = puntos[t]
+        punto["t"] = t
+        punto["grados_media"] = round(punto["suma_grados"] / punto["muestras"], 2)
+        resultado.append(punto)
+    return nivel, resultado
@@ -0,0 +1,170 @@
+"""Conectividad de las máquinas mantenida de forma incremental.
+
+Cada contacto (sondeo o telemetría) mueve el plazo de la máquina a
+``ahora + ttl_conexion``. Los plazos viven en un min-heap con una sola entrada
+por máquina: al vencer la cima, si la máquina tuvo contacto después se vuelve
+a insertar con su plazo nuevo (O(log n)); si no, pasa a desconectada. Las
+transiciones se guardan en EstadoMaquina con un UPDATE por sentido y se
+publican en ``bus_estado``; "¿está conectada?" es una consulta a un set.
+
+Con varios workers cada proceso solo ve sus propios contactos, así que antes
+de desconectar una máquina se comprueba su ``ultimo_timestamp`` en la BD (lo
+mantiene latidos.py) y se rearma el plazo si otro worker la vio.
+"""
+import heapq
+import threading
+import time
+
+from django.conf import settings
+
+from .estado import almacen_estado, conectado_por_tiempo
+from .eventos import bus_estado
+from .models import EstadoMaquina
+from .tareas import TareaPeriodica
+
+
+class MonitorConectividad:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._heap = []           # (plazo, nombre), una entrada por máquina
+        self._plazos = {}         # nombre -> plazo vigente
+        self._ids = {}            # nombre -> maquina_id
+        self._en_linea = set()    # nombres
+        self._transiciones = {}   # maquina_id -> conectado, pendientes de guardar
+        self._cargado = False
+
+    def contacto(self, maquina_id, nombre, ts=None):
+        """Registra un contacto; O(1) salvo la primera vez (O(log n))."""
+        plazo = (ts or time.time()) + self.ttl
+        with self._lock:
+            if nombre not in self._plazos:
+                heapq.heappush(self._heap, (plazo, nombre))
+            self._plazos[nombre] = max(plazo, self._plazos.get(nombre, 0))
+            self._ids[nombre] = maquina_id
+            nueva = nombre not in self._en_linea
+            if nueva:
+                self._en_linea.add(nombre)
+                self._transiciones[maquina_id] = True
+        if nueva:
+            bus_estado.publicar(nombre, {"conectado": True})
+        _tarea_barrer.iniciar()
+
+    def conectado(self, nombre):
+        with self._lock:
+            return nombre in self._en_linea
+
+    def en_linea(self):
+        """Copia del conjunto de máquinas conectadas (por nombre)."""
+        with self._lock:
+            return set(self._en_linea)
+
+    def _cargar(self):
+        """Arranque: las máquinas que la BD da por conectadas entran al heap con su plazo real."""
+        filas = EstadoMaquina.objects.filter(conectado=True).values_list(
+            "maquina_id", "maquina__numero", "ultimo_timestamp"
+        )
+        for maquina_id, nombre, ultimo in filas:
+            with self._lock:
+                if nombre in self._plazos:
+                    continue
+                plazo = (ultimo or 0) + self.ttl
+                heapq.heappush(self._heap, (plazo, nombre))
+                self._plazos[nombre] = plazo
+                self._ids[nombre] = maquina_id
+                self._en_linea.add(nombre)
+        self._cargado = True
+
+    def _vencidas(self, ahora):
+        vencidas = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= ahora:
+                plazo, nombre = heapq.heappop(self._heap)
+                vigente = self._plazos[nombre]
+                if vigente > ahora:
+                    heapq.heappush(self._heap, (vigente, nombre))
+                else:
+                    vencidas.append(nombre)
+        return vencidas
+
+    def barrer(self, ahora=None):
+        """Desconecta las máquinas vencidas y guarda las transiciones acumuladas."""
+        if not self._cargado:
+            self._cargar()
+        ahora = ahora or time.time()
+        vencidas = self._vencidas(ahora)
+
+        # Contactos vistos por otros workers (BD) o por el almacén compartido
+        recientes = {}
+        try:
+            if vencidas:
+                ids = {self._ids[n]: n for n in vencidas}
+                for maquina_id, ultimo in EstadoMaquina.objects.filter(maquina_id__in=ids).values_list(
+                    "maquina_id", "ultimo_timestamp"
+                ):
+                    recientes[ids[maquina_id]] = ultimo or 0
+                for nombre in vencidas:
+                    estado = almacen_estado.obtener(nombre) or {}
+                    if conectado_por_tiempo(estado, ahora):
+                        recientes[nombre] = max(recientes.get(nombre, 0), estado["ultimo_timestamp"])
+        except Exception:
+            # Se devuelven al heap para revisarlas en el próximo barrido
+            with self._lock:
+                for nombre in vencidas:
+                    heapq.heappush(self._heap, (self._plazos[nombre], nombre))
+            raise
+
+        desconectadas = []
+        with self._lock:
+            for nombre in vencidas:
+                plazo = max(recientes.get(nombre, 0) + self.ttl, self._plazos[nombre])
+                if plazo > ahora:
+                    self._plazos[nombre] = plazo
+                    heapq.heappush(self._heap, (plazo, nombre))
+                    continue
+                del self._plazos[nombre]
+                if nombre in self._en_linea:
+                    self._en_linea.discard(nombre)
+                    self._transiciones[self._ids[nombre]] = False
+                    desconectadas.append(nombre)
+            transiciones, self._transiciones = self._transiciones, {}
+
+        for nombre in desconectadas:
+            bus_estado.publicar(nombre, {"conectado": False})
+        try:
+            self._guardar(transiciones)
+        except Exception:
+            # Se devuelven sin pisar transiciones más nuevas llegadas entretanto
+            with self._lock:
+                for maquina_id, conectado in transiciones.items():
+                    self._transiciones.setdefault(maquina_id, conectado)
+            raise
+        return desconectadas
+
+    def _guardar(self, transiciones):
+        for valor in (True, False):
+            ids = [m for m, conectado in transiciones.items() if conectado is valor]
+            if ids:
+                EstadoMaquina.objects.filter(maquina_id__in=ids).update(conectado=valor)
+
+    def limpiar(self):
+        with self._lock:
+            self._heap.clear()
+            self._plazos.clear()
+            self._ids.clear()
+            self._en_linea.clear()
+            self._transiciones.clear()
+            self._cargado = False
+
+
+monitor_conectividad = MonitorConectividad(almacen_estado.ttl_conexion)
+_tarea_barrer = TareaPeriodica(
+    monitor_conectividad.barrer, getattr(settings, "CONECTIVIDAD_BARRIDO", 5), "conectividad-barrer"
+)
+
+
+def esta_conectada(nombre, estado=None):
+    """Set del monitor y, de respaldo, el ``ultimo_timestamp`` del estado compartido."""
+    return monitor_conectividad.conectado(nombre) or (
+        estado is not None and conectado_por_tiempo(estado)
+    )
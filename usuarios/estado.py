@@ -0,0 +1,189 @@
+"""Almacén del estado en vivo de las máquinas, compartible entre procesos.
+
+El backend se elige con ``settings.ESTADO_ALMACEN`` (mismo formato que CACHES):
+
+    ESTADO_ALMACEN = {
+        "BACKEND": "usuarios.estado.AlmacenRedis",
+        "OPCIONES": {"url": "redis://localhost:6379/0"},
+    }
+
+``AlmacenMemoria`` sirve para desarrollo con un solo proceso; con varios
+workers de gunicorn/uvicorn hay que usar ``AlmacenRedis`` (cualquier servidor
+compatible con Redis: Redis, Valkey, KeyDB...) para que todos vean lo mismo.
+"""
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class AlmacenEstado:
+    """Interfaz común. Los estados son dicts planos serializables a JSON."""
+
+    def __init__(self, ttl_conexion=60):
+        self.ttl_conexion = ttl_conexion
+
+    def obtener(self, nombre):
+        """Copia del estado de la máquina, o None si no hay."""
+        raise NotImplementedError
+
+    def inicializar(self, nombre, estado):
+        """Guarda ``estado`` solo si la máquina no tiene uno; devuelve el vigente."""
+        raise NotImplementedError
+
+    def actualizar(self, nombre, campos, reemplazar=False):
+        """Mezcla ``campos`` (o reemplaza todo) de forma atómica por máquina.
+
+        Devuelve ``(anterior, nuevo)``; ``anterior`` es {} si no existía.
+        """
+        raise NotImplementedError
+
+    def todos(self):
+        """{nombre: estado} de todas las máquinas conocidas."""
+        raise NotImplementedError
+
+    def limpiar(self):
+        """Borra todo (útil en pruebas)."""
+        raise NotImplementedError
+
+
+class AlmacenMemoria(AlmacenEstado):
+    """Dicts en el propio proceso protegidos con un lock."""
+
+    def __init__(self, ttl_conexion=60):
+        super().__init__(ttl_conexion)
+        self._lock = threading.Lock()
+        self._estados = {}
+
+    def obtener(self, nombre):
+        with self._lock:
+            estado = self._estados.get(nombre)
+            return dict(estado) if estado is not None else None
+
+    def inicializar(self, nombre, estado):
+        with self._lock:
+            return dict(self._estados.setdefault(nombre, dict(estado)))
+
+    def actualizar(self, nombre, campos, reemplazar=False):
+        with self._lock:
+            anterior = self._estados.get(nombre, {})
+            nuevo = dict(campos) if reemplazar else {**anterior, **campos}
+            self._estados[nombre] = nuevo
+            return dict(anterior), dict(nuevo)
+
+    def todos(self):
+        with self._lock:
+            return {nombre: dict(estado) for nombre, estado in self._estados.items()}
+
+    def limpiar(self):
+        with self._lock:
+            self._estados.clear()
+
+
+# HGETALL + HSET en un solo paso atómico del servidor.
+# KEYS: hash del estado, set de nombres
+# ARGV: nombre, reemplazar (0/1), campo1, valor1, ...
+_LUA_ACTUALIZAR = """
+local anterior = redis.call('HGETALL', KEYS[1])
+if ARGV[2] == '1' then redis.call('DEL', KEYS[1]) end
+if #ARGV > 2 then redis.call('HSET', KEYS[1], unpack(ARGV, 3)) end
+redis.call('SADD', KEYS[2], ARGV[1])
+return anterior
+"""
+
+_LUA_INICIALIZAR = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+
+
+class AlmacenRedis(AlmacenEstado):
+    """Estado en hashes de Redis, uno por máquina, y un set con los nombres.
+
+    La conectividad se deduce del ``ultimo_timestamp`` guardado en el hash
+    (ver ``conectado_por_tiempo`` y conectividad.py), visible para todos los workers.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefijo="rt", ttl_conexion=60):
+        if redis is None:
+            raise ImproperlyConfigured("AlmacenRedis requiere el paquete 'redis' (pip install redis)")
+        super().__init__(ttl_conexion)
+        self.cliente = redis.Redis.from_url(url)
+        self.prefijo = prefijo
+        self._actualizar = self.cliente.register_script(_LUA_ACTUALIZAR)
+        self._inicializar = self.cliente.register_script(_LUA_INICIALIZAR)
+
+    def _llave(self, tipo, nombre=""):
+        return f"{self.prefijo}:{tipo}:{nombre}" if nombre else f"{self.prefijo}:{tipo}"
+
+    @staticmethod
+    def _decodificar(pares):
+        if isinstance(pares, dict):
+            pares = [x for par in pares.items() for x in par]
+        return {
+            pares[i].decode(): json.loads(pares[i + 1])
+            for i in range(0, len(pares), 2)
+        }
+
+    @staticmethod
+    def _codificar(campos):
+        return [x for k, v in campos.items() for x in (k, json.dumps(v))]
+
+    def obtener(self, nombre):
+        estado = self.cliente.hgetall(self._llave("estado", nombre))
+        return self._decodificar(estado) if estado else None
+
+    def inicializar(self, nombre, estado):
+        pares = self._inicializar(
+            keys=[self._llave("estado", nombre), self._llave("maquinas")],
+            args=[nombre] + self._codificar(estado),
+        )
+        return self._decodificar(pares)
+
+    def actualizar(self, nombre, campos, reemplazar=False):
+        pares = self._actualizar(
+            keys=[self._llave("estado", nombre), self._llave("maquinas")],
+            args=[nombre, int(reemplazar)] + self._codificar(campos),
+        )
+        anterior = self._decodificar(pares)
+        nuevo = dict(campos) if reemplazar else {**anterior, **campos}
+        return anterior, nuevo
+
+    def todos(self):
+        nombres = sorted(n.decode() for n in self.cliente.smembers(self._llave("maquinas")))
+        with self.cliente.pipeline(transaction=False) as pipe:
+            for nombre in nombres:
+                pipe.hgetall(self._llave("estado", nombre))
+            estados = pipe.execute()
+        return {n: self._decodificar(e) for n, e in zip(nombres, estados) if e}
+
+    def limpiar(self):
+        llaves = list(self.cliente.scan_iter(f"{self.prefijo}:*"))
+        if llaves:
+            self.cliente.delete(*llaves)
+
+
+def conectado_por_tiempo(estado, ahora=None):
+    """Conectividad de un dict de estado según su ``ultimo_timestamp``."""
+    ahora = ahora or time.time()
+    return (ahora - estado.get("ultimo_timestamp", 0)) <= almacen_estado.ttl_conexion
+
+
+def cargar_almacen():
+    config = getattr(settings, "ESTADO_ALMACEN", {})
+    backend = import_string(config.get("BACKEND", "usuarios.estado.AlmacenMemoria"))
+    return backend(**config.get("OPCIONES", {}))
+
+
+almacen_estado = cargar_almacen()
@@ -0,0 +1,161 @@
+"""Bus de eventos en proceso para transmitir cambios de estado de las máquinas.
+
+Cada proceso tiene su propio bus. Con ``AlmacenRedis`` (varios workers) los
+eventos se reenvían además por pub/sub de Redis: un comando encolado en un
+worker despierta al long-poll o al stream que sostiene otro. Con el almacén en
+memoria no hay reenvío; ese modo es solo para un proceso.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict, deque, namedtuple
+
+from .estado import almacen_estado
+
+logger = logging.getLogger("usuarios")
+
+Evento = namedtuple("Evento", ["id", "nombre", "tipo", "datos"])
+
+
+class BusEventos:
+    """Historial acotado de eventos con avisos por máquina para vistas async.
+
+    Las vistas síncronas publican desde hilos del servidor; las vistas async
+    esperan en su propio event loop, por eso el aviso usa call_soon_threadsafe.
+    """
+
+    def __init__(self, capacidad=1000, relevo=None):
+        self.relevo = relevo
+        self._lock = threading.Lock()
+        self._eventos = deque(maxlen=capacidad)
+        self._ultimo_id = 0
+        # nombre de máquina (o None para "todas") -> {(loop, asyncio.Event)}
+        self._esperando = defaultdict(set)
+
+    @property
+    def ultimo_id(self):
+        return self._ultimo_id
+
+    def publicar(self, nombre, datos, tipo="delta", relevar=True):
+        if relevar and self.relevo is not None:
+            self.relevo.enviar(nombre, tipo, datos)
+        with self._lock:
+            self._ultimo_id += 1
+            evento = Evento(self._ultimo_id, nombre, tipo, datos)
+            self._eventos.append(evento)
+            avisos = list(self._esperando.get(nombre, ())) + list(self._esperando.get(None, ()))
+        for loop, aviso in avisos:
+            try:
+                loop.call_soon_threadsafe(aviso.set)
+            except RuntimeError:
+                # El loop del suscriptor ya se cerró
+                pass
+        return evento
+
+    def desde(self, ultimo_id, nombre=None):
+        """Eventos posteriores a ``ultimo_id``.
+
+        Devuelve None si el historial ya no cubre ese id (el cliente necesita
+        un snapshot completo en lugar de deltas).
+        """
+        with self._lock:
+            if ultimo_id > self._ultimo_id:
+                return None
+            if self._eventos and ultimo_id < self._eventos[0].id - 1:
+                return None
+            eventos = list(self._eventos)
+        return [
+            e for e in eventos
+            if e.id > ultimo_id and (nombre is None or e.nombre == nombre)
+        ]
+
+    def escuchar(self):
+        """Empieza a recibir los eventos de los demás procesos (si hay relevo)."""
+        if self.relevo is not None:
+            self.relevo.escuchar(self)
+
+    async def esperar(self, ultimo_id, nombre=None, timeout=15):
+        """Espera hasta que haya un evento nuevo para ``nombre``. True si llegó."""
+        self.escuchar()
+        loop = asyncio.get_running_loop()
+        aviso = asyncio.Event()
+        clave = (loop, aviso)
+        with self._lock:
+            for e in reversed(self._eventos):
+                if e.id <= ultimo_id:
+                    break
+                if nombre is None or e.nombre == nombre:
+                    return True
+            self._esperando[nombre].add(clave)
+        try:
+            await asyncio.wait_for(aviso.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._esperando[nombre].discard(clave)
+                if not self._esperando[nombre]:
+                    del self._esperando[nombre]
+
+
+class RelevoRedis:
+    """Reenvía los eventos de un bus a los demás procesos por un canal de Redis.
+
+    Cada proceso escucha el canal en un hilo daemon que arranca con la primera
+    espera o el primer stream WSGI (los procesos que solo publican no lo
+    necesitan) y descarta los mensajes que publicó él mismo.
+    """
+
+    def __init__(self, cliente, canal):
+        self.cliente = cliente
+        self.canal = canal
+        self.origen = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def enviar(self, nombre, tipo, datos):
+        mensaje = json.dumps({"o": self.origen, "n": nombre, "t": tipo, "d": datos})
+        try:
+            self.cliente.publish(self.canal, mensaje)
+        except Exception:
+            # Sin Redis el evento igual llega a este proceso; los demás lo verán al vencer su espera
+            logger.warning("No se pudo reenviar el evento de %s por %s", nombre, self.canal, exc_info=True)
+
+    def escuchar(self, bus):
+        if self._hilo is not None:
+            return
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, args=(bus,), name=f"relevo-{self.canal}", daemon=True)
+                self._hilo.start()
+
+    def _bucle(self, bus):
+        while True:
+            try:
+                pubsub = self.cliente.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.canal)
+                for mensaje in pubsub.listen():
+                    if mensaje.get("type") != "message":
+                        continue
+                    evento = json.loads(mensaje["data"])
+                    if evento["o"] != self.origen:
+                        bus.publicar(evento["n"], evento["d"], evento["t"], relevar=False)
+            except Exception:
+                logger.exception("Relevo %s interrumpido, reconectando", self.canal)
+                time.sleep(1)
+
+
+def _relevo(canal):
+    cliente = getattr(almacen_estado, "cliente", None)
+    if cliente is None:
+        return None
+    return RelevoRedis(cliente, f"{almacen_estado.prefijo}:eventos:{canal}")
+
+
+# Instancias compartidas por las vistas del proceso
+bus_estado = BusEventos(relevo=_relevo("estado"))
+bus_comandos = BusEventos(relevo=_relevo("comandos"))
@@ -0,0 +1,122 @@
+"""Exportación de pacientes y sesiones en CSV o NDJSON con memoria constante.
+
+Las filas salen de ``.values_list().iterator(chunk_size)``: en PostgreSQL es
+un cursor del lado del servidor y en SQLite se leen con ``fetchmany``, así que
+nunca hay más de ``chunk_size`` filas en memoria. Se serializan a medida que
+se leen y se entregan en bloques de ~64 KB para no hacer un write por fila.
+Sirve igual para StreamingHttpResponse (vistas) que para un archivo (comando).
+"""
+import csv
+import datetime
+import json
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import SesionTerapia, Usuario
+
+FORMATOS = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+TAMANO_BLOQUE = 64 * 1024
+CHUNK_FILAS = 2000
+
+CAMPOS_PACIENTES = (
+    "id", "username", "nombre", "email", "peso", "altura", "tamano_de_la_pantorrilla",
+    "sesiones", "activacion_muscular", "descripcion_de_la_ultima_sesion", "date_joined",
+)
+CAMPOS_SESIONES = (
+    "id", "maquina__numero", "usuario_id", "usuario__nombre", "fecha_inicio", "fecha_fin",
+    "grados_objetivo", "repeticiones_objetivo", "repeticiones_completadas", "completada",
+    "grados_alcanzados",
+)
+
+
+def leer_fecha(valor, fin=False):
+    """Fecha u hora ISO a datetime aware. Una fecha sola en ``fin`` cubre el día entero.
+
+    None si ``valor`` viene vacío; ValueError si no se entiende.
+    """
+    if not valor:
+        return None
+    # La fecha va primero: parse_datetime también acepta "2026-03-02" (medianoche)
+    try:
+        dia = parse_date(valor)
+        momento = parse_datetime(valor) if dia is None else None
+    except ValueError:
+        raise ValueError(f"Fecha inválida: {valor}")
+    if dia is not None:
+        momento = datetime.datetime.combine(dia + datetime.timedelta(days=fin), datetime.time.min)
+    elif momento is None:
+        raise ValueError(f"Fecha inválida: {valor}")
+    if timezone.is_naive(momento):
+        momento = timezone.make_aware(momento)
+    return momento
+
+
+def _rango(consulta, campo, desde=None, hasta=None):
+    if desde is not None:
+        consulta = consulta.filter(**{f"{campo}__gte": desde})
+    if hasta is not None:
+        consulta = consulta.filter(**{f"{campo}__lt": hasta})
+    return consulta
+
+
+def pacientes(desde=None, hasta=None, paciente=None, maquina=None):
+    """Pacientes, opcionalmente por alta (date_joined), id o máquina en la que hicieron sesiones."""
+    consulta = _rango(Usuario.objects.filter(rol="paciente"), "date_joined", desde, hasta)
+    if paciente is not None:
+        consulta = consulta.filter(pk=paciente)
+    if maquina:
+        # Subconsulta en vez de JOIN + distinct, que obligaría a ordenar todo antes de emitir
+        consulta = consulta.filter(pk__in=SesionTerapia.objects.filter(maquina__numero=maquina).values("usuario_id"))
+    return consulta.order_by("pk").values_list(*CAMPOS_PACIENTES)
+
+
+def sesiones(desde=None, hasta=None, paciente=None, maquina=None):
+    """Sesiones por fecha de inicio, paciente y máquina."""
+    consulta = _rango(SesionTerapia.objects.all(), "fecha_inicio", desde, hasta)
+    if paciente is not None:
+        consulta = consulta.filter(usuario_id=paciente)
+    if maquina:
+        consulta = consulta.filter(maquina__numero=maquina)
+    return consulta.order_by("pk").values_list(*CAMPOS_SESIONES)
+
+
+CONSULTAS = {"pacientes": (pacientes, CAMPOS_PACIENTES), "sesiones": (sesiones, CAMPOS_SESIONES)}
+
+
+def _valor(valor):
+    return valor.isoformat() if isinstance(valor, (datetime.date, datetime.datetime)) else valor
+
+
+class _Linea:
+    """Destino de csv.writer que devuelve la línea en vez de escribirla."""
+
+    def write(self, texto):
+        return texto
+
+
+def _lineas(filas, campos, formato):
+    if formato == "csv":
+        escritor = csv.writer(_Linea())
+        yield escritor.writerow([c.replace("__", "_") for c in campos])
+        for fila in filas:
+            yield escritor.writerow([_valor(v) for v in fila])
+    else:
+        nombres = [c.replace("__", "_") for c in campos]
+        for fila in filas:
+            yield json.dumps(dict(zip(nombres, map(_valor, fila))), ensure_ascii=False) + "\n"
+
+
+def exportar(tipo, formato="csv", chunk_size=CHUNK_FILAS, **filtros):
+    """Generador de bloques de texto con la exportación ``tipo`` ("pacientes" o "sesiones")."""
+    consulta, campos = CONSULTAS[tipo]
+    filas = consulta(**filtros).iterator(chunk_size=chunk_size)
+    bloque, tamano = [], 0
+    for linea in _lineas(filas, campos, formato):
+        bloque.append(linea)
+        tamano += len(linea)
+        if tamano >= TAMANO_BLOQUE:
+            yield "".join(bloque)
+            bloque, tamano = [], 0
+    if bloque:
+        yield "".join(bloque)
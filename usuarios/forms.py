@@ -32,3 +32,33 @@ class UsuarioChangeForm(forms.ModelForm):
     class Meta:
         model = Usuario
         fields = ('email', 'nombre', 'rol', 'password', 'is_active', 'is_staff', 'is_superuser')
+
+
+class PacienteImportForm(forms.Form):
+    """Valida una fila de la importación masiva de pacientes (ver pacientes.importar)."""
+    nombre = forms.CharField(max_length=50)
+    email = forms.EmailField(required=False)
+    peso = forms.FloatField(required=False, min_value=0)
+    altura = forms.FloatField(required=False, min_value=0)
+    tamano_de_la_pantorrilla = forms.FloatField(required=False, min_value=0)
+    sesiones = forms.CharField(max_length=50, required=False)
+    activacion_muscular = forms.CharField(max_length=50, required=False)
+    descripcion_de_la_ultima_sesion = forms.CharField(max_length=50, required=False)
+
+
+class PasoProgramaForm(forms.Form):
+    """Valida un paso de un ProgramaTerapia (ver programas.crear)."""
+    grados = forms.IntegerField(min_value=0, max_value=180)
+    repeticiones = forms.IntegerField(min_value=1)
+    series = forms.IntegerField(min_value=1, required=False)
+    stop_grados = forms.IntegerField(min_value=0, max_value=180, required=False)
+    modo = forms.CharField(max_length=50, required=False)
+    descanso = forms.IntegerField(min_value=0, max_value=3600, required=False)
+
+    def clean(self):
+        datos = super().clean()
+        # Los opcionales vacíos toman el valor por defecto del modelo
+        for campo, defecto in (("series", 1), ("stop_grados", 0), ("modo", "normal"), ("descanso", 0)):
+            if datos.get(campo) in (None, ""):
+                datos[campo] = defecto
+        return datos
@@ -0,0 +1,90 @@
+"""Último contacto de cada máquina, acumulado en memoria.
+
+Los sondeos de las ESP32 (controlar_sesion, comando_esp) solo anotan aquí la
+hora; cada ``LATIDOS_INTERVALO`` segundos se vuelca todo a EstadoMaquina con un
+UPDATE por bloque (CASE por máquina). Una máquina cuyo último volcado tiene
+menos de ``LATIDOS_RESOLUCION`` segundos no se vuelve a escribir, así las
+escrituras dependen de cuántas máquinas hay y de sus cambios de conectividad,
+no de cada cuánto sondean.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .conectividad import monitor_conectividad
+from .models import EstadoMaquina
+from .tareas import TareaPeriodica
+
+BLOQUE = 200
+
+
+class RegistroLatidos:
+    def __init__(self, resolucion=15):
+        self.resolucion = resolucion
+        self._lock = threading.Lock()
+        self._pendientes = {}   # maquina_id -> ts aún no volcado
+        self._volcados = {}     # maquina_id -> último ts escrito en la BD
+
+    def registrar(self, maquina_id, nombre, ts=None):
+        ts = ts or time.time()
+        monitor_conectividad.contacto(maquina_id, nombre, ts)
+        with self._lock:
+            if ts - self._volcados.get(maquina_id, 0) < self.resolucion:
+                return
+            self._pendientes[maquina_id] = ts
+        _tarea_vaciar.iniciar()
+
+    def vaciar(self):
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+        if not pendientes:
+            return 0
+        try:
+            ids = list(pendientes)
+            with transaction.atomic():
+                for i in range(0, len(ids), BLOQUE):
+                    self._volcar_bloque({m: pendientes[m] for m in ids[i:i + BLOQUE]})
+            with self._lock:
+                self._volcados.update(pendientes)
+        except Exception:
+            # Se devuelven sin pisar latidos más nuevos llegados entretanto
+            with self._lock:
+                for maquina_id, ts in pendientes.items():
+                    if self._pendientes.get(maquina_id, 0) < ts:
+                        self._pendientes[maquina_id] = ts
+            raise
+        return len(pendientes)
+
+    @staticmethod
+    def _volcar_bloque(bloque):
+        existentes = set(
+            EstadoMaquina.objects.filter(maquina_id__in=bloque).values_list("maquina_id", flat=True)
+        )
+        if existentes:
+            EstadoMaquina.objects.filter(maquina_id__in=existentes).update(
+                conectado=True,
+                # Greatest: no retroceder una hora escrita por recibir_datos_esp
+                ultimo_timestamp=Greatest(
+                    Coalesce(F("ultimo_timestamp"), Value(0.0)),
+                    Case(
+                        *[When(maquina_id=m, then=Value(bloque[m])) for m in existentes],
+                        output_field=FloatField(),
+                    ),
+                ),
+            )
+        nuevas = [
+            EstadoMaquina(maquina_id=m, conectado=True, ultimo_timestamp=ts)
+            for m, ts in bloque.items() if m not in existentes
+        ]
+        if nuevas:
+            EstadoMaquina.objects.bulk_create(nuevas, ignore_conflicts=True)
+
+
+latidos = RegistroLatidos(getattr(settings, "LATIDOS_RESOLUCION", 15))
+_tarea_vaciar = TareaPeriodica(
+    latidos.vaciar, getattr(settings, "LATIDOS_INTERVALO", 5), "latidos-vaciar"
+)
@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, transaction
+
+from usuarios.maquinas import resumen_maquinas
+from usuarios.models import EstadoMaquina, Maquinas, TelemetriaMaquina
+
+
+class Command(BaseCommand):
+    help = (
+        "Carga concurrente contra la BD configurada (perfil DB_PERFIL): escritores que "
+        "simulan la ingesta de las ESP32 y lectores que simulan los dashboards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--maquinas", type=int, default=50)
+        parser.add_argument("--escritores", type=int, default=4)
+        parser.add_argument("--lectores", type=int, default=8)
+        parser.add_argument("--segundos", type=float, default=10)
+
+    def handle(self, *args, **opciones):
+        prefijo = "bench-bd-"
+        maquinas = Maquinas.objects.bulk_create(
+            [Maquinas(numero=f"{prefijo}{i}", ip="0.0.0.0") for i in range(opciones["maquinas"])]
+        )
+        maquinas = list(Maquinas.objects.filter(numero__startswith=prefijo))
+        EstadoMaquina.objects.bulk_create([EstadoMaquina(maquina=m) for m in maquinas])
+        ids = [m.pk for m in maquinas]
+
+        fin = time.monotonic() + opciones["segundos"]
+        conteos = {"escrituras": 0, "lecturas": 0, "bloqueos": 0}
+        lock = threading.Lock()
+
+        def escritor():
+            try:
+                while time.monotonic() < fin:
+                    maquina_id = random.choice(ids)
+                    grados = random.randint(0, 120)
+                    try:
+                        # Lo que hace recibir_datos_esp por muestra
+                        with transaction.atomic():
+                            EstadoMaquina.objects.filter(maquina_id=maquina_id).update(
+                                grados_actuales=grados, ultimo_timestamp=time.time(), conectado=True
+                            )
+                            TelemetriaMaquina.objects.create(
+                                maquina_id=maquina_id, ts=time.time(), grados=grados, repeticiones=0
+                            )
+                        campo = "escrituras"
+                    except OperationalError:
+                        campo = "bloqueos"
+                    with lock:
+                        conteos[campo] += 1
+            finally:
+                connection.close()
+
+        def lector():
+            try:
+                while time.monotonic() < fin:
+                    try:
+                        resumen_maquinas()
+                        list(TelemetriaMaquina.objects.filter(
+                            maquina_id=random.choice(ids), ts__gte=time.time() - 60
+                        ).values_list("ts", "grados"))
+                        campo = "lecturas"
+                    except OperationalError:
+                        campo = "bloqueos"
+                    with lock:
+                        conteos[campo] += 1
+            finally:
+                connection.close()
+
+        hilos = [threading.Thread(target=escritor) for _ in range(opciones["escritores"])]
+        hilos += [threading.Thread(target=lector) for _ in range(opciones["lectores"])]
+        inicio = time.monotonic()
+        try:
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+        finally:
+            duracion = time.monotonic() - inicio
+            Maquinas.objects.filter(numero__startswith=prefijo).delete()
+
+        self.stdout.write(
+            f"perfil={getattr(settings, 'DB_PERFIL', 'sqlite')} "
+            f"ingesta={conteos['escrituras'] / duracion:.0f}/s "
+            f"lecturas={conteos['lecturas'] / duracion:.0f}/s "
+            f"bloqueos={conteos['bloqueos']}"
+        )
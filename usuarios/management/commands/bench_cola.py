@@ -0,0 +1,68 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from usuarios import cola
+from usuarios.models import ComandoMaquina, Maquinas
+
+
+class Command(BaseCommand):
+    help = "Mide reclamar/confirmar de la cola con miles de comandos en el historial de una máquina."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--historial", type=int, nargs="+", default=[100, 1000, 10000],
+                            help="Comandos ya ejecutados por máquina en cada ronda")
+        parser.add_argument("--pendientes", type=int, default=1000,
+                            help="Comandos en cola por máquina en cada ronda")
+        parser.add_argument("--reclamos", type=int, default=200)
+
+    def handle(self, *args, **opciones):
+        # Todo corre dentro de una transacción que se revierte al final
+        try:
+            with transaction.atomic():
+                for historial in opciones["historial"]:
+                    self._ronda(historial, opciones["pendientes"], opciones["reclamos"])
+                raise _Revertir
+        except _Revertir:
+            pass
+
+    def _ronda(self, historial, pendientes, reclamos):
+        maquina = Maquinas.objects.create(numero=f"bench-cola-{historial}", ip="0.0.0.0")
+        ahora = time.time()
+        ComandoMaquina.objects.bulk_create(
+            [
+                ComandoMaquina(maquina=maquina, accion="iniciar", ejecutado=True,
+                               timestamp_creacion=ahora - historial + i, timestamp_ejecucion=ahora)
+                for i in range(historial)
+            ]
+            + [
+                ComandoMaquina(maquina=maquina, accion="iniciar", timestamp_creacion=ahora + i)
+                for i in range(pendientes)
+            ],
+            batch_size=1000,
+        )
+
+        tiempos = []
+        consultas = 0
+        for _ in range(min(reclamos, pendientes)):
+            with CaptureQueriesContext(connection) as q:
+                inicio = time.perf_counter()
+                token, _comandos = cola.reclamar(maquina)
+                cola.confirmar(token, maquina)
+                tiempos.append((time.perf_counter() - inicio) * 1000)
+            consultas += len(q)
+
+        tiempos.sort()
+        self.stdout.write(
+            f"historial={historial:>6} pendientes={pendientes:>5} "
+            f"p50={statistics.median(tiempos):.3f}ms "
+            f"p95={tiempos[int(len(tiempos) * 0.95) - 1]:.3f}ms "
+            f"consultas/entrega={consultas / len(tiempos):.1f}"
+        )
+
+
+class _Revertir(Exception):
+    pass
@@ -0,0 +1,57 @@
+import json
+import random
+import time
+import zlib
+
+from django.core.management.base import BaseCommand
+
+from usuarios import protocolo
+from usuarios.telemetria import leer_muestra
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara JSON contra el formato binario de protocolo.py: bytes por muestra "
+        "(con y sin gzip) y tiempo de decodificación por muestra."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--muestras", type=int, default=50, help="Muestras por lote")
+        parser.add_argument("--repeticiones", type=int, default=2000, help="Lotes decodificados por formato")
+
+    def handle(self, *args, **op):
+        n = op["muestras"]
+        inicio = time.time()
+        muestras = [
+            {
+                "nombre": "rehabilitatec-esp32-01",
+                "activo": True,
+                "grados_actuales": random.randint(0, 120),
+                "repeticiones": i // 10,
+                "ts": round(inicio + i * 0.05, 3),
+            }
+            for i in range(n)
+        ]
+        cuerpos = {
+            "json": json.dumps({"muestras": muestras}).encode(),
+            "binario": protocolo.codificar(17, muestras),
+        }
+
+        def decodificar_json(cuerpo):
+            data = json.loads(cuerpo)
+            return [leer_muestra(m) for m in data["muestras"]]
+
+        decodificadores = {"json": decodificar_json, "binario": protocolo.decodificar}
+
+        self.stdout.write(f"{'formato':<10}{'bytes/muestra':>15}{'gzip/muestra':>14}{'µs/muestra':>12}")
+        for formato, cuerpo in cuerpos.items():
+            decodificar = decodificadores[formato]
+            t0 = time.perf_counter()
+            for _ in range(op["repeticiones"]):
+                decodificar(cuerpo)
+            segundos = time.perf_counter() - t0
+            comprimido = zlib.compress(cuerpo, 6)
+            self.stdout.write(
+                f"{formato:<10}{len(cuerpo) / n:>15.1f}{len(comprimido) / n:>14.1f}"
+                f"{segundos / (op['repeticiones'] * n) * 1e6:>12.2f}"
+            )
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from usuarios import compactacion
+
+
+class Command(BaseCommand):
+    help = "Agrega la telemetría nueva por segundo, minuto y sesión y purga lo que salió de la retención."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lote", type=int, default=20000, help="Muestras por transacción")
+        parser.add_argument("--max-lotes", type=int, default=None, help="Corta tras N lotes (por defecto hasta el final)")
+        parser.add_argument("--sin-purgar", action="store_true", help="Solo agrega, no borra nada")
+
+    def handle(self, *args, **opciones):
+        muestras = compactacion.compactar(opciones["lote"], opciones["max_lotes"])
+        self.stdout.write(self.style.SUCCESS(f"{muestras} muestras agregadas"))
+        if not opciones["sin_purgar"]:
+            borradas = compactacion.purgar()
+            detalle = ", ".join(f"{nivel}: {n}" for nivel, n in borradas.items()) or "nada"
+            self.stdout.write(f"Filas borradas por retención ({detalle})")
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from usuarios import exportacion
+
+
+class Command(BaseCommand):
+    help = "Exporta pacientes o sesiones en CSV/NDJSON con memoria constante."
+
+    def add_arguments(self, parser):
+        parser.add_argument("tipo", choices=sorted(exportacion.CONSULTAS))
+        parser.add_argument("--formato", choices=sorted(exportacion.FORMATOS), default="csv")
+        parser.add_argument("--desde", help="Fecha u hora ISO (inclusive)")
+        parser.add_argument("--hasta", help="Fecha u hora ISO (una fecha sola incluye el día entero)")
+        parser.add_argument("--paciente", type=int)
+        parser.add_argument("--maquina", help="Número de la máquina")
+        parser.add_argument("--salida", help="Archivo de salida (por defecto stdout)")
+        parser.add_argument("--chunk", type=int, default=exportacion.CHUNK_FILAS, help="Filas por lectura de la BD")
+
+    def handle(self, *args, **opciones):
+        try:
+            filtros = {
+                "desde": exportacion.leer_fecha(opciones["desde"]),
+                "hasta": exportacion.leer_fecha(opciones["hasta"], fin=True),
+                "paciente": opciones["paciente"],
+                "maquina": opciones["maquina"],
+            }
+        except ValueError as error:
+            raise CommandError(error)
+        bloques = exportacion.exportar(opciones["tipo"], opciones["formato"], opciones["chunk"], **filtros)
+        if opciones["salida"]:
+            with open(opciones["salida"], "w", encoding="utf-8", newline="") as archivo:
+                archivo.writelines(bloques)
+            self.stderr.write(self.style.SUCCESS(f"Exportación escrita en {opciones['salida']}"))
+        else:
+            for bloque in bloques:
+                self.stdout.write(bloque, ending="")
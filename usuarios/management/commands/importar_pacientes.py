@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from usuarios import pacientes
+
+
+class Command(BaseCommand):
+    help = "Importa pacientes desde un CSV con cabecera o un JSON, por bloques."
+
+    def add_arguments(self, parser):
+        parser.add_argument("archivo")
+        parser.add_argument("--formato", choices=["csv", "json"], help="Por defecto según la extensión")
+        parser.add_argument("--chunk", type=int, default=pacientes.CHUNK_IMPORTACION, help="Pacientes por transacción")
+        parser.add_argument("--simular", action="store_true", help="Solo valida, no crea nada")
+
+    def handle(self, *args, **opciones):
+        formato = opciones["formato"] or ("csv" if opciones["archivo"].lower().endswith(".csv") else "json")
+        try:
+            with open(opciones["archivo"], "rb") as archivo:
+                filas = pacientes.leer_archivo(archivo.read(), formato)
+        except (OSError, ValueError, UnicodeDecodeError) as error:
+            raise CommandError(f"No se pudo leer {opciones['archivo']}: {error}")
+
+        resumen = pacientes.importar(filas, opciones["chunk"], opciones["simular"])
+        for error in resumen["errores"]:
+            self.stderr.write(f"Fila {error['fila']}: {json.dumps(error['errores'], ensure_ascii=False)}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{resumen['creados']} pacientes creados de {resumen['filas']} filas ({len(resumen['errores'])} con errores)"
+        ))
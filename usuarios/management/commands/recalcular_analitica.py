@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from usuarios import analitica
+
+
+class Command(BaseCommand):
+    help = "Reconstruye los agregados de analítica de pacientes desde SesionTerapia."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--paciente", type=int, nargs="*", help="IDs de pacientes (por defecto todos)")
+
+    def handle(self, *args, **opciones):
+        pacientes = analitica.recalcular(opciones["paciente"] or None)
+        self.stdout.write(self.style.SUCCESS(f"Agregados recalculados para {pacientes} pacientes"))
@@ -0,0 +1,202 @@
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+
+PREFIJO = "sim-esp-"
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    return valores[min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))]
+
+
+class Resultados:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = defaultdict(list)
+        self.errores = defaultdict(int)
+        self.consultas = defaultdict(list)
+
+    def registrar(self, ruta, segundos, ok, consultas=None):
+        with self._lock:
+            self.latencias[ruta].append(segundos * 1000)
+            if not ok:
+                self.errores[ruta] += 1
+            if consultas is not None:
+                self.consultas[ruta].append(consultas)
+
+
+class ClienteHTTP:
+    """Peticiones reales contra un servidor en marcha."""
+
+    def __init__(self, url, token):
+        self.url = url.rstrip("/")
+        self.sesion = requests.Session()
+        self.sesion.headers["Authorization"] = f"Token {token}"
+
+    def get(self, ruta, params):
+        r = self.sesion.get(self.url + ruta, params=params, timeout=30)
+        return r.status_code, r.headers.get("X-Consultas-BD")
+
+    def post(self, ruta, datos):
+        r = self.sesion.post(self.url + ruta, json=datos, timeout=30)
+        return r.status_code, r.headers.get("X-Consultas-BD")
+
+    def cerrar(self):
+        self.sesion.close()
+
+
+class ClienteEnProceso:
+    """Peticiones con el Client de Django en este proceso, contando consultas a la BD."""
+
+    def __init__(self, token):
+        self.cliente = Client(HTTP_AUTHORIZATION=f"Token {token}")
+
+    def _medir(self, llamada):
+        contador = [0]
+
+        def contar(execute, sql, params, many, context):
+            contador[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(contar):
+            respuesta = llamada()
+        return respuesta.status_code, contador[0]
+
+    def get(self, ruta, params):
+        return self._medir(lambda: self.cliente.get(ruta, params))
+
+    def post(self, ruta, datos):
+        return self._medir(
+            lambda: self.cliente.post(ruta, json.dumps(datos), content_type="application/json")
+        )
+
+    def cerrar(self):
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Simula N ESP32 (telemetría + sondeo de comandos) y M dashboards (estado) contra "
+        "los endpoints y reporta p50/p95/p99, peticiones por segundo y consultas por petición."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://localhost:8000",
+                            help="Servidor a probar (se ignora con --en-proceso)")
+        parser.add_argument("--en-proceso", action="store_true",
+                            help="Usa el Client de Django en este proceso y cuenta consultas a la BD")
+        parser.add_argument("--dispositivos", type=int, default=20)
+        parser.add_argument("--dashboards", type=int, default=5)
+        parser.add_argument("--segundos", type=float, default=30)
+        parser.add_argument("--intervalo-telemetria", type=float, default=0.5)
+        parser.add_argument("--intervalo-comandos", type=float, default=1.0)
+        parser.add_argument("--intervalo-dashboard", type=float, default=0.5)
+        parser.add_argument("--espera", type=float, default=0,
+                            help="Segundos de long-poll en /controlar_sesion/ (0 = sondeo normal)")
+        parser.add_argument("--semilla", type=int, default=1, help="Semilla para que la carga sea reproducible")
+        parser.add_argument("--token", default=None)
+
+    def handle(self, *args, **op):
+        random.seed(op["semilla"])
+        token = op["token"] or getattr(settings, "ESP32_API_TOKEN", "")
+        resultados = Resultados()
+        fin = time.monotonic() + op["segundos"]
+
+        def nuevo_cliente():
+            return ClienteEnProceso(token) if op["en_proceso"] else ClienteHTTP(op["url"], token)
+
+        def peticion(cliente, ruta, metodo, datos):
+            inicio = time.perf_counter()
+            try:
+                if metodo == "GET":
+                    status, consultas = cliente.get(ruta, datos)
+                else:
+                    status, consultas = cliente.post(ruta, datos)
+                ok = status < 400
+            except Exception:
+                ok, consultas = False, None
+            resultados.registrar(ruta, time.perf_counter() - inicio, ok,
+                                 int(consultas) if consultas is not None else None)
+
+        def bucle(tareas):
+            """tareas: [(intervalo, ruta, metodo, generador_de_datos)] con desfase aleatorio."""
+            cliente = nuevo_cliente()
+            proximas = [time.monotonic() + random.uniform(0, t[0]) for t in tareas]
+            try:
+                while True:
+                    i = min(range(len(tareas)), key=proximas.__getitem__)
+                    if proximas[i] >= fin:
+                        break
+                    time.sleep(max(0, proximas[i] - time.monotonic()))
+                    intervalo, ruta, metodo, datos = tareas[i]
+                    peticion(cliente, ruta, metodo, datos())
+                    proximas[i] += intervalo
+            finally:
+                cliente.cerrar()
+
+        def dispositivo(n):
+            nombre = f"{PREFIJO}{n}"
+            estado = {"grados": 0, "reps": 0}
+
+            def muestra():
+                estado["grados"] = (estado["grados"] + 7) % 120
+                estado["reps"] += estado["grados"] < 7
+                return {"nombre": nombre, "activo": True,
+                        "grados_actuales": estado["grados"], "repeticiones": estado["reps"]}
+
+            bucle([
+                (op["intervalo_telemetria"], "/recibir_datos_esp/", "POST", muestra),
+                (op["intervalo_comandos"], "/controlar_sesion/", "GET",
+                 lambda: {"numero": nombre, "espera": op["espera"]}),
+                (op["intervalo_comandos"], "/comando_esp/", "GET", lambda: {"maquina": nombre}),
+            ])
+
+        def dashboard(n):
+            nombre = f"{PREFIJO}{n % max(op['dispositivos'], 1)}"
+            bucle([(op["intervalo_dashboard"], "/estado_arduino/", "GET", lambda: {"numero": nombre})])
+
+        hilos = [threading.Thread(target=dispositivo, args=(n,)) for n in range(op["dispositivos"])]
+        hilos += [threading.Thread(target=dashboard, args=(n,)) for n in range(op["dashboards"])]
+        inicio = time.monotonic()
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        duracion = time.monotonic() - inicio
+
+        if op["en_proceso"]:
+            from usuarios.models import Maquinas
+            from usuarios.telemetria import buffer_telemetria
+            buffer_telemetria.vaciar()
+            Maquinas.objects.filter(numero__startswith=PREFIJO).delete()
+
+        self._reporte(resultados, duracion)
+
+    def _reporte(self, resultados, duracion):
+        self.stdout.write(
+            f"{'ruta':<22}{'peticiones':>11}{'errores':>9}{'req/s':>9}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'consultas':>11}"
+        )
+        total = 0
+        for ruta in sorted(resultados.latencias):
+            latencias = sorted(resultados.latencias[ruta])
+            consultas = resultados.consultas.get(ruta)
+            total += len(latencias)
+            self.stdout.write(
+                f"{ruta:<22}{len(latencias):>11}{resultados.errores[ruta]:>9}"
+                f"{len(latencias) / duracion:>9.1f}"
+                f"{percentil(latencias, 50):>9.2f}{percentil(latencias, 95):>9.2f}"
+                f"{percentil(latencias, 99):>9.2f}"
+                f"{(sum(consultas) / len(consultas)) if consultas else float('nan'):>11.1f}"
+            )
+        self.stdout.write(f"total: {total} peticiones en {duracion:.1f}s ({total / duracion:.1f} req/s)")
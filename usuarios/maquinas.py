@@ -0,0 +1,47 @@
+"""Vista general de máquinas: estado de la BD mezclado con el estado en vivo."""
+import time
+
+from .conectividad import monitor_conectividad
+from .estado import almacen_estado, conectado_por_tiempo
+from .models import Maquinas
+
+
+def resumen_maquinas(conectado=None, activo=None):
+    """Lista de máquinas con su estado, en una sola consulta a la BD.
+
+    El estado en vivo (almacén) tiene prioridad sobre la fila de EstadoMaquina;
+    ``conectado``/``activo`` filtran sobre el resultado ya mezclado.
+    """
+    filas = Maquinas.objects.order_by("id").values(
+        "id", "numero", "ip",
+        "estadomaquina__activo",
+        "estadomaquina__grados_actuales",
+        "estadomaquina__repeticiones",
+        "estadomaquina__ultimo_timestamp",
+    )
+    en_vivo = almacen_estado.todos()
+    en_linea = monitor_conectividad.en_linea()
+    ahora = time.time()
+
+    resultado = []
+    for fila in filas:
+        vivo = en_vivo.get(fila["numero"], {})
+        if vivo:
+            ultimo = vivo.get("ultimo_timestamp", 0)
+        else:
+            ultimo = fila["estadomaquina__ultimo_timestamp"] or 0
+        maquina = {
+            "id": fila["id"],
+            "numero": fila["numero"],
+            "ip": fila["ip"],
+            "conectado": fila["numero"] in en_linea or conectado_por_tiempo({"ultimo_timestamp": ultimo}, ahora),
+            "activo": vivo.get("activo", fila["estadomaquina__activo"] or False),
+            "grados_actuales": vivo.get("grados_actuales", fila["estadomaquina__grados_actuales"] or 0),
+            "repeticiones": vivo.get("repeticiones", fila["estadomaquina__repeticiones"] or 0),
+        }
+        if conectado is not None and maquina["conectado"] != conectado:
+            continue
+        if activo is not None and maquina["activo"] != activo:
+            continue
+        resultado.append(maquina)
+    return resultado
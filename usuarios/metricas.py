@@ -0,0 +1,298 @@
+"""Métricas de las rutas calientes en formato de texto de Prometheus.
+
+``MetricasMiddleware`` mide por ruta la latencia (histograma), las consultas a
+la BD y su tiempo, los bytes de entrada/salida y las peticiones por
+dispositivo. Las consultas se cuentan con un execute_wrapper instalado en cada
+conexión que lee un ContextVar, así también se cuentan las que hacen las vistas
+async dentro de sync_to_async.
+
+Con varios workers, ``METRICAS_DIR`` apunta a un directorio compartido donde
+cada proceso vuelca su snapshot; /metrics suma los de todos los procesos.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from .tareas import TareaPeriodica
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BUCKETS_CONSULTAS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+_medicion = contextvars.ContextVar("metricas_medicion", default=None)
+
+logger = logging.getLogger("usuarios")
+
+
+def _contar_consulta(execute, sql, params, many, context):
+    medicion = _medicion.get()
+    if medicion is None:
+        return execute(sql, params, many, context)
+    inicio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        medicion[0] += 1
+        medicion[1] += time.perf_counter() - inicio
+
+
+def _instalar_contador(sender, connection, **kwargs):
+    if _contar_consulta not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_contar_consulta)
+
+
+connection_created.connect(_instalar_contador)
+
+
+def _histograma(buckets):
+    return {"buckets": [0] * len(buckets), "suma": 0.0, "cuenta": 0}
+
+
+def _observar(histograma, buckets, valor):
+    for i, limite in enumerate(buckets):
+        if valor <= limite:
+            histograma["buckets"][i] += 1
+            break
+    histograma["suma"] += valor
+    histograma["cuenta"] += 1
+
+
+class Registro:
+    """Contadores del proceso; ``snapshot()`` los deja listos para JSON."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reiniciar()
+
+    def reiniciar(self):
+        self.peticiones = defaultdict(int)          # (ruta, metodo, codigo)
+        self.latencia = {}                          # ruta -> histograma
+        self.consultas = {}                         # ruta -> histograma
+        self.tiempo_bd = defaultdict(float)         # ruta
+        self.bytes_entrada = defaultdict(int)       # ruta
+        self.bytes_salida = defaultdict(int)        # ruta
+        self.dispositivos = defaultdict(int)        # nombre
+        self.errores = defaultdict(int)             # origen
+
+    def observar(self, ruta, metodo, codigo, segundos, consultas, tiempo_bd,
+                 entrada, salida, dispositivo=None):
+        with self._lock:
+            self.peticiones[(ruta, metodo, str(codigo))] += 1
+            _observar(self.latencia.setdefault(ruta, _histograma(BUCKETS_LATENCIA)),
+                      BUCKETS_LATENCIA, segundos)
+            _observar(self.consultas.setdefault(ruta, _histograma(BUCKETS_CONSULTAS)),
+                      BUCKETS_CONSULTAS, consultas)
+            self.tiempo_bd[ruta] += tiempo_bd
+            self.bytes_entrada[ruta] += entrada
+            self.bytes_salida[ruta] += salida
+            if dispositivo:
+                self.dispositivos[dispositivo] += 1
+
+    def error(self, origen):
+        with self._lock:
+            self.errores[origen] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "peticiones": [[*k, v] for k, v in self.peticiones.items()],
+                "latencia": json.loads(json.dumps(self.latencia)),
+                "consultas": json.loads(json.dumps(self.consultas)),
+                "tiempo_bd": dict(self.tiempo_bd),
+                "bytes_entrada": dict(self.bytes_entrada),
+                "bytes_salida": dict(self.bytes_salida),
+                "dispositivos": dict(self.dispositivos),
+                "errores": dict(self.errores),
+            }
+
+
+registro = Registro()
+
+
+def reportar_error(origen, mensaje, *args):
+    """Cuenta el error en /metrics y lo deja en el log con su traceback."""
+    registro.error(origen)
+    logger.exception(mensaje, *args)
+
+
+def _directorio():
+    return getattr(settings, "METRICAS_DIR", None)
+
+
+def volcar():
+    """Escribe el snapshot del proceso en METRICAS_DIR (escritura atómica)."""
+    directorio = _directorio()
+    if not directorio:
+        return
+    os.makedirs(directorio, exist_ok=True)
+    destino = os.path.join(directorio, f"{os.getpid()}.json")
+    temporal = destino + ".tmp"
+    with open(temporal, "w") as f:
+        json.dump(registro.snapshot(), f)
+    os.replace(temporal, destino)
+
+
+_tarea_volcar = TareaPeriodica(volcar, 5, "metricas-volcar")
+
+
+def _sumar(total, parcial):
+    for clave, valor in parcial.items():
+        if isinstance(valor, dict) and "buckets" in valor:
+            destino = total.setdefault(clave, {"buckets": [0] * len(valor["buckets"]), "suma": 0.0, "cuenta": 0})
+            destino["buckets"] = [a + b for a, b in zip(destino["buckets"], valor["buckets"])]
+            destino["suma"] += valor["suma"]
+            destino["cuenta"] += valor["cuenta"]
+        else:
+            total[clave] = total.get(clave, 0) + valor
+
+
+def _expira():
+    # Un worker vivo reescribe su snapshot cada 5 s; uno más viejo es de un proceso muerto
+    return getattr(settings, "METRICAS_EXPIRA", 60)
+
+
+def agregado():
+    """Snapshot sumado de todos los procesos (o solo este si no hay METRICAS_DIR).
+
+    Los snapshots sin actualizar en ``METRICAS_EXPIRA`` segundos se borran.
+    """
+    snapshots = [registro.snapshot()]
+    directorio = _directorio()
+    if directorio and os.path.isdir(directorio):
+        propio = f"{os.getpid()}.json"
+        limite = time.time() - _expira()
+        for archivo in os.listdir(directorio):
+            if archivo.endswith(".json") and archivo != propio:
+                ruta = os.path.join(directorio, archivo)
+                try:
+                    if os.path.getmtime(ruta) < limite:
+                        os.remove(ruta)
+                        continue
+                    with open(ruta) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+    total = {"peticiones": {}}
+    for snap in snapshots:
+        for ruta, metodo, codigo, n in snap["peticiones"]:
+            clave = (ruta, metodo, codigo)
+            total["peticiones"][clave] = total["peticiones"].get(clave, 0) + n
+        for seccion in ("latencia", "consultas", "tiempo_bd", "bytes_entrada",
+                        "bytes_salida", "dispositivos", "errores"):
+            _sumar(total.setdefault(seccion, {}), snap[seccion])
+    return total
+
+
+def _etiqueta(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _lineas_histograma(nombre, ayuda, datos, buckets):
+    lineas = [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} histogram"]
+    for ruta, h in sorted(datos.items()):
+        acumulado = 0
+        for limite, n in zip(buckets, h["buckets"]):
+            acumulado += n
+            lineas.append(f'{nombre}_bucket{{ruta="{_etiqueta(ruta)}",le="{limite}"}} {acumulado}')
+        lineas.append(f'{nombre}_bucket{{ruta="{_etiqueta(ruta)}",le="+Inf"}} {h["cuenta"]}')
+        lineas.append(f'{nombre}_sum{{ruta="{_etiqueta(ruta)}"}} {h["suma"]}')
+        lineas.append(f'{nombre}_count{{ruta="{_etiqueta(ruta)}"}} {h["cuenta"]}')
+    return lineas
+
+
+def _lineas_contador(nombre, ayuda, datos, etiqueta):
+    lineas = [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} counter"]
+    for clave, valor in sorted(datos.items()):
+        lineas.append(f'{nombre}{{{etiqueta}="{_etiqueta(clave)}"}} {valor}')
+    return lineas
+
+
+def texto_prometheus():
+    datos = agregado()
+    lineas = [
+        "# HELP rehabilitatec_peticiones_total Peticiones atendidas por ruta, método y código.",
+        "# TYPE rehabilitatec_peticiones_total counter",
+    ]
+    for (ruta, metodo, codigo), n in sorted(datos["peticiones"].items()):
+        lineas.append(
+            f'rehabilitatec_peticiones_total{{ruta="{_etiqueta(ruta)}",metodo="{metodo}",codigo="{codigo}"}} {n}'
+        )
+    lineas += _lineas_histograma("rehabilitatec_latencia_segundos",
+                                 "Latencia de la vista hasta tener la respuesta.",
+                                 datos["latencia"], BUCKETS_LATENCIA)
+    lineas += _lineas_histograma("rehabilitatec_consultas_bd",
+                                 "Consultas a la BD por petición.",
+                                 datos["consultas"], BUCKETS_CONSULTAS)
+    lineas += _lineas_contador("rehabilitatec_bd_segundos_total",
+                               "Tiempo acumulado dentro de la BD.", datos["tiempo_bd"], "ruta")
+    lineas += _lineas_contador("rehabilitatec_bytes_entrada_total",
+                               "Bytes de cuerpo recibidos.", datos["bytes_entrada"], "ruta")
+    lineas += _lineas_contador("rehabilitatec_bytes_salida_total",
+                               "Bytes de cuerpo enviados (sin streams).", datos["bytes_salida"], "ruta")
+    lineas += _lineas_contador("rehabilitatec_peticiones_dispositivo_total",
+                               "Peticiones por dispositivo ESP32.", datos["dispositivos"], "dispositivo")
+    lineas += _lineas_contador("rehabilitatec_errores_total",
+                               "Errores capturados por las vistas.", datos["errores"], "origen")
+    return "\n".join(lineas) + "\n"
+
+
+class MetricasMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.cabecera = getattr(settings, "METRICAS_CABECERA", settings.DEBUG)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # Conexiones abiertas antes de cargar el middleware (checks, runserver)
+        _instalar_contador(None, connection)
+        medicion, token, inicio = self._empezar()
+        try:
+            respuesta = self.get_response(request)
+        finally:
+            _medicion.reset(token)
+        return self._terminar(request, respuesta, medicion, inicio)
+
+    async def __acall__(self, request):
+        medicion, token, inicio = self._empezar()
+        try:
+            respuesta = await self.get_response(request)
+        finally:
+            _medicion.reset(token)
+        return self._terminar(request, respuesta, medicion, inicio)
+
+    def _empezar(self):
+        medicion = [0, 0.0]
+        return medicion, _medicion.set(medicion), time.perf_counter()
+
+    def _terminar(self, request, respuesta, medicion, inicio):
+        segundos = time.perf_counter() - inicio
+        match = getattr(request, "resolver_match", None)
+        ruta = "/" + match.route if match and match.route else "sin_ruta"
+        # Solo el que fijó una vista de dispositivo tras validar el token: un
+        # ?numero= arbitrario crearía una serie nueva por cada valor
+        dispositivo = getattr(request, "dispositivo", None)
+        salida = 0 if respuesta.streaming else len(respuesta.content)
+        registro.observar(
+            ruta, request.method, respuesta.status_code, segundos, medicion[0], medicion[1],
+            int(request.META.get("CONTENT_LENGTH") or 0), salida, dispositivo,
+        )
+        if self.cabecera:
+            respuesta["X-Consultas-BD"] = str(medicion[0])
+        if _directorio():
+            _tarea_volcar.iniciar()
+        return respuesta
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0011_remove_estadomaquina_fecha_actualizacion_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelemetriaMaquina',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ts', models.FloatField()),
+                ('grados', models.SmallIntegerField()),
+                ('repeticiones', models.PositiveIntegerField()),
+                ('activo', models.BooleanField(default=False)),
+                ('maquina', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='telemetria', to='usuarios.maquinas')),
+                ('sesion', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='telemetria', to='usuarios.sesionterapia')),
+            ],
+            options={
+                'db_table': 'telemetria_maquinas',
+                'indexes': [models.Index(fields=['maquina', 'ts'], name='telemetria_maquina_ts_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0012_telemetriamaquina'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comandomaquina',
+            name='descartado',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='comandomaquina',
+            name='expira',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='comandomaquina',
+            name='intentos',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comandomaquina',
+            name='timestamp_reclamo',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='comandomaquina',
+            name='token_reclamo',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='comandomaquina',
+            index=models.Index(condition=models.Q(('ejecutado', False)), fields=['maquina', 'timestamp_creacion'], name='comando_pendiente_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0013_cola_comandos'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sesionterapia',
+            name='grados_alcanzados',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ResumenPaciente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sesiones', models.PositiveIntegerField(default=0)),
+                ('sesiones_completadas', models.PositiveIntegerField(default=0)),
+                ('repeticiones_objetivo', models.PositiveIntegerField(default=0)),
+                ('repeticiones_completadas', models.PositiveIntegerField(default=0)),
+                ('suma_grados', models.FloatField(default=0)),
+                ('grados_max', models.IntegerField(default=0)),
+                ('primera_sesion', models.DateTimeField(blank=True, null=True)),
+                ('ultima_sesion', models.DateTimeField(blank=True, null=True)),
+                ('usuario', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='resumen', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'resumen_pacientes',
+            },
+        ),
+        migrations.CreateModel(
+            name='ResumenSemanalPaciente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('semana', models.DateField()),
+                ('sesiones', models.PositiveIntegerField(default=0)),
+                ('sesiones_completadas', models.PositiveIntegerField(default=0)),
+                ('repeticiones_objetivo', models.PositiveIntegerField(default=0)),
+                ('repeticiones_completadas', models.PositiveIntegerField(default=0)),
+                ('suma_grados', models.FloatField(default=0)),
+                ('grados_max', models.IntegerField(default=0)),
+                ('usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resumenes_semanales', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'resumen_semanal_pacientes',
+                'constraints': [models.UniqueConstraint(fields=('usuario', 'semana'), name='resumen_semanal_unico')],
+            },
+        ),
+    ]
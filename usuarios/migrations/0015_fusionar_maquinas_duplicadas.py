@@ -0,0 +1,43 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def fusionar_duplicadas(apps, schema_editor):
+    """Deja una máquina por número (la de id más bajo) y le pasa las filas de las demás."""
+    Maquinas = apps.get_model('usuarios', 'Maquinas')
+    repetidos = (
+        Maquinas.objects.values('numero').annotate(n=Count('id'), primera=Min('id')).filter(n__gt=1)
+    )
+    for grupo in repetidos:
+        conservar = grupo['primera']
+        duplicadas = list(
+            Maquinas.objects.filter(numero=grupo['numero']).exclude(pk=conservar).values_list('pk', flat=True)
+        )
+        for relacion in Maquinas._meta.related_objects:
+            modelo, campo = relacion.related_model, relacion.field.name
+            filas = modelo.objects.filter(**{f'{campo}__in': duplicadas})
+            if relacion.one_to_one:
+                # EstadoMaquina: se queda el de la máquina conservada o, si no
+                # tiene, el más reciente de las duplicadas
+                if not modelo.objects.filter(**{campo: conservar}).exists():
+                    ultimo = filas.order_by('-ultimo_timestamp').first()
+                    if ultimo is not None:
+                        filas.filter(pk=ultimo.pk).update(**{campo: conservar})
+                filas.delete()
+            else:
+                filas.update(**{campo: conservar})
+        Maquinas.objects.filter(pk__in=duplicadas).delete()
+
+
+class Migration(migrations.Migration):
+    # Va sola: en PostgreSQL los UPDATE/DELETE dejan triggers de FK diferidos
+    # pendientes y el ALTER TABLE de 0016_maquinas_identidad_unica fallaría en
+    # la misma transacción ("pending trigger events")
+
+    dependencies = [
+        ('usuarios', '0014_analitica_pacientes'),
+    ]
+
+    operations = [
+        migrations.RunPython(fusionar_duplicadas, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0015_fusionar_maquinas_duplicadas'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='maquinas',
+            name='numero',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='sesionterapia',
+            name='usuario',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sesiones_terapia', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='estadomaquina',
+            index=models.Index(fields=['ultimo_timestamp'], name='estado_ultimo_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sesionterapia',
+            index=models.Index(fields=['usuario', 'fecha_inicio'], name='sesion_usuario_fecha_idx'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0016_maquinas_identidad_unica'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CursorCompactacion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nombre', models.CharField(max_length=50, unique=True)),
+                ('ultimo_id', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'cursores_compactacion',
+            },
+        ),
+        migrations.CreateModel(
+            name='TelemetriaSesion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('muestras', models.PositiveIntegerField(default=0)),
+                ('grados_min', models.SmallIntegerField()),
+                ('grados_max', models.SmallIntegerField()),
+                ('suma_grados', models.FloatField(default=0)),
+                ('repeticiones_min', models.PositiveIntegerField()),
+                ('repeticiones_max', models.PositiveIntegerField()),
+                ('segundos_activos', models.PositiveIntegerField(default=0)),
+                ('ts_inicio', models.FloatField()),
+                ('ts_fin', models.FloatField()),
+                ('sesion', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='telemetria_resumen', to='usuarios.sesionterapia')),
+            ],
+            options={
+                'db_table': 'telemetria_sesiones',
+            },
+        ),
+        migrations.CreateModel(
+            name='TelemetriaMinuto',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('muestras', models.PositiveIntegerField(default=0)),
+                ('grados_min', models.SmallIntegerField()),
+                ('grados_max', models.SmallIntegerField()),
+                ('suma_grados', models.FloatField(default=0)),
+                ('repeticiones_min', models.PositiveIntegerField()),
+                ('repeticiones_max', models.PositiveIntegerField()),
+                ('segundos_activos', models.PositiveIntegerField(default=0)),
+                ('inicio', models.IntegerField()),
+                ('maquina', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='usuarios.maquinas')),
+            ],
+            options={
+                'db_table': 'telemetria_minutos',
+                'constraints': [models.UniqueConstraint(fields=('maquina', 'inicio'), name='telemetria_minuto_unico')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TelemetriaSegundo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('muestras', models.PositiveIntegerField(default=0)),
+                ('grados_min', models.SmallIntegerField()),
+                ('grados_max', models.SmallIntegerField()),
+                ('suma_grados', models.FloatField(default=0)),
+                ('repeticiones_min', models.PositiveIntegerField()),
+                ('repeticiones_max', models.PositiveIntegerField()),
+                ('segundos_activos', models.PositiveIntegerField(default=0)),
+                ('inicio', models.IntegerField()),
+                ('maquina', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='usuarios.maquinas')),
+            ],
+            options={
+                'db_table': 'telemetria_segundos',
+                'constraints': [models.UniqueConstraint(fields=('maquina', 'inicio'), name='telemetria_segundo_unico')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0018_usuario_busqueda_indices'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContadorUsername',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base', models.CharField(max_length=150, unique=True)),
+                ('siguiente', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'contadores_username',
+            },
+        ),
+    ]
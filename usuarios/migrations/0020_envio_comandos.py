@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0019_contador_username'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnvioComandos',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('accion', models.CharField(max_length=20)),
+                ('grados', models.IntegerField(blank=True, null=True)),
+                ('repeticiones', models.IntegerField(blank=True, null=True)),
+                ('selector', models.CharField(max_length=20)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('timestamp_creacion', models.FloatField(default=0)),
+                ('creado_por', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'envios_comandos',
+            },
+        ),
+        migrations.AddField(
+            model_name='comandomaquina',
+            name='envio',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='comandos', to='usuarios.enviocomandos'),
+        ),
+    ]
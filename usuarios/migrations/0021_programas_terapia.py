@@ -0,0 +1,76 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0020_envio_comandos'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comandomaquina',
+            name='plan',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='comandomaquina',
+            name='accion',
+            field=models.CharField(choices=[('iniciar', 'Iniciar'), ('detener', 'Detener'), ('pausar', 'Pausar'), ('continuar', 'Continuar'), ('programa', 'Programa')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='ProgramaTerapia',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nombre', models.CharField(max_length=100)),
+                ('descripcion', models.CharField(blank=True, max_length=255)),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True)),
+                ('creado_por', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'programas_terapia',
+            },
+        ),
+        migrations.CreateModel(
+            name='EjecucionPrograma',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('estado', models.CharField(choices=[('enviada', 'Enviada'), ('en_curso', 'En curso'), ('completada', 'Completada'), ('cancelada', 'Cancelada')], default='enviada', max_length=20)),
+                ('paso_actual', models.PositiveSmallIntegerField(default=0)),
+                ('progreso', models.JSONField(default=list)),
+                ('timestamp_inicio', models.FloatField(blank=True, null=True)),
+                ('timestamp_fin', models.FloatField(blank=True, null=True)),
+                ('comando', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='ejecucion', to='usuarios.comandomaquina')),
+                ('maquina', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='usuarios.maquinas')),
+                ('sesion', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='usuarios.sesionterapia')),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ejecuciones_programa', to=settings.AUTH_USER_MODEL)),
+                ('programa', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ejecuciones', to='usuarios.programaterapia')),
+            ],
+            options={
+                'db_table': 'ejecuciones_programa',
+            },
+        ),
+        migrations.CreateModel(
+            name='PasoPrograma',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orden', models.PositiveSmallIntegerField()),
+                ('grados', models.IntegerField()),
+                ('repeticiones', models.PositiveIntegerField()),
+                ('series', models.PositiveSmallIntegerField(default=1)),
+                ('stop_grados', models.IntegerField(default=0)),
+                ('modo', models.CharField(default='normal', max_length=50)),
+                ('descanso', models.PositiveIntegerField(default=0)),
+                ('programa', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pasos', to='usuarios.programaterapia')),
+            ],
+            options={
+                'db_table': 'pasos_programa',
+                'ordering': ['programa', 'orden'],
+                'constraints': [models.UniqueConstraint(fields=('programa', 'orden'), name='paso_programa_orden_unico')],
+            },
+        ),
+    ]
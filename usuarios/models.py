@@ -1,6 +1,7 @@
 # models.py - Agregar estos modelos a los que ya tienes
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.functions import Lower
 
 class Usuario(AbstractUser):
     ROLES = [
@@ -17,12 +18,30 @@ class Usuario(AbstractUser):
     tamano_de_la_pantorrilla = models.FloatField(blank=True, null=True)
     rol = models.CharField(max_length=10, choices=ROLES)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Listado paginado por id de los pacientes (keyset, ver lista_pacientes)
+            models.Index(fields=['rol', 'id'], name='usuario_rol_id_idx'),
+            # Búsqueda por prefijo sin distinguir mayúsculas: rango sobre lower(...)
+            models.Index(Lower('nombre'), name='usuario_nombre_lower_idx'),
+            models.Index(Lower('username'), name='usuario_username_lower_idx'),
+        ]
+
     def __str__(self):
         return f"{self.nombre} ({self.rol})"
 
+class ContadorUsername(models.Model):
+    """Siguiente sufijo libre por base de username (ver pacientes.asignar_usernames)."""
+    base = models.CharField(max_length=150, unique=True)
+    siguiente = models.PositiveIntegerField(default=0)  # 0 -> "base", n -> "base_n"
+
+    class Meta:
+        db_table = 'contadores_username'
+
 class Maquinas(models.Model):
     
-    numero = models.CharField(max_length=50)
+    # Único: dos primeros contactos simultáneos no pueden duplicar la máquina
+    numero = models.CharField(max_length=50, unique=True)
     ip = models.GenericIPAddressField()
 
     class Meta:
@@ -39,12 +58,35 @@ class EstadoMaquina(models.Model):
     conectado = models.BooleanField(default=True)
     ultimo_timestamp = models.FloatField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Barrido de conectividad: máquinas sin contacto desde hace X segundos
+            models.Index(fields=['ultimo_timestamp'], name='estado_ultimo_ts_idx'),
+        ]
+
+class EnvioComandos(models.Model):
+    """Un mismo comando encolado a la vez en varias máquinas (ver cola.encolar_envio)."""
+    accion = models.CharField(max_length=20)
+    grados = models.IntegerField(null=True, blank=True)
+    repeticiones = models.IntegerField(null=True, blank=True)
+    selector = models.CharField(max_length=20)  # "maquinas", "todas" o "conectadas"
+    total = models.PositiveIntegerField(default=0)
+    creado_por = models.ForeignKey(Usuario, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    timestamp_creacion = models.FloatField(default=0)
+
+    class Meta:
+        db_table = 'envios_comandos'
+
+    def __str__(self):
+        return f"Envío {self.pk} - {self.accion} ({self.total} máquinas)"
+
 class ComandoMaquina(models.Model):
     TIPO_ACCIONES = [
         ('iniciar', 'Iniciar'),
         ('detener', 'Detener'),
         ('pausar', 'Pausar'),
         ('continuar', 'Continuar'),
+        ('programa', 'Programa'),
     ]
     
     maquina = models.ForeignKey(Maquinas, on_delete=models.CASCADE, related_name='comandos')
@@ -55,26 +97,214 @@ class ComandoMaquina(models.Model):
     timestamp_creacion = models.FloatField(default=0)
     timestamp_ejecucion = models.FloatField(null=True, blank=True)
     usuario = models.ForeignKey(Usuario, on_delete=models.SET_NULL, null=True, blank=True)
+    # Cola con reclamo atómico (ver cola.py)
+    token_reclamo = models.CharField(max_length=32, null=True, blank=True)
+    timestamp_reclamo = models.FloatField(null=True, blank=True)
+    intentos = models.PositiveSmallIntegerField(default=0)
+    expira = models.FloatField(null=True, blank=True)
+    descartado = models.BooleanField(default=False)
+    envio = models.ForeignKey(EnvioComandos, on_delete=models.SET_NULL, null=True, blank=True, related_name='comandos')
+    # Plan compilado de un ProgramaTerapia (accion "programa"), se entrega entero a la máquina
+    plan = models.JSONField(null=True, blank=True)
     
     class Meta:
         db_table = 'comandos_maquinas'
         ordering = ['timestamp_creacion']
+        indexes = [
+            # Índice parcial: solo contiene los pendientes, no crece con el historial
+            models.Index(
+                fields=['maquina', 'timestamp_creacion'],
+                condition=models.Q(ejecutado=False),
+                name='comando_pendiente_idx',
+            ),
+        ]
     
     def __str__(self):
         return f"{self.maquina.numero} - {self.accion}"
 
 class SesionTerapia(models.Model):
     maquina = models.ForeignKey(Maquinas, on_delete=models.CASCADE, related_name='sesiones')
-    usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE, related_name='sesiones_terapia')
+    # Sin índice propio: lo cubre el índice compuesto (usuario, fecha_inicio)
+    usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE, related_name='sesiones_terapia', db_index=False)
     fecha_inicio = models.DateTimeField(auto_now_add=True)
     fecha_fin = models.DateTimeField(null=True, blank=True)
     grados_objetivo = models.IntegerField()
     repeticiones_objetivo = models.IntegerField()
     repeticiones_completadas = models.IntegerField(default=0)
     completada = models.BooleanField(default=False)
+    grados_alcanzados = models.IntegerField(null=True, blank=True)
     
     class Meta:
         db_table = 'sesiones_terapia'
+        indexes = [
+            models.Index(fields=['usuario', 'fecha_inicio'], name='sesion_usuario_fecha_idx'),
+        ]
+
+    @property
+    def cerrada(self):
+        return self.completada or self.fecha_fin is not None
     
     def __str__(self):
-        return f"Sesión {self.maquina.numero} - {self.usuario.nombre}"
\ No newline at end of file
+        return f"Sesión {self.maquina.numero} - {self.usuario.nombre}"
+
+# PROGRAMAS DE TERAPIA (ver programas.py)
+class ProgramaTerapia(models.Model):
+    nombre = models.CharField(max_length=100)
+    descripcion = models.CharField(max_length=255, blank=True)
+    creado_por = models.ForeignKey(Usuario, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'programas_terapia'
+
+    def __str__(self):
+        return self.nombre
+
+class PasoPrograma(models.Model):
+    programa = models.ForeignKey(ProgramaTerapia, on_delete=models.CASCADE, related_name='pasos')
+    orden = models.PositiveSmallIntegerField()
+    grados = models.IntegerField()
+    repeticiones = models.PositiveIntegerField()
+    series = models.PositiveSmallIntegerField(default=1)
+    stop_grados = models.IntegerField(default=0)
+    modo = models.CharField(max_length=50, default="normal")
+    descanso = models.PositiveIntegerField(default=0)  # segundos después de cada serie
+
+    class Meta:
+        db_table = 'pasos_programa'
+        ordering = ['programa', 'orden']
+        constraints = [
+            models.UniqueConstraint(fields=['programa', 'orden'], name='paso_programa_orden_unico'),
+        ]
+
+class EjecucionPrograma(models.Model):
+    """Un programa enviado a una máquina y el avance que va informando la máquina."""
+    ESTADOS = [
+        ('enviada', 'Enviada'),
+        ('en_curso', 'En curso'),
+        ('completada', 'Completada'),
+        ('cancelada', 'Cancelada'),
+    ]
+
+    programa = models.ForeignKey(ProgramaTerapia, on_delete=models.SET_NULL, null=True, related_name='ejecuciones')
+    comando = models.OneToOneField(ComandoMaquina, on_delete=models.CASCADE, related_name='ejecucion')
+    maquina = models.ForeignKey(Maquinas, on_delete=models.CASCADE, related_name='+')
+    usuario = models.ForeignKey(Usuario, on_delete=models.SET_NULL, null=True, blank=True, related_name='ejecuciones_programa')
+    sesion = models.ForeignKey(SesionTerapia, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    estado = models.CharField(max_length=20, choices=ESTADOS, default='enviada')
+    paso_actual = models.PositiveSmallIntegerField(default=0)  # índice en plan["pasos"]
+    # Un elemento por paso del plan: {"repeticiones", "grados_max", "inicio", "fin"} o None si no empezó
+    progreso = models.JSONField(default=list)
+    timestamp_inicio = models.FloatField(null=True, blank=True)
+    timestamp_fin = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'ejecuciones_programa'
+
+class TelemetriaMaquina(models.Model):
+    """Histórico append-only de muestras de las ESP32 (una fila por muestra)."""
+    # Sin índice propio: lo cubre el índice compuesto (maquina, ts)
+    maquina = models.ForeignKey(Maquinas, on_delete=models.CASCADE, related_name='telemetria', db_index=False)
+    sesion = models.ForeignKey(SesionTerapia, on_delete=models.SET_NULL, null=True, blank=True, related_name='telemetria')
+    ts = models.FloatField()
+    grados = models.SmallIntegerField()
+    repeticiones = models.PositiveIntegerField()
+    activo = models.BooleanField(default=False)
+
+    class Meta:
+        db_table = 'telemetria_maquinas'
+        indexes = [
+            models.Index(fields=['maquina', 'ts'], name='telemetria_maquina_ts_idx'),
+        ]
+
+
+# AGREGADOS DE TELEMETRÍA (los genera compactacion.py a partir de TelemetriaMaquina)
+class AgregadoTelemetria(models.Model):
+    """Campos combinables: dos agregados del mismo intervalo se suman sin releer las muestras."""
+    muestras = models.PositiveIntegerField(default=0)
+    grados_min = models.SmallIntegerField()
+    grados_max = models.SmallIntegerField()
+    suma_grados = models.FloatField(default=0)
+    repeticiones_min = models.PositiveIntegerField()
+    repeticiones_max = models.PositiveIntegerField()
+    segundos_activos = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    @property
+    def grados_media(self):
+        return self.suma_grados / self.muestras if self.muestras else None
+
+
+class TelemetriaSegundo(AgregadoTelemetria):
+    maquina = models.ForeignKey(Maquinas, on_delete=models.CASCADE, related_name='+', db_index=False)
+    inicio = models.IntegerField()  # epoch en segundos
+
+    class Meta:
+        db_table = 'telemetria_segundos'
+        constraints = [
+            models.UniqueConstraint(fields=['maquina', 'inicio'], name='telemetria_segundo_unico'),
+        ]
+
+
+class TelemetriaMinuto(AgregadoTelemetria):
+    maquina = models.ForeignKey(Maquinas, on_delete=models.CASCADE, related_name='+', db_index=False)
+    inicio = models.IntegerField()  # epoch en segundos, múltiplo de 60
+
+    class Meta:
+        db_table = 'telemetria_minutos'
+        constraints = [
+            models.UniqueConstraint(fields=['maquina', 'inicio'], name='telemetria_minuto_unico'),
+        ]
+
+
+class TelemetriaSesion(AgregadoTelemetria):
+    sesion = models.OneToOneField(SesionTerapia, on_delete=models.CASCADE, related_name='telemetria_resumen')
+    ts_inicio = models.FloatField()
+    ts_fin = models.FloatField()
+
+    class Meta:
+        db_table = 'telemetria_sesiones'
+
+
+class CursorCompactacion(models.Model):
+    """Hasta qué id de TelemetriaMaquina ya está sumado en los agregados."""
+    nombre = models.CharField(max_length=50, unique=True)
+    ultimo_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'cursores_compactacion'
+
+
+# AGREGADOS DE ANALÍTICA (se actualizan al cerrar cada sesión, ver analitica.py)
+class ResumenPaciente(models.Model):
+    usuario = models.OneToOneField(Usuario, on_delete=models.CASCADE, related_name='resumen')
+    sesiones = models.PositiveIntegerField(default=0)
+    sesiones_completadas = models.PositiveIntegerField(default=0)
+    repeticiones_objetivo = models.PositiveIntegerField(default=0)
+    repeticiones_completadas = models.PositiveIntegerField(default=0)
+    suma_grados = models.FloatField(default=0)
+    grados_max = models.IntegerField(default=0)
+    primera_sesion = models.DateTimeField(null=True, blank=True)
+    ultima_sesion = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'resumen_pacientes'
+
+
+class ResumenSemanalPaciente(models.Model):
+    usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE, related_name='resumenes_semanales')
+    semana = models.DateField()  # lunes de la semana
+    sesiones = models.PositiveIntegerField(default=0)
+    sesiones_completadas = models.PositiveIntegerField(default=0)
+    repeticiones_objetivo = models.PositiveIntegerField(default=0)
+    repeticiones_completadas = models.PositiveIntegerField(default=0)
+    suma_grados = models.FloatField(default=0)
+    grados_max = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'resumen_semanal_pacientes'
+        constraints = [
+            models.UniqueConstraint(fields=['usuario', 'semana'], name='resumen_semanal_unico'),
+        ]
@@ -0,0 +1,134 @@
+"""Alta de pacientes: asignación de usernames y la importación masiva.
+
+Antes, cada alta leía todos los usernames con la misma base y buscaba el
+sufijo más alto con una regex (O(n) por alta y con carrera entre dos altas
+simultáneas). Ahora cada base tiene un ContadorUsername: reservar ``n``
+usernames es bloquear la fila del contador y sumarle ``n``. La primera vez que
+aparece una base el contador se siembra desde los usernames existentes.
+"""
+import csv
+import io
+import json
+import re
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Q
+
+from .forms import PacienteImportForm
+from .models import ContadorUsername, Usuario
+
+CHUNK_IMPORTACION = 500
+_NO_PERMITIDOS = re.compile(r"[^\w.@+-]")
+
+
+def base_username(nombre):
+    """"Ana María" -> "ana_maría" (solo caracteres válidos para un username)."""
+    base = _NO_PERMITIDOS.sub("", nombre.strip().lower().replace(" ", "_"))
+    return base[:140] or "paciente"
+
+
+def _username(base, numero):
+    return base if numero == 0 else f"{base}_{numero}"
+
+
+def _bases_posibles(username):
+    """(base, siguiente) para cada base de la que ``username`` podría ser alta: "ana_3" -> ("ana", 4)."""
+    yield username, 1
+    digitos = len(username) - len(username.rstrip("0123456789"))
+    for corte in range(len(username) - digitos, len(username)):
+        base = username[:corte]
+        numero = int(username[corte:]) + 1
+        yield base, numero
+        if base.endswith("_"):
+            yield base[:-1], numero
+
+
+def _sembrar(bases, grupo=200):
+    """Crea los contadores que falten a partir de los usernames ya usados (una consulta cada ``grupo`` bases)."""
+    existentes = set(ContadorUsername.objects.filter(base__in=bases).values_list("base", flat=True))
+    faltan = sorted(set(bases) - existentes)
+    siguiente = dict.fromkeys(faltan, 0)
+    for inicio in range(0, len(faltan), grupo):
+        consulta = Q()
+        for base in faltan[inicio:inicio + grupo]:
+            consulta |= Q(username__startswith=base)
+        for username in Usuario.objects.filter(consulta).values_list("username", flat=True):
+            for base, numero in _bases_posibles(username):
+                if base in siguiente:
+                    siguiente[base] = max(siguiente[base], numero)
+    ContadorUsername.objects.bulk_create(
+        [ContadorUsername(base=base, siguiente=n) for base, n in siguiente.items()], ignore_conflicts=True
+    )
+
+
+def asignar_usernames(nombres):
+    """Un username libre por nombre, en orden. Reserva en bloque con los contadores bloqueados."""
+    bases = [base_username(n) for n in nombres]
+    resultado = [None] * len(bases)
+    pendientes = list(range(len(bases)))
+    with transaction.atomic():
+        _sembrar(set(bases))
+        while pendientes:
+            por_base = Counter(bases[i] for i in pendientes)
+            contadores = {
+                c.base: c for c in ContadorUsername.objects.select_for_update().filter(base__in=list(por_base))
+            }
+            for i in pendientes:
+                contador = contadores[bases[i]]
+                resultado[i] = _username(contador.base, contador.siguiente)
+                contador.siguiente += 1
+            ContadorUsername.objects.bulk_update(contadores.values(), ["siguiente"])
+            # Usernames creados por otra vía (admin, shell): se vuelven a asignar
+            tomados = set(Usuario.objects.filter(
+                username__in=[resultado[i] for i in pendientes]
+            ).values_list("username", flat=True))
+            pendientes = [i for i in pendientes if resultado[i] in tomados]
+    return resultado
+
+
+# -------------------------------
+# Importación masiva
+# -------------------------------
+
+def leer_archivo(contenido, formato):
+    """Filas (dicts) de un CSV con cabecera o de un JSON (lista o {"pacientes": [...]})."""
+    if isinstance(contenido, bytes):
+        contenido = contenido.decode("utf-8-sig")
+    if formato == "csv":
+        return list(csv.DictReader(io.StringIO(contenido)))
+    datos = json.loads(contenido)
+    if isinstance(datos, dict):
+        datos = datos.get("pacientes")
+    if not isinstance(datos, list) or not all(isinstance(f, dict) for f in datos):
+        raise ValueError("Se esperaba una lista de pacientes")
+    return datos
+
+
+def importar(filas, chunk=CHUNK_IMPORTACION, simular=False):
+    """Valida e inserta pacientes por bloques de ``chunk`` (una transacción por bloque).
+
+    Las filas inválidas no detienen la importación; se informan con su número
+    (1 = primera fila de datos). Con ``simular`` solo valida.
+    """
+    validos, errores = [], []
+    for numero, fila in enumerate(filas, start=1):
+        # Las celdas vacías del CSV cuentan como "sin dato"
+        form = PacienteImportForm({k: v for k, v in fila.items() if v not in ("", None)})
+        if form.is_valid():
+            validos.append(form.cleaned_data)
+        else:
+            errores.append({"fila": numero, "errores": {c: list(mensajes) for c, mensajes in form.errors.items()}})
+
+    creados = 0
+    if not simular:
+        for inicio in range(0, len(validos), chunk):
+            bloque = validos[inicio:inicio + chunk]
+            with transaction.atomic():
+                usernames = asignar_usernames([d["nombre"] for d in bloque])
+                Usuario.objects.bulk_create([
+                    Usuario(username=username, rol="paciente", **{c: v for c, v in datos.items() if v not in ("", None)})
+                    for username, datos in zip(usernames, bloque)
+                ])
+            creados += len(bloque)
+    return {"filas": len(validos) + len(errores), "validos": len(validos), "creados": creados, "errores": errores}
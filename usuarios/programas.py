@@ -0,0 +1,192 @@
+"""Programas de terapia: una rutina de varios pasos entregada a la máquina de una vez.
+
+Un ProgramaTerapia (p. ej. calentamiento, 3×10 a 60°, 3×10 a 90°) se compila
+a un plan JSON con una entrada por serie, ya desplegada y con su descanso. La
+máquina lo recibe entero en un solo comando "programa" (ver cola.py) y lo
+recorre sola, sin volver a sondear al servidor entre pasos. Al empezar y al
+terminar cada serie informa su avance en /progreso_programa/; cada informe es
+una lectura y una escritura de la fila de EjecucionPrograma.
+
+Las repeticiones y los grados de la sesión siguen saliendo de la telemetría
+(sesiones.py); el plan abre la sesión con el total de repeticiones como
+objetivo y el informe final la cierra.
+"""
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from . import cola
+from .forms import PasoProgramaForm
+from .models import EjecucionPrograma, PasoPrograma, ProgramaTerapia, SesionTerapia
+from .sesiones import ABIERTAS, gestor_sesiones
+
+VERSION_PLAN = 1
+CAMPOS_PASO = ("grados", "repeticiones", "series", "stop_grados", "modo", "descanso")
+TERMINADAS = ("completada", "cancelada")
+
+
+def _max_series():
+    # Entradas del plan desplegado: la ESP32 lo guarda entero en memoria
+    return getattr(settings, "PROGRAMA_MAX_SERIES", 100)
+
+
+def crear(nombre, pasos, descripcion="", creado_por=None):
+    """Valida los pasos (en orden) y crea el programa. Devuelve ``(programa, errores)``."""
+    validos, errores = [], []
+    for numero, paso in enumerate(pasos, start=1):
+        form = PasoProgramaForm(paso if isinstance(paso, dict) else {})
+        if form.is_valid():
+            validos.append(form.cleaned_data)
+        else:
+            errores.append({"paso": numero, "errores": {c: list(m) for c, m in form.errors.items()}})
+    if not nombre:
+        errores.append({"paso": None, "errores": {"nombre": ["Este campo es obligatorio."]}})
+    if not validos and not errores:
+        errores.append({"paso": None, "errores": {"pasos": ["El programa necesita al menos un paso."]}})
+    maximo = _max_series()
+    if sum(p["series"] for p in validos) > maximo:
+        errores.append({"paso": None, "errores": {"pasos": [f"Máximo {maximo} series en total."]}})
+    if errores:
+        return None, errores
+
+    with transaction.atomic():
+        programa = ProgramaTerapia.objects.create(nombre=nombre, descripcion=descripcion, creado_por=creado_por)
+        PasoPrograma.objects.bulk_create([
+            PasoPrograma(programa=programa, orden=orden, **{c: datos[c] for c in CAMPOS_PASO})
+            for orden, datos in enumerate(validos, start=1)
+        ])
+    return programa, []
+
+
+def compilar(programa):
+    """Plan que recorre la máquina: una entrada por serie, el descanso va después de cada una."""
+    pasos = []
+    for paso in programa.pasos.all():
+        for serie in range(1, paso.series + 1):
+            pasos.append({
+                "paso": paso.orden,
+                "serie": serie,
+                "grados": paso.grados,
+                "repeticiones": paso.repeticiones,
+                "stop_grados": paso.stop_grados,
+                "modo": paso.modo,
+                "descanso": paso.descanso,
+            })
+    if pasos:
+        pasos[-1]["descanso"] = 0
+    return {
+        "version": VERSION_PLAN,
+        "programa": programa.pk,
+        "pasos": pasos,
+        "repeticiones": sum(p["repeticiones"] for p in pasos),
+        "grados_max": max((p["grados"] for p in pasos), default=0),
+    }
+
+
+def enviar(programa, maquina, paciente=None, ttl=None):
+    """Encola el plan compilado en la máquina y crea su EjecucionPrograma."""
+    plan = compilar(programa)
+    with transaction.atomic():
+        comando = cola.encolar(
+            maquina,
+            "programa",
+            grados=plan["grados_max"],
+            repeticiones=plan["repeticiones"],
+            usuario=paciente,
+            ttl=ttl,
+            plan=plan,
+        )
+        return EjecucionPrograma.objects.create(
+            programa=programa,
+            comando=comando,
+            maquina=maquina,
+            usuario=paciente,
+            progreso=[None] * len(plan["pasos"]),
+        )
+
+
+# -------------------------------
+# Avance informado por la máquina
+# -------------------------------
+
+def _entero(evento, campo):
+    valor = evento.get(campo)
+    if valor is None:
+        return None
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{campo}' inválido")
+
+
+def _aplicar(ejecucion, evento, ahora):
+    """Un evento {"i", "estado": iniciado|completado|cancelado, "repeticiones"?, "grados_max"?}."""
+    estado = evento.get("estado")
+    if estado == "cancelado":
+        ejecucion.estado = "cancelada"
+        ejecucion.timestamp_fin = ahora
+        return
+    i = _entero(evento, "i")
+    if estado not in ("iniciado", "completado") or i is None or not 0 <= i < len(ejecucion.progreso):
+        raise ValueError("Evento inválido: se espera 'i' dentro del plan y 'estado' iniciado, completado o cancelado")
+    serie = ejecucion.progreso[i] or {"inicio": ahora, "fin": None, "repeticiones": 0, "grados_max": None}
+    if estado == "completado":
+        serie["fin"] = serie["fin"] or ahora
+        for campo in ("repeticiones", "grados_max"):
+            valor = _entero(evento, campo)
+            if valor is not None:
+                serie[campo] = valor
+    ejecucion.progreso[i] = serie
+    ejecucion.paso_actual = max(ejecucion.paso_actual, i)
+    ejecucion.estado = "en_curso"
+    ejecucion.timestamp_inicio = ejecucion.timestamp_inicio or ahora
+    if estado == "completado" and i == len(ejecucion.progreso) - 1:
+        ejecucion.estado = "completada"
+        ejecucion.timestamp_fin = ahora
+
+
+def informar(comando_id, maquina_id, eventos):
+    """Aplica los eventos de avance de la máquina; None si el comando no es un programa suyo.
+
+    Reenviar un informe no cambia nada; los de una ejecución ya terminada se ignoran.
+    """
+    ahora = time.time()
+    with transaction.atomic():
+        ejecucion = EjecucionPrograma.objects.select_for_update().filter(
+            comando_id=comando_id, maquina_id=maquina_id
+        ).first()
+        if ejecucion is None or ejecucion.estado in TERMINADAS:
+            return ejecucion
+        for evento in eventos:
+            if not isinstance(evento, dict):
+                raise ValueError("Cada evento debe ser un objeto")
+            _aplicar(ejecucion, evento, ahora)
+            if ejecucion.estado in TERMINADAS:
+                break
+        ejecucion.save(update_fields=["estado", "paso_actual", "progreso", "timestamp_inicio", "timestamp_fin"])
+    # Cierra la sesión del plan, salvo que la máquina ya haya pasado a otra
+    if ejecucion.estado in TERMINADAS and SesionTerapia.objects.filter(ABIERTAS, pk=ejecucion.sesion_id).exists():
+        gestor_sesiones.cerrar(maquina_id)
+    return ejecucion
+
+
+def resumen(ejecucion):
+    plan = ejecucion.comando.plan or {"pasos": []}
+    return {
+        "id": ejecucion.pk,
+        "programa": ejecucion.programa_id,
+        "maquina": ejecucion.maquina.numero,
+        "paciente": ejecucion.usuario_id,
+        "sesion": ejecucion.sesion_id,
+        "estado": ejecucion.estado,
+        "entrega": cola.estado_comando(
+            ejecucion.comando.ejecutado, ejecucion.comando.descartado, ejecucion.comando.timestamp_reclamo
+        ),
+        "paso_actual": ejecucion.paso_actual,
+        "series_completadas": sum(1 for s in ejecucion.progreso if s and s["fin"]),
+        "series": len(plan["pasos"]),
+        "timestamp_inicio": ejecucion.timestamp_inicio,
+        "timestamp_fin": ejecucion.timestamp_fin,
+        "pasos": [{**paso, "avance": avance} for paso, avance in zip(plan["pasos"], ejecucion.progreso)],
+    }
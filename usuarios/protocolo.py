@@ -0,0 +1,81 @@
+"""Formato binario compacto para la telemetría de las ESP32.
+
+Se negocia por ``Content-Type: application/vnd.rehabilitatec.telemetria`` en
+/recibir_datos_esp/ y /recibir_datos_esp/lote/. Todo va en little-endian:
+
+    cabecera (18 bytes)  "RT" | versión u8 | flags u8 | maquina u32 | ts_base f64 | n u16
+    muestra  (9 bytes)   dt_ms u32 | grados i16 | repeticiones u16 | activo u8
+
+``maquina`` es el id de Maquinas (lo devuelve /recibir_datos_esp/ en JSON como
+"id"), así no viaja el nombre en cada muestra. El ts de cada muestra es
+``ts_base + dt_ms / 1000``; ts_base = 0 significa "sin hora" (se usa la del
+servidor). Un cuerpo de n muestras ocupa 18 + 9·n bytes.
+"""
+import struct
+
+TIPO_CONTENIDO = "application/vnd.rehabilitatec.telemetria"
+MAGIA = b"RT"
+VERSION = 1
+
+CABECERA = struct.Struct("<2sBBIdH")
+MUESTRA = struct.Struct("<IhHB")
+ACUSE = struct.Struct("<BHH")
+
+
+def es_binario(request):
+    tipo = request.content_type or ""
+    return tipo.split(";")[0].strip().lower() == TIPO_CONTENIDO
+
+
+def acepta_binario(request):
+    return TIPO_CONTENIDO in request.headers.get("Accept", "")
+
+
+def codificar(maquina_id, muestras, ts_base=None):
+    """Empaqueta muestras ({activo, grados_actuales, repeticiones, ts?}) de una máquina."""
+    if ts_base is None:
+        ts_base = min((m["ts"] for m in muestras if m.get("ts")), default=0.0)
+    registros = []
+    for m in muestras:
+        dt = round((m["ts"] - ts_base) * 1000) if m.get("ts") and ts_base else 0
+        registros.append(MUESTRA.pack(
+            dt, m.get("grados_actuales", 0), m.get("repeticiones", 0), int(bool(m.get("activo")))
+        ))
+    return CABECERA.pack(MAGIA, VERSION, 0, maquina_id, ts_base, len(muestras)) + b"".join(registros)
+
+
+def decodificar(cuerpo, maximo=None):
+    """Devuelve ``(maquina_id, muestras)``; lanza ValueError si el cuerpo no es válido.
+
+    Las muestras salen con las mismas claves que ``telemetria.leer_muestra``
+    salvo "nombre", que conoce quien resuelve el id de la máquina.
+    """
+    if len(cuerpo) < CABECERA.size:
+        raise ValueError("Cabecera incompleta")
+    magia, version, flags, maquina_id, ts_base, n = CABECERA.unpack_from(cuerpo)
+    if magia != MAGIA:
+        raise ValueError("No es telemetría binaria")
+    if version != VERSION:
+        raise ValueError(f"Versión {version} no soportada")
+    if maximo is not None and n > maximo:
+        raise ValueError(f"Máximo {maximo} muestras por lote")
+    if len(cuerpo) != CABECERA.size + n * MUESTRA.size:
+        raise ValueError("Longitud no coincide con el número de muestras")
+
+    registros = memoryview(cuerpo)[CABECERA.size:]
+    if ts_base:
+        muestras = [
+            {"activo": bool(a), "grados_actuales": g, "repeticiones": r, "ts": ts_base + dt / 1000}
+            for dt, g, r, a in MUESTRA.iter_unpack(registros)
+        ]
+    else:
+        muestras = [
+            {"activo": bool(a), "grados_actuales": g, "repeticiones": r, "ts": None}
+            for dt, g, r, a in MUESTRA.iter_unpack(registros)
+        ]
+    return maquina_id, muestras
+
+
+def acuse(recibidas, rechazadas=0):
+    """Respuesta binaria de 5 bytes: versión | recibidas u16 | rechazadas u16."""
+    return ACUSE.pack(VERSION, min(recibidas, 0xFFFF), min(rechazadas, 0xFFFF))
@@ -0,0 +1,132 @@
+"""Caché en proceso de numero → máquina para las vistas de las ESP32.
+
+Los datos de una máquina (id, ip, id de su EstadoMaquina) casi nunca cambian,
+así que los sondeos no necesitan consultarlos cada vez. La caché tiene tamaño
+acotado (LRU), se precarga con la primera consulta del proceso y se invalida
+con signals al guardar o borrar Maquinas/EstadoMaquina (ver signals.py).
+
+Las signals solo alcanzan al proceso que hizo el cambio; en los demás una
+entrada vieja puede durar hasta que la desaloje el LRU, por eso las vistas que
+escriben con ``estado_id`` comprueban que el UPDATE haya tocado una fila.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .models import EstadoMaquina, Maquinas
+
+
+class Entrada(namedtuple("Entrada", "id numero ip estado_id")):
+    __slots__ = ()
+
+    def instancia(self):
+        """Maquinas armada con los datos en caché, sin consultar la BD."""
+        return Maquinas.from_db("default", ["id", "numero", "ip"], [self.id, self.numero, self.ip])
+
+
+CAMPOS = ("id", "numero", "ip", "estadomaquina__id")
+
+
+class RegistroMaquinas:
+    def __init__(self, capacidad=2000):
+        self.capacidad = capacidad
+        self._lock = threading.Lock()
+        self._entradas = OrderedDict()   # numero -> Entrada, del menos al más usado
+        self._ids = {}                   # id -> numero
+        self._precargado = False
+
+    def _guardar(self, entrada):
+        with self._lock:
+            self._entradas[entrada.numero] = entrada
+            self._entradas.move_to_end(entrada.numero)
+            self._ids[entrada.id] = entrada.numero
+            while len(self._entradas) > self.capacidad:
+                _, vieja = self._entradas.popitem(last=False)
+                self._ids.pop(vieja.id, None)
+        return entrada
+
+    def _buscar(self, numero):
+        with self._lock:
+            entrada = self._entradas.get(numero)
+            if entrada is not None:
+                self._entradas.move_to_end(numero)
+            return entrada
+
+    def precargar(self):
+        """Carga hasta ``capacidad`` máquinas en una sola consulta."""
+        filas = Maquinas.objects.order_by("-id").values_list(*CAMPOS)[:self.capacidad]
+        for fila in filas:
+            self._guardar(Entrada(*fila))
+        self._precargado = True
+
+    def obtener(self, numero):
+        """Entrada de la máquina o None si no existe."""
+        if not self._precargado:
+            self.precargar()
+        entrada = self._buscar(numero)
+        if entrada is not None:
+            return entrada
+        fila = Maquinas.objects.filter(numero=numero).values_list(*CAMPOS).first()
+        return self._guardar(Entrada(*fila)) if fila else None
+
+    def obtener_o_crear(self, numero, ip=None):
+        """Como get_or_create; una máquina nueva se registra con la ip del dispositivo.
+
+        Con ``numero`` único, si dos primeros contactos compiten el perdedor
+        recibe IntegrityError dentro de get_or_create y relee la fila ganadora.
+        """
+        entrada = self.obtener(numero)
+        if entrada is not None:
+            return entrada
+        maquina, _ = Maquinas.objects.get_or_create(numero=numero, defaults={"ip": ip or "0.0.0.0"})
+        return self._guardar(Entrada(maquina.pk, maquina.numero, maquina.ip, None))
+
+    def por_id(self, maquina_id):
+        with self._lock:
+            numero = self._ids.get(maquina_id)
+        if numero is not None:
+            entrada = self._buscar(numero)
+            if entrada is not None:
+                return entrada
+        fila = Maquinas.objects.filter(pk=maquina_id).values_list(*CAMPOS).first()
+        return self._guardar(Entrada(*fila)) if fila else None
+
+    def estado(self, entrada, defaults=None):
+        """EstadoMaquina de la máquina (una consulta con el id en caché)."""
+        estado = None
+        if entrada.estado_id is not None:
+            estado = EstadoMaquina.objects.filter(pk=entrada.estado_id).first()
+        if estado is None:
+            estado, _ = EstadoMaquina.objects.get_or_create(maquina_id=entrada.id, defaults=defaults or {})
+            self._guardar(entrada._replace(estado_id=estado.pk))
+        return estado
+
+    def actualizar_estado(self, entrada, **campos):
+        """UPDATE directo de EstadoMaquina por el id en caché; crea la fila si falta."""
+        if entrada.estado_id is not None and EstadoMaquina.objects.filter(pk=entrada.estado_id).update(**campos):
+            return
+        estado, creado = EstadoMaquina.objects.get_or_create(maquina_id=entrada.id, defaults=campos)
+        if not creado:
+            for campo, valor in campos.items():
+                setattr(estado, campo, valor)
+            estado.save(update_fields=list(campos))
+        self.fijar_estado(entrada, estado.pk)
+
+    def fijar_estado(self, entrada, estado_id):
+        return self._guardar(entrada._replace(estado_id=estado_id))
+
+    def invalidar(self, maquina_id):
+        with self._lock:
+            numero = self._ids.pop(maquina_id, None)
+            if numero is not None:
+                self._entradas.pop(numero, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+            self._ids.clear()
+            self._precargado = False
+
+
+registro_maquinas = RegistroMaquinas(getattr(settings, "REGISTRO_MAQUINAS_MAX", 2000))
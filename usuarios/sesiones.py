@@ -0,0 +1,227 @@
+"""Ciclo de vida de SesionTerapia a partir de los comandos y la telemetría.
+
+- Entregar un "iniciar" con paciente abre una sesión en la máquina (y cierra
+  la que hubiera abierta). Un "programa" (programas.py) abre una sola sesión
+  para todo el plan y se enlaza a su EjecucionPrograma.
+- Cada muestra avanza la sesión en memoria en O(1). Las repeticiones salen
+  del contador del dispositivo: si el contador vuelve a empezar, lo ya
+  contado se acumula. La muestra se guarda en el histórico con su sesion_id.
+- Entregar un "detener", o pasar ``SESIONES_INACTIVIDAD`` segundos sin
+  muestras, cierra la sesión con save(), así signals.py la suma a la analítica.
+
+El avance se vuelca cada ``SESIONES_VOLCADO`` segundos con un UPDATE por
+bloque (CASE por sesión, como latidos.py); las muestras no hacen consultas.
+Con varios workers, una máquina cuya sesión abrió otro proceso se adopta
+desde la BD (como mucho una consulta cada ``relectura`` segundos por máquina)
+y los volcados usan Greatest para no retroceder lo escrito por otro proceso.
+"""
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import EjecucionPrograma, SesionTerapia
+from .tareas import TareaPeriodica
+
+BLOQUE = 200
+ABIERTAS = Q(completada=False, fecha_fin__isnull=True)
+
+
+class SesionActiva:
+    __slots__ = (
+        "sesion_id", "comando_id", "objetivo", "base", "ultima", "acumulado",
+        "completadas", "grados_max", "ts_contador", "ultimo_contacto", "sucia",
+    )
+
+    def __init__(self, sesion_id, objetivo, comando_id=None, completadas=0, grados_max=None):
+        self.sesion_id = sesion_id
+        self.comando_id = comando_id
+        self.objetivo = objetivo or 0
+        self.base = None             # valor del contador del dispositivo al empezar (o al reiniciarse)
+        self.ultima = 0
+        self.acumulado = completadas
+        self.completadas = completadas
+        self.grados_max = grados_max
+        self.ts_contador = 0
+        self.ultimo_contacto = time.time()
+        self.sucia = False
+
+    def avanzar(self, repeticiones, grados, ts):
+        if self.base is None:
+            self.base = self.ultima = repeticiones
+        elif ts >= self.ts_contador and repeticiones < self.ultima:
+            # El dispositivo reinició su contador: lo contado hasta aquí se conserva
+            self.acumulado += self.ultima - self.base
+            self.base = repeticiones
+        if ts >= self.ts_contador:
+            self.ultima, self.ts_contador = repeticiones, ts
+        self.completadas = max(self.completadas, self.acumulado + self.ultima - self.base)
+        self.grados_max = grados if self.grados_max is None else max(self.grados_max, grados)
+        self.ultimo_contacto = time.time()
+        self.sucia = True
+
+
+class GestorSesiones:
+    def __init__(self, inactividad=300, relectura=5, duracion_max=4 * 3600):
+        self.inactividad = inactividad
+        self.relectura = relectura
+        self.duracion_max = duracion_max
+        self._lock = threading.Lock()
+        self._activas = {}       # maquina_id -> SesionActiva
+        self._consultadas = {}   # maquina_id -> última vez que se buscó en la BD sin encontrar sesión
+
+    # -------------------------------
+    # Eventos
+    # -------------------------------
+
+    def comando_entregado(self, comando):
+        if comando.accion == "iniciar":
+            self.abrir(comando.maquina_id, comando.usuario_id, comando.grados, comando.repeticiones, comando.pk)
+        elif comando.accion == "programa":
+            sesion_id = self.abrir(comando.maquina_id, comando.usuario_id, comando.grados, comando.repeticiones, comando.pk)
+            # Solo la primera entrega: una reentrega no pisa el avance ya informado
+            EjecucionPrograma.objects.filter(comando_id=comando.pk, sesion__isnull=True, estado="enviada").update(
+                sesion_id=sesion_id
+            )
+        elif comando.accion == "detener":
+            self.cerrar(comando.maquina_id)
+
+    def abrir(self, maquina_id, usuario_id, grados=None, repeticiones=None, comando_id=None):
+        """Abre una sesión; None si el comando no trae paciente. Una reentrega del mismo comando no reabre."""
+        with self._lock:
+            actual = self._activas.get(maquina_id)
+        if actual is not None and comando_id is not None and actual.comando_id == comando_id:
+            return actual.sesion_id
+        self.cerrar(maquina_id)
+        if usuario_id is None:
+            return None
+        sesion = SesionTerapia.objects.create(
+            maquina_id=maquina_id,
+            usuario_id=usuario_id,
+            grados_objetivo=grados or 0,
+            repeticiones_objetivo=repeticiones or 0,
+        )
+        _tarea_vaciar.iniciar()
+        with self._lock:
+            self._activas[maquina_id] = SesionActiva(sesion.pk, repeticiones, comando_id)
+        return sesion.pk
+
+    def muestra(self, maquina_id, repeticiones, grados, ts=None):
+        """Avanza la sesión abierta de la máquina y devuelve su id (o None)."""
+        with self._lock:
+            activa = self._activas.get(maquina_id)
+            if activa is not None:
+                activa.avanzar(repeticiones, grados, ts or time.time())
+                return activa.sesion_id
+        activa = self._adoptar(maquina_id)
+        if activa is None:
+            return None
+        with self._lock:
+            activa.avanzar(repeticiones, grados, ts or time.time())
+        return activa.sesion_id
+
+    def _adoptar(self, maquina_id):
+        """Sesión abierta por otro proceso (o antes de reiniciar), releída cada ``relectura`` segundos."""
+        ahora = time.time()
+        with self._lock:
+            if ahora - self._consultadas.get(maquina_id, 0) < self.relectura:
+                return None
+            self._consultadas[maquina_id] = ahora
+        fila = SesionTerapia.objects.filter(ABIERTAS, maquina_id=maquina_id).order_by("-fecha_inicio").values_list(
+            "pk", "repeticiones_objetivo", "repeticiones_completadas", "grados_alcanzados"
+        ).first()
+        if fila is None:
+            return None
+        _tarea_vaciar.iniciar()
+        with self._lock:
+            return self._activas.setdefault(maquina_id, SesionActiva(fila[0], fila[1], None, fila[2], fila[3]))
+
+    def cerrar(self, maquina_id):
+        """Cierra la sesión abierta de la máquina (la propia y las que dejó abiertas otro proceso)."""
+        with self._lock:
+            activa = self._activas.pop(maquina_id, None)
+            self._consultadas.pop(maquina_id, None)
+        abiertas = SesionTerapia.objects.filter(ABIERTAS, maquina_id=maquina_id)
+        cerradas = 0
+        for sesion in abiertas:
+            self._cerrar_sesion(sesion, activa if activa and activa.sesion_id == sesion.pk else None)
+            cerradas += 1
+        return cerradas
+
+    @staticmethod
+    def _cerrar_sesion(sesion, activa=None):
+        if activa is not None:
+            sesion.repeticiones_completadas = max(sesion.repeticiones_completadas, activa.completadas)
+            if activa.grados_max is not None:
+                sesion.grados_alcanzados = max(sesion.grados_alcanzados or activa.grados_max, activa.grados_max)
+        sesion.completada = 0 < sesion.repeticiones_objetivo <= sesion.repeticiones_completadas
+        sesion.fecha_fin = timezone.now()
+        # save() y no update(): la signal post_save suma la sesión a la analítica
+        sesion.save(update_fields=["repeticiones_completadas", "grados_alcanzados", "completada", "fecha_fin"])
+
+    # -------------------------------
+    # Volcado periódico
+    # -------------------------------
+
+    def vaciar(self):
+        """Guarda el avance de las sesiones y cierra las inactivas. Devuelve cuántas sesiones escribió."""
+        ahora = time.time()
+        with self._lock:
+            sucias = {}
+            for maquina_id, activa in self._activas.items():
+                if activa.sucia:
+                    activa.sucia = False
+                    sucias[activa.sesion_id] = (maquina_id, activa.completadas, activa.grados_max)
+            vencidas = [m for m, a in self._activas.items() if ahora - a.ultimo_contacto > self.inactividad]
+
+        ids = list(sucias)
+        for i in range(0, len(ids), BLOQUE):
+            self._volcar_bloque({s: sucias[s] for s in ids[i:i + BLOQUE]})
+
+        for maquina_id in vencidas:
+            self.cerrar(maquina_id)
+        # Sesiones que nadie cerró (p. ej. el proceso que las abrió se reinició)
+        limite = timezone.now() - timedelta(seconds=self.duracion_max)
+        for sesion in SesionTerapia.objects.filter(ABIERTAS, fecha_inicio__lt=limite):
+            self._cerrar_sesion(sesion)
+        return len(ids)
+
+    def _volcar_bloque(self, bloque):
+        SesionTerapia.objects.filter(ABIERTAS, pk__in=list(bloque)).update(
+            repeticiones_completadas=Greatest(
+                F("repeticiones_completadas"),
+                Case(*[When(pk=s, then=Value(c)) for s, (_, c, _) in bloque.items()], output_field=IntegerField()),
+            ),
+            grados_alcanzados=Greatest(
+                # Greatest con NULL da NULL en SQLite
+                Coalesce(F("grados_alcanzados"), Value(-1)),
+                Case(
+                    *[When(pk=s, then=Value(g if g is not None else -1)) for s, (_, _, g) in bloque.items()],
+                    output_field=IntegerField(),
+                ),
+            ),
+        )
+        # Las que ya cerró otro proceso dejan de seguirse aquí
+        cerradas = SesionTerapia.objects.filter(pk__in=list(bloque)).exclude(ABIERTAS).values_list("pk", flat=True)
+        with self._lock:
+            for sesion_id in cerradas:
+                maquina_id = bloque[sesion_id][0]
+                activa = self._activas.get(maquina_id)
+                if activa is not None and activa.sesion_id == sesion_id:
+                    del self._activas[maquina_id]
+
+    def limpiar(self):
+        with self._lock:
+            self._activas.clear()
+            self._consultadas.clear()
+
+
+gestor_sesiones = GestorSesiones(
+    inactividad=getattr(settings, "SESIONES_INACTIVIDAD", 300),
+    duracion_max=getattr(settings, "SESIONES_DURACION_MAX", 4 * 3600),
+)
+_tarea_vaciar = TareaPeriodica(gestor_sesiones.vaciar, getattr(settings, "SESIONES_VOLCADO", 5), "sesiones-vaciar")
@@ -0,0 +1,54 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import analitica
+from .eventos import bus_comandos
+from .models import ComandoMaquina, EstadoMaquina, Maquinas, SesionTerapia
+from .registro import registro_maquinas
+
+
+@receiver(post_save, sender=Maquinas)
+@receiver(post_delete, sender=Maquinas)
+def invalidar_maquina(sender, instance, **kwargs):
+    """Saca la máquina de la caché de registro.py (cambió su número, ip o se borró)."""
+    registro_maquinas.invalidar(instance.pk)
+
+
+@receiver(post_save, sender=EstadoMaquina)
+def invalidar_estado_creado(sender, instance, created, **kwargs):
+    if created:
+        registro_maquinas.invalidar(instance.maquina_id)
+
+
+@receiver(post_delete, sender=EstadoMaquina)
+def invalidar_estado_borrado(sender, instance, **kwargs):
+    registro_maquinas.invalidar(instance.maquina_id)
+
+
+@receiver(post_save, sender=ComandoMaquina)
+def avisar_comando_encolado(sender, instance, created, **kwargs):
+    """Despierta a los long-polls de la máquina cuando se encola un comando."""
+    if not created:
+        return
+    numero = instance.maquina.numero
+    # Tras el commit, para que la máquina ya pueda leer el comando al despertar
+    transaction.on_commit(lambda: bus_comandos.publicar(numero, {"id": instance.pk}, tipo="comando"))
+
+
+@receiver(pre_save, sender=SesionTerapia)
+def recordar_cierre_previo(sender, instance, **kwargs):
+    if instance.pk is None:
+        instance._estaba_cerrada = False
+    else:
+        instance._estaba_cerrada = SesionTerapia.objects.filter(pk=instance.pk).exclude(
+            completada=False, fecha_fin__isnull=True
+        ).exists()
+
+
+@receiver(post_save, sender=SesionTerapia)
+def actualizar_analitica(sender, instance, **kwargs):
+    """Suma la sesión a los agregados del paciente la primera vez que se cierra."""
+    if instance.cerrada and not getattr(instance, "_estaba_cerrada", False):
+        analitica.registrar_cierre(instance)
+        instance._estaba_cerrada = True
@@ -3,6 +3,9 @@
 ============================================================ */
 let maquinas = [];
 let intervaloEstado = null;
+let streamEstado = null;
+let esperaSnapshot = null;
+let estadoMaquina = {};
 let maquinaMonitoreada = null;
 let pacientes = [];
 
@@ -61,6 +64,10 @@ document.addEventListener("DOMContentLoaded", async () => {
     function detenerMonitoreoEstado() {
         if (intervaloEstado) clearInterval(intervaloEstado);
         intervaloEstado = null;
+        clearTimeout(esperaSnapshot);
+        if (streamEstado) streamEstado.close();
+        streamEstado = null;
+        estadoMaquina = {};
         maquinaMonitoreada = null;
         actualizarEstadoVisual("Cargando...", false);
     }
@@ -76,15 +83,19 @@ document.addEventListener("DOMContentLoaded", async () => {
         estadoElemento.innerText = texto;
     }
 
+    function pintarEstado(data) {
+        actualizarEstadoVisual(
+            data.estado || "Ocupado",
+            data.estado === "Disponible"
+        );
+    }
+
     async function obtenerEstado(numeroMaquina) {
         try {
             const res = await fetch(`/estado_arduino/?numero=${numeroMaquina}`);
             const data = await res.json();
 
-            actualizarEstadoVisual(
-                data.estado || "Ocupado",
-                data.estado === "Disponible"
-            );
+            pintarEstado(data);
         } catch (err) {
             console.error("Error consultando estado:", err);
             actualizarEstadoVisual("Error de conexión", false);
@@ -94,6 +105,44 @@ document.addEventListener("DOMContentLoaded", async () => {
     function iniciarMonitoreoEstado(numeroMaquina) {
         detenerMonitoreoEstado();
         maquinaMonitoreada = numeroMaquina;
+
+        // Navegadores sin SSE: se mantiene el sondeo anterior
+        if (!window.EventSource) {
+            iniciarSondeoEstado(numeroMaquina);
+            return;
+        }
+
+        // El servidor manda un snapshot ("estado") y después solo cambios ("delta").
+        // EventSource reconecta solo y reenvía Last-Event-ID para reanudar.
+        streamEstado = new EventSource(`/stream_estado/?numero=${encodeURIComponent(numeroMaquina)}`);
+
+        // Si el stream no entrega el snapshot a tiempo (proxy que lo bufferiza,
+        // servidor que no lo sirve) se vuelve al sondeo
+        esperaSnapshot = setTimeout(() => iniciarSondeoEstado(numeroMaquina), 5000);
+
+        streamEstado.addEventListener("estado", e => {
+            clearTimeout(esperaSnapshot);
+            estadoMaquina = JSON.parse(e.data);
+            pintarEstado(estadoMaquina);
+        });
+
+        streamEstado.addEventListener("delta", e => {
+            Object.assign(estadoMaquina, JSON.parse(e.data));
+            pintarEstado(estadoMaquina);
+        });
+
+        streamEstado.onerror = () => {
+            if (streamEstado && streamEstado.readyState === EventSource.CLOSED) {
+                clearTimeout(esperaSnapshot);
+                iniciarSondeoEstado(numeroMaquina);
+            }
+        };
+    }
+
+    function iniciarSondeoEstado(numeroMaquina) {
+        if (intervaloEstado) return;
+        if (streamEstado) streamEstado.close();
+        streamEstado = null;
         obtenerEstado(numeroMaquina);
         intervaloEstado = setInterval(() => obtenerEstado(numeroMaquina), 500);
     }
@@ -147,34 +196,31 @@ document.addEventListener("DOMContentLoaded", async () => {
 
 
     /* ============================================================
-    CARGAR PACIENTES DESDE DJANGO
+    BUSCAR PACIENTES EN DJANGO (búsqueda por prefijo en el servidor)
     ============================================================ */
-    async function cargarPacientes() {
+    const CAMPOS_PACIENTE = "id,nombre,peso,tamano_de_la_pantorrilla,sesiones,altura";
+    let temporizadorBusqueda = null;
+    let ultimaBusqueda = "";
+
+    async function buscarPacientes(texto) {
+        const params = new URLSearchParams({ q: texto, limite: 20, fields: CAMPOS_PACIENTE });
         try {
-            const resp = await fetch(URL_LISTA_PACIENTES);
-            pacientes = await resp.json();
-            console.log("Pacientes cargados:", pacientes);
+            const resp = await fetch(`${URL_LISTA_PACIENTES}?${params}`);
+            const datos = await resp.json();
+            return datos.pacientes || [];
         } catch (err) {
-            console.error("Error cargando pacientes:", err);
+            console.error("Error buscando pacientes:", err);
+            return [];
         }
     }
-    await cargarPacientes();
 
 
     /* ============================================================
     AUTOCOMPLETADO DE PACIENTES
     ============================================================ */
-    patientSelect.addEventListener("input", () => {
-        const valor = patientSelect.value.toLowerCase();
+    function mostrarPacientes(filtrados) {
         autocompleteList.innerHTML = "";
 
-        if (valor.length < 2) {
-            autocompleteList.style.display = "none";
-            return;
-        }
-
-        const filtrados = pacientes.filter(p => p.nombre.toLowerCase().includes(valor));
-
         if (filtrados.length === 0) {
             autocompleteList.style.display = "none";
             return;
@@ -195,6 +241,27 @@ document.addEventListener("DOMContentLoaded", async () => {
         });
 
         autocompleteList.style.display = "block";
+    }
+
+    patientSelect.addEventListener("input", () => {
+        const valor = patientSelect.value.trim();
+        clearTimeout(temporizadorBusqueda);
+
+        if (valor.length < 2) {
+            autocompleteList.innerHTML = "";
+            autocompleteList.style.display = "none";
+            return;
+        }
+
+        // Espera a que se deje de escribir para no consultar por cada tecla
+        temporizadorBusqueda = setTimeout(async () => {
+            ultimaBusqueda = valor;
+            const resultado = await buscarPacientes(valor);
+            if (valor === ultimaBusqueda) {
+                pacientes = resultado;
+                mostrarPacientes(pacientes);
+            }
+        }, 250);
     });
 
     document.addEventListener("click", e => {
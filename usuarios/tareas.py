@@ -0,0 +1,53 @@
+"""Hilos en segundo plano para trabajos periódicos del proceso (vaciados a BD, etc.)."""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger("usuarios")
+
+
+class TareaPeriodica:
+    """Ejecuta ``funcion`` cada ``intervalo`` segundos en un hilo daemon.
+
+    El hilo arranca con la primera llamada a ``iniciar()`` (no al importar, para
+    no lanzar hilos en migrate/shell) y ``despertar()`` adelanta la siguiente
+    ejecución. Al salir del proceso se ejecuta una última vez. Con
+    ``TAREAS_SEGUNDO_PLANO = False`` (en las pruebas) no se lanza nada.
+    """
+
+    def __init__(self, funcion, intervalo, nombre):
+        self.funcion = funcion
+        self.intervalo = intervalo
+        self.nombre = nombre
+        self._lock = threading.Lock()
+        self._evento = threading.Event()
+        self._hilo = None
+
+    def iniciar(self):
+        if self._hilo is not None or not getattr(settings, "TAREAS_SEGUNDO_PLANO", True):
+            return
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, name=self.nombre, daemon=True)
+                self._hilo.start()
+                atexit.register(self.ejecutar)
+
+    def despertar(self):
+        self._evento.set()
+
+    def ejecutar(self):
+        try:
+            self.funcion()
+        except Exception:
+            logger.exception("Error en tarea %s", self.nombre)
+        finally:
+            close_old_connections()
+
+    def _bucle(self):
+        while True:
+            self._evento.wait(self.intervalo)
+            self._evento.clear()
+            self.ejecutar()
@@ -0,0 +1,216 @@
+"""Ingesta de telemetría de las ESP32 (muestras sueltas y por lotes)."""
+import logging
+import math
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+
+from . import compactacion
+from .conectividad import monitor_conectividad
+from .models import Maquinas, EstadoMaquina, TelemetriaMaquina
+from .sesiones import gestor_sesiones
+from .tareas import TareaPeriodica
+
+logger = logging.getLogger("usuarios")
+
+# Tope al descomprimir un lote gzip, para no inflar cuerpos maliciosos en memoria
+MAX_BYTES_DESCOMPRIMIDOS = 10 * 1024 * 1024
+# Rangos de las columnas de TelemetriaMaquina (SmallIntegerField / PositiveIntegerField)
+GRADOS_MIN, GRADOS_MAX = -32768, 32767
+REPETICIONES_MAX = 2147483647
+
+
+def descomprimir(cuerpo, codificacion):
+    """Devuelve el cuerpo sin gzip si el cliente lo mandó comprimido."""
+    if (codificacion or "").lower() != "gzip":
+        return cuerpo
+    descompresor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        datos = descompresor.decompress(cuerpo, MAX_BYTES_DESCOMPRIMIDOS)
+    except zlib.error:
+        raise ValueError("gzip inválido")
+    if descompresor.unconsumed_tail:
+        raise ValueError("Lote demasiado grande")
+    if not descompresor.eof:
+        raise ValueError("gzip incompleto")
+    return datos
+
+
+def leer_muestra(data, nombre_defecto=None):
+    """Valida una muestra y la devuelve normalizada; lanza ValueError si no sirve."""
+    if not isinstance(data, dict):
+        raise ValueError("La muestra debe ser un objeto")
+    nombre = data.get("nombre") or nombre_defecto
+    if not nombre:
+        raise ValueError("Falta 'nombre' del dispositivo")
+    try:
+        muestra = {
+            "nombre": str(nombre),
+            "activo": bool(data.get("activo", False)),
+            "grados_actuales": int(data.get("grados_actuales", 0)),
+            "repeticiones": int(data.get("repeticiones", 0)),
+            "ts": float(data["ts"]) if data.get("ts") is not None else None,
+        }
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Valores numéricos inválidos")
+    # Fuera de rango la fila no entraría al histórico (y bloquearía el vaciado del buffer)
+    if not GRADOS_MIN <= muestra["grados_actuales"] <= GRADOS_MAX:
+        raise ValueError(f"'grados_actuales' fuera de rango ({GRADOS_MIN} a {GRADOS_MAX})")
+    if not 0 <= muestra["repeticiones"] <= REPETICIONES_MAX:
+        raise ValueError("'repeticiones' fuera de rango (debe ser >= 0)")
+    if muestra["ts"] is not None and not math.isfinite(muestra["ts"]):
+        raise ValueError("'ts' inválido")
+    return muestra
+
+
+def ultima_por_maquina(muestras):
+    """Se queda con la muestra más reciente de cada máquina (por ts o por orden)."""
+    ultimas = {}
+    for muestra in muestras:
+        previa = ultimas.get(muestra["nombre"])
+        if previa is None or (muestra["ts"] or 0) >= (previa["ts"] or 0):
+            ultimas[muestra["nombre"]] = muestra
+    return ultimas
+
+
+class BufferTelemetria:
+    """Buffer write-behind del histórico de telemetría.
+
+    La ingesta solo agrega filas en memoria; un hilo las inserta con
+    bulk_create cuando el buffer llega a ``max_muestras`` o cuando la muestra
+    más vieja cumple ``max_edad`` segundos.
+    """
+
+    def __init__(self, max_muestras=500, max_edad=2.0):
+        self.max_muestras = max_muestras
+        self._lock = threading.Lock()
+        self._pendientes = []
+        self._tarea = TareaPeriodica(self.vaciar, max_edad, "buffer-telemetria")
+
+    def __len__(self):
+        return len(self._pendientes)
+
+    def agregar(self, maquina_id, muestra, ts=None, sesion_id=None):
+        ts = muestra["ts"] or ts or time.time()
+        if sesion_id is None:
+            # Avanza la sesión abierta de la máquina en memoria (ver sesiones.py)
+            sesion_id = gestor_sesiones.muestra(maquina_id, muestra["repeticiones"], muestra["grados_actuales"], ts)
+        fila = TelemetriaMaquina(
+            maquina_id=maquina_id,
+            sesion_id=sesion_id,
+            ts=ts,
+            grados=muestra["grados_actuales"],
+            repeticiones=muestra["repeticiones"],
+            activo=muestra["activo"],
+        )
+        with self._lock:
+            self._pendientes.append(fila)
+            lleno = len(self._pendientes) >= self.max_muestras
+        self._tarea.iniciar()
+        if lleno:
+            self._tarea.despertar()
+
+    def vaciar(self):
+        """Inserta todo lo pendiente; si la BD falla, las filas vuelven al buffer.
+
+        Las filas que violan una restricción (p. ej. la máquina se borró) se
+        descartan sin bloquear al resto. Devuelve cuántas filas se guardaron.
+        """
+        with self._lock:
+            filas, self._pendientes = self._pendientes, []
+        if not filas:
+            return 0
+        try:
+            guardadas = self._insertar(filas)
+        except Exception:
+            for fila in filas:
+                fila.pk = None
+            with self._lock:
+                # Se reintenta en el siguiente ciclo sin crecer sin límite
+                self._pendientes[:0] = filas[-10 * self.max_muestras:]
+            raise
+        compactacion.programar()
+        return guardadas
+
+    def _insertar(self, filas):
+        """bulk_create todo o nada; ante un error de datos parte el lote en mitades hasta aislar la fila."""
+        try:
+            with transaction.atomic():
+                TelemetriaMaquina.objects.bulk_create(filas, batch_size=self.max_muestras)
+            return len(filas)
+        except (IntegrityError, DataError):
+            for fila in filas:
+                fila.pk = None
+            if len(filas) == 1:
+                logger.warning(
+                    "Muestra de telemetría descartada: maquina=%s grados=%s repeticiones=%s",
+                    filas[0].maquina_id, filas[0].grados, filas[0].repeticiones, exc_info=True,
+                )
+                return 0
+            mitad = len(filas) // 2
+            return self._insertar(filas[:mitad]) + self._insertar(filas[mitad:])
+
+
+buffer_telemetria = BufferTelemetria(
+    max_muestras=getattr(settings, "TELEMETRIA_BUFFER_MAX", 500),
+    max_edad=getattr(settings, "TELEMETRIA_BUFFER_EDAD", 2.0),
+)
+
+
+def guardar_lote(muestras, ip="0.0.0.0"):
+    """Persiste el último estado de cada máquina del lote en una sola transacción.
+
+    Las consultas no dependen del tamaño del lote: una lectura de máquinas y
+    estados, y a lo sumo un bulk_create/bulk_update por tabla.
+    """
+    ultimas = ultima_por_maquina(muestras)
+    if not ultimas:
+        return ultimas
+    ahora = time.time()
+
+    with transaction.atomic():
+        maquinas = {m.numero: m for m in Maquinas.objects.filter(numero__in=list(ultimas))}
+        nuevas = [Maquinas(numero=nombre, ip=ip) for nombre in ultimas if nombre not in maquinas]
+        if nuevas:
+            # numero es único: si otra petición la creó entretanto se ignora y se relee
+            Maquinas.objects.bulk_create(nuevas, ignore_conflicts=True)
+            maquinas.update(
+                (m.numero, m) for m in Maquinas.objects.filter(numero__in=[n.numero for n in nuevas])
+            )
+
+        estados = {
+            e.maquina_id: e
+            for e in EstadoMaquina.objects.filter(maquina__in=list(maquinas.values()))
+        }
+        crear, actualizar = [], []
+        for nombre, muestra in ultimas.items():
+            maquina = maquinas[nombre]
+            estado = estados.get(maquina.pk)
+            if estado is None:
+                estado = EstadoMaquina(maquina=maquina)
+                crear.append(estado)
+            else:
+                actualizar.append(estado)
+            estado.activo = muestra["activo"]
+            estado.grados_actuales = muestra["grados_actuales"]
+            estado.repeticiones = muestra["repeticiones"]
+            estado.ultimo_timestamp = ahora
+            estado.conectado = True
+
+        if crear:
+            EstadoMaquina.objects.bulk_create(crear, ignore_conflicts=True)
+        if actualizar:
+            EstadoMaquina.objects.bulk_update(
+                actualizar,
+                ["activo", "grados_actuales", "repeticiones", "ultimo_timestamp", "conectado"],
+            )
+
+    for nombre in ultimas:
+        monitor_conectividad.contacto(maquinas[nombre].pk, nombre, ahora)
+    # El histórico guarda todas las muestras, no solo la última
+    for muestra in muestras:
+        buffer_telemetria.agregar(maquinas[muestra["nombre"]].pk, muestra, ts=ahora)
+    return ultimas
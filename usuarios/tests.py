@@ -1,3 +1,847 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from . import analisis, analitica, cola, compactacion, graficas, metricas, pacientes, programas, protocolo
+from .conectividad import MonitorConectividad
+from .estado import AlmacenMemoria, AlmacenRedis, almacen_estado, conectado_por_tiempo
+from .eventos import BusEventos, RelevoRedis
+from .maquinas import resumen_maquinas
+from .registro import RegistroMaquinas, registro_maquinas
+from .models import (
+    ComandoMaquina, ContadorUsername, EjecucionPrograma, EstadoMaquina, Maquinas, SesionTerapia,
+    TelemetriaMaquina, Usuario,
+)
+from .sesiones import gestor_sesiones
+from .telemetria import BufferTelemetria, buffer_telemetria, leer_muestra
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+# -------------------------------
+# Protocolo binario de telemetría (vectores fijos: la firmware depende de ellos)
+# -------------------------------
+
+VECTORES = [
+    (
+        "dos muestras con hora",
+        7,
+        [
+            {"activo": True, "grados_actuales": 45, "repeticiones": 3, "ts": 1700000000.0},
+            {"activo": False, "grados_actuales": -5, "repeticiones": 4, "ts": 1700000000.25},
+        ],
+        "525401000700000000000040fc54d9410200"
+        "000000002d00030001"
+        "fa000000fbff040000",
+    ),
+    (
+        "sin hora y valores en el límite",
+        300,
+        [{"activo": True, "grados_actuales": 90, "repeticiones": 65535, "ts": None}],
+        "525401002c01000000000000000000000100"
+        "000000005a00ffff01",
+    ),
+    (
+        "lote vacío",
+        1,
+        [],
+        "525401000100000000000000000000000000",
+    ),
+]
+
+
+class ProtocoloTests(SimpleTestCase):
+    def test_codificar_vectores(self):
+        for nombre, maquina_id, muestras, esperado in VECTORES:
+            with self.subTest(nombre):
+                self.assertEqual(protocolo.codificar(maquina_id, muestras).hex(), esperado)
+
+    def test_decodificar_vectores(self):
+        for nombre, maquina_id, muestras, hexa in VECTORES:
+            with self.subTest(nombre):
+                self.assertEqual(protocolo.decodificar(bytes.fromhex(hexa)), (maquina_id, muestras))
+
+    def test_tamano(self):
+        muestras = [{"activo": True, "grados_actuales": i, "repeticiones": i, "ts": 1.0 + i} for i in range(50)]
+        self.assertEqual(len(protocolo.codificar(1, muestras)), 18 + 9 * 50)
+
+    def test_cuerpos_invalidos(self):
+        valido = bytes.fromhex(VECTORES[0][3])
+        casos = {
+            "corto": valido[:10],
+            "magia": b"XX" + valido[2:],
+            "version": valido[:2] + b"\x02" + valido[3:],
+            "truncado": valido[:-1],
+            "sobrante": valido + b"\x00",
+        }
+        for nombre, cuerpo in casos.items():
+            with self.subTest(nombre):
+                with self.assertRaises(ValueError):
+                    protocolo.decodificar(cuerpo)
+        with self.assertRaises(ValueError):
+            protocolo.decodificar(valido, maximo=1)
+
+
+class RecibirBinarioTests(TestCase):
+    def setUp(self):
+        self.maquina = Maquinas.objects.create(numero="esp-bin", ip="0.0.0.0")
+
+    def _post(self, ruta, cuerpo, **extra):
+        return self.client.post(
+            ruta, cuerpo, content_type=protocolo.TIPO_CONTENIDO,
+            HTTP_AUTHORIZATION=f"Token {settings.ESP32_API_TOKEN}", **extra,
+        )
+
+    def test_lote_binario(self):
+        muestras = [
+            {"activo": True, "grados_actuales": 10 * i, "repeticiones": i, "ts": 1700000000.0 + i}
+            for i in range(5)
+        ]
+        respuesta = self._post("/recibir_datos_esp/lote/", protocolo.codificar(self.maquina.pk, muestras))
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()["recibidas"], 5)
+
+        buffer_telemetria.vaciar()
+        self.assertEqual(
+            list(TelemetriaMaquina.objects.filter(maquina=self.maquina).order_by("ts").values_list("grados", flat=True)),
+            [0, 10, 20, 30, 40],
+        )
+        self.maquina.estadomaquina.refresh_from_db()
+        self.assertEqual(self.maquina.estadomaquina.grados_actuales, 40)
+
+    def test_acuse_binario(self):
+        cuerpo = protocolo.codificar(self.maquina.pk, [{"activo": True, "grados_actuales": 5, "repeticiones": 1}])
+        respuesta = self._post("/recibir_datos_esp/", cuerpo, HTTP_ACCEPT=protocolo.TIPO_CONTENIDO)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.content, protocolo.acuse(1))
+        buffer_telemetria.vaciar()
+
+    def test_maquina_desconocida(self):
+        cuerpo = protocolo.codificar(self.maquina.pk + 1000, [])
+        self.assertEqual(self._post("/recibir_datos_esp/", cuerpo).status_code, 404)
+
+
+class LoteTelemetriaTests(TestCase):
+    def _post(self, cuerpo, **cabeceras):
+        return self.client.post(
+            "/recibir_datos_esp/lote/", cuerpo, content_type="application/json",
+            HTTP_AUTHORIZATION=f"Token {settings.ESP32_API_TOKEN}", **cabeceras,
+        )
+
+    def test_lote_gzip_de_varias_maquinas(self):
+        cuerpo = gzip.compress(json.dumps({"nombre": "esp-lote-a", "muestras": [
+            {"ts": 1700000000.0, "grados_actuales": 10, "repeticiones": 1, "activo": True},
+            {"ts": 1700000001.0, "grados_actuales": 20, "repeticiones": 2, "activo": True},
+            {"ts": 1700000001.0, "grados_actuales": 5, "repeticiones": 7, "nombre": "esp-lote-b"},
+            {"ts": 1700000002.0, "grados_actuales": "mucho"},
+        ]}).encode())
+        datos = self._post(cuerpo, HTTP_CONTENT_ENCODING="gzip").json()
+        self.assertEqual((datos["recibidas"], datos["rechazadas"]), (3, 1))
+        self.assertEqual([a["ok"] for a in datos["acuses"]], [True, True, True, False])
+        # El estado guardado es el de la última muestra de cada máquina
+        self.assertEqual(
+            dict(EstadoMaquina.objects.values_list("maquina__numero", "grados_actuales")),
+            {"esp-lote-a": 20, "esp-lote-b": 5},
+        )
+        buffer_telemetria.vaciar()
+        self.assertEqual(TelemetriaMaquina.objects.filter(maquina__numero="esp-lote-a").count(), 2)
+
+    @override_settings(LOTE_MAX_MUESTRAS=2)
+    def test_cuerpos_invalidos(self):
+        self.assertEqual(self._post(b"no es gzip", HTTP_CONTENT_ENCODING="gzip").status_code, 400)
+        self.assertEqual(self._post(gzip.compress(b"[{")[:-4], HTTP_CONTENT_ENCODING="gzip").status_code, 400)
+        self.assertEqual(self._post({"nombre": "esp-lote-a"}).status_code, 400)
+        self.assertEqual(self._post({"nombre": "esp-lote-a", "muestras": [{}] * 3}).status_code, 413)
+
+
+# -------------------------------
+# Resumen de máquinas
+# -------------------------------
+
+class ResumenMaquinasTests(TestCase):
+    def setUp(self):
+        for i in range(3):
+            maquina = Maquinas.objects.create(numero=f"esp-resumen-{i}", ip="0.0.0.0")
+            if i:
+                EstadoMaquina.objects.create(maquina=maquina, activo=i == 2, grados_actuales=10 * i)
+
+    def test_una_consulta(self):
+        with self.assertNumQueries(1):
+            maquinas = resumen_maquinas()
+        self.assertEqual([m["grados_actuales"] for m in maquinas], [0, 10, 20])
+        with self.assertNumQueries(1):
+            self.assertEqual([m["numero"] for m in resumen_maquinas(activo=True)], ["esp-resumen-2"])
+
+    def test_etag_y_304(self):
+        self.client.force_login(Usuario.objects.create(username="doctora", nombre="Doctora", rol="doctor"))
+        respuesta = self.client.get("/maquinas_estado/")
+        etag = respuesta["ETag"]
+        respuesta = self.client.get("/maquinas_estado/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((respuesta.status_code, respuesta.content), (304, b""))
+
+        EstadoMaquina.objects.filter(maquina__numero="esp-resumen-1").update(grados_actuales=45)
+        respuesta = self.client.get("/maquinas_estado/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertNotEqual(respuesta["ETag"], etag)
+
+
+class RegistroMaquinasTests(TestCase):
+    def setUp(self):
+        self.registro = RegistroMaquinas(capacidad=2)
+        self.maquinas = [Maquinas.objects.create(numero=f"esp-registro-{i}", ip="10.0.0.1") for i in range(3)]
+
+    def test_precarga_y_aciertos_sin_consultas(self):
+        with self.assertNumQueries(1):
+            entrada = self.registro.obtener("esp-registro-2")   # precarga las 2 más nuevas
+        self.assertEqual(entrada.instancia().pk, self.maquinas[2].pk)
+        with self.assertNumQueries(0):
+            self.registro.obtener("esp-registro-1")
+            self.registro.por_id(self.maquinas[2].pk)
+
+    def test_lru_e_invalidacion(self):
+        self.registro.obtener("esp-registro-2")
+        with self.assertNumQueries(1):
+            self.registro.obtener("esp-registro-0")   # fallo: desaloja la menos usada (esp-registro-1)
+        with self.assertNumQueries(1):
+            self.registro.obtener("esp-registro-1")
+        self.assertIsNone(self.registro.obtener("no-existe"))
+
+        # Un cambio guardado invalida la entrada en la caché compartida
+        registro_maquinas.obtener("esp-registro-0")
+        maquina = self.maquinas[0]
+        maquina.ip = "10.0.0.9"
+        maquina.save()
+        self.assertEqual(registro_maquinas.obtener("esp-registro-0").ip, "10.0.0.9")
+
+
+# -------------------------------
+# Telemetría: validación y buffer write-behind
+# -------------------------------
+
+class LeerMuestraTests(SimpleTestCase):
+    def test_rangos(self):
+        self.assertEqual(leer_muestra({"nombre": "m", "grados_actuales": -5, "repeticiones": 0})["grados_actuales"], -5)
+        for invalida in (
+            {"repeticiones": -1},
+            {"grados_actuales": 40000},
+            {"grados_actuales": "x"},
+            {"ts": "nan"},
+        ):
+            with self.subTest(invalida):
+                with self.assertRaises(ValueError):
+                    leer_muestra({"nombre": "m", **invalida})
+
+
+class BufferTelemetriaTests(TestCase):
+    def setUp(self):
+        self.maquina = Maquinas.objects.create(numero="esp-buffer", ip="0.0.0.0")
+        self.buffer = BufferTelemetria(max_muestras=1000)
+
+    def _agregar(self, repeticiones):
+        muestra = {"activo": True, "grados_actuales": 10, "repeticiones": repeticiones, "ts": 1700000000.0 + len(self.buffer)}
+        self.buffer.agregar(self.maquina.pk, muestra)
+
+    def test_vaciar(self):
+        for i in range(5):
+            self._agregar(i)
+        self.assertEqual(self.buffer.vaciar(), 5)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(TelemetriaMaquina.objects.filter(maquina=self.maquina).count(), 5)
+
+    def test_fila_invalida_no_bloquea_el_resto(self):
+        for i in range(6):
+            self._agregar(-1 if i == 3 else i)
+        with self.assertLogs("usuarios", "WARNING"):
+            self.assertEqual(self.buffer.vaciar(), 5)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(
+            list(TelemetriaMaquina.objects.filter(maquina=self.maquina).order_by("ts").values_list("repeticiones", flat=True)),
+            [0, 1, 2, 4, 5],
+        )
+
+    def test_muestra_fuera_de_rango_se_rechaza(self):
+        respuesta = self.client.post(
+            "/recibir_datos_esp/", {"nombre": "esp-buffer", "grados_actuales": 10, "repeticiones": -1},
+            content_type="application/json", HTTP_AUTHORIZATION=f"Token {settings.ESP32_API_TOKEN}",
+        )
+        self.assertEqual(respuesta.status_code, 400)
+        respuesta = self.client.post(
+            "/recibir_datos_esp/lote/", {"nombre": "esp-buffer", "muestras": [{"repeticiones": 1}, {"repeticiones": -1}]},
+            content_type="application/json", HTTP_AUTHORIZATION=f"Token {settings.ESP32_API_TOKEN}",
+        )
+        self.assertEqual((respuesta.json()["recibidas"], respuesta.json()["rechazadas"]), (1, 1))
+        buffer_telemetria.vaciar()
+
+    def test_serie_acota_la_cola_sin_compactar(self):
+        for i in range(6):
+            self._agregar(i)
+        self.buffer.vaciar()
+        ahora = time.time()
+        TelemetriaMaquina.objects.update(ts=ahora - 30)
+
+        nivel, puntos = compactacion.serie(self.maquina.pk, ahora - 60, ahora, 1, limite=4)
+        self.assertEqual(nivel.nombre, "segundo")
+        self.assertEqual(sum(p["muestras"] for p in puntos), 4)
+
+        compactacion.compactar()
+        nivel, puntos = compactacion.serie(self.maquina.pk, ahora - 60, ahora, 1, limite=4)
+        self.assertEqual(sum(p["muestras"] for p in puntos), 6)
+
+
+    def test_grafica_corta_con_demasiadas_crudas_usa_el_nivel_por_segundo(self):
+        inicio = int(time.time()) - 30
+        TelemetriaMaquina.objects.bulk_create([
+            TelemetriaMaquina(maquina=self.maquina, ts=inicio + i, grados=i, repeticiones=0) for i in range(8)
+        ])
+        compactacion.compactar()
+        with mock.patch.object(graficas, "MAX_CRUDAS", 5):
+            nivel, puntos = graficas.grafica_grados(self.maquina.pk, inicio, inicio + 60, 800)
+        self.assertEqual(nivel.nombre, "segundo")
+        self.assertEqual(puntos[-1], (inicio + 7, 7))
+
+        nivel, puntos = graficas.grafica_grados(self.maquina.pk, inicio, inicio + 60, 800)
+        self.assertEqual((nivel.nombre, len(puntos)), ("crudo", 8))
+
+
+@skipUnless(analisis.disponible(), "requiere numpy")
+class AnalisisSesionTests(SimpleTestCase):
+    PERIODO = 4.0
+
+    def _serie(self, repeticiones, ruido=0.0):
+        import numpy as np
+        t = np.arange(0, repeticiones * self.PERIODO + 1e-9, 0.05)   # 20 Hz
+        grados = 45 - 45 * np.cos(2 * np.pi * t / self.PERIODO)      # de 0 a 90 grados y vuelta
+        return t, grados + np.random.default_rng(0).normal(0, ruido, len(t))
+
+    def test_senoidal(self):
+        resultado = analisis.analizar(*self._serie(6))
+        self.assertEqual(len(resultado["repeticiones"]), 6)
+        self.assertAlmostEqual(resultado["resumen"]["rom_medio"], 90, delta=1)
+        self.assertAlmostEqual(resultado["resumen"]["indice_fatiga"], 0, delta=0.01)
+
+    def test_ruido_no_agrega_repeticiones(self):
+        resultado = analisis.analizar(*self._serie(6, ruido=2.0))
+        self.assertEqual(len(resultado["repeticiones"]), 6)
+        self.assertAlmostEqual(resultado["resumen"]["rom_medio"], 90, delta=3)
+
+    def test_senal_plana(self):
+        t, limpia = self._serie(6)
+        temblor = self._serie(6, ruido=1.0)[1] - limpia
+        for grados in (30 + 0 * t, 30 + temblor):   # quieta, y quieta con temblor de ~1 grado
+            resultado = analisis.analizar(t, grados)
+            self.assertEqual((resultado["repeticiones"], resultado["resumen"]), ([], None))
+
+
+# -------------------------------
+# Cola de comandos con reclamo atómico
+# -------------------------------
+
+class ColaComandosTests(TestCase):
+    def setUp(self):
+        self.maquina = Maquinas.objects.create(numero="esp-cola", ip="0.0.0.0")
+
+    def test_un_comando_se_reclama_una_sola_vez(self):
+        cola.encolar(self.maquina, "iniciar", grados=30, repeticiones=5)
+        token, comandos = cola.reclamar(self.maquina.pk)
+        self.assertEqual([c.accion for c in comandos], ["iniciar"])
+        # Un segundo sondeo, mientras el primero no confirma, no recibe el mismo comando
+        self.assertEqual(cola.reclamar(self.maquina.pk), (None, []))
+        self.assertEqual(cola.confirmar(token, self.maquina.pk), 1)
+        self.assertEqual(cola.reclamar(self.maquina.pk, visibilidad=0), (None, []))
+
+    def test_reclamo_sin_confirmar_vuelve_a_la_cola(self):
+        cola.encolar(self.maquina, "iniciar")
+        primer_token, _ = cola.reclamar(self.maquina.pk)
+        futuro = time.time() + cola._visibilidad() + 1
+        with mock.patch("usuarios.cola.time.time", return_value=futuro):
+            token, comandos = cola.reclamar(self.maquina.pk)
+        self.assertEqual(len(comandos), 1)
+        self.assertNotEqual(token, primer_token)
+        self.assertEqual(comandos[0].intentos, 2)
+        # El token viejo ya no confirma nada
+        self.assertEqual(cola.confirmar(primer_token, self.maquina.pk), 0)
+
+    def test_orden_y_limite(self):
+        for accion in ("iniciar", "pausar", "continuar"):
+            cola.encolar(self.maquina, accion)
+        _, comandos = cola.reclamar(self.maquina.pk, limite=2)
+        self.assertEqual([c.accion for c in comandos], ["iniciar", "pausar"])
+
+    def test_descartar_vencidos(self):
+        vencido = cola.encolar(self.maquina, "iniciar", ttl=1)
+        agotado = cola.encolar(self.maquina, "pausar")
+        vigente = cola.encolar(self.maquina, "continuar")
+        ComandoMaquina.objects.filter(pk=agotado.pk).update(
+            intentos=cola._max_intentos(), timestamp_reclamo=time.time() - cola._visibilidad() - 1
+        )
+        with mock.patch("usuarios.cola.time.time", return_value=time.time() + 2):
+            self.assertEqual(cola.descartar_vencidos(), 2)
+        self.assertEqual(
+            set(ComandoMaquina.objects.filter(descartado=True).values_list("pk", flat=True)), {vencido.pk, agotado.pk}
+        )
+        self.assertFalse(ComandoMaquina.objects.get(pk=vigente.pk).ejecutado)
+
+    def test_comando_esp_no_consume_otros_comandos(self):
+        """La ruta heredada solo confirma el comando que entrega, no toda la cola."""
+        otro = cola.encolar(self.maquina, "detener")
+        self.client.post(
+            "/recibir_datos/", {"maquina": "esp-cola", "accion": "iniciar", "grados": 45, "repeticiones": 8},
+            content_type="application/json",
+        )
+        respuesta = self.client.get("/comando_esp/?maquina=esp-cola")
+        self.assertEqual(respuesta.json()["accion"], "iniciar")
+        entregado = ComandoMaquina.objects.get(maquina=self.maquina, grados=45)
+        self.assertTrue(entregado.ejecutado)
+        otro.refresh_from_db()
+        self.assertFalse(otro.ejecutado)
+        _, comandos = cola.reclamar(self.maquina.pk)
+        self.assertEqual([c.pk for c in comandos], [otro.pk])
+
+
+class EnvioComandosTests(TestCase):
+    def test_estado_del_envio_por_maquina(self):
+        maquinas = [Maquinas.objects.create(numero=f"esp-envio-{i}", ip="0.0.0.0") for i in range(3)]
+        envio = cola.encolar_envio([(m.pk, m.numero) for m in maquinas], "detener")
+
+        token, _ = cola.reclamar(maquinas[0].pk)
+        cola.confirmar(token, maquinas[0].pk)
+        cola.reclamar(maquinas[1].pk)
+
+        estado = cola.estado_envio(envio.pk)
+        self.assertEqual(estado["resumen"], {"ejecutados": 1, "descartados": 0, "entregados": 1, "pendientes": 1})
+        self.assertEqual([m["estado"] for m in estado["maquinas"]], ["ejecutado", "entregado", "pendiente"])
+
+
+# -------------------------------
+# Ciclo de vida de SesionTerapia
+# -------------------------------
+
+class SesionesTests(TestCase):
+    def setUp(self):
+        self.maquina = Maquinas.objects.create(numero="esp-sesion", ip="0.0.0.0")
+        self.paciente = Usuario.objects.create_user(username="pac-sesion", password="x", rol="paciente", nombre="Pac")
+        self.addCleanup(gestor_sesiones.limpiar)
+
+    def _recibir(self, accion, **extra):
+        self.client.post(
+            "/recibir_datos/", {"maquina": "esp-sesion", "accion": accion, "paciente": self.paciente.pk, **extra},
+            content_type="application/json",
+        )
+
+    def _muestra(self, repeticiones, grados):
+        self.client.post(
+            "/recibir_datos_esp/", {"nombre": "esp-sesion", "activo": True, "grados_actuales": grados, "repeticiones": repeticiones},
+            content_type="application/json", HTTP_AUTHORIZATION=f"Token {settings.ESP32_API_TOKEN}",
+        )
+
+    def test_controlar_sesion_abre_y_detener_cierra(self):
+        self._recibir("iniciar", grados=60, repeticiones=3)
+        self.client.get("/controlar_sesion/?numero=esp-sesion")
+        sesion = SesionTerapia.objects.get(maquina=self.maquina)
+        self.assertEqual((sesion.usuario_id, sesion.repeticiones_objetivo, sesion.fecha_fin), (self.paciente.pk, 3, None))
+
+        for repeticiones, grados in ((0, 10), (2, 55), (3, 62)):
+            self._muestra(repeticiones, grados)
+        buffer_telemetria.vaciar()
+        self.assertEqual(TelemetriaMaquina.objects.filter(sesion=sesion).count(), 3)
+
+        self._recibir("detener", grados=0, repeticiones=0)
+        self.client.get("/controlar_sesion/?numero=esp-sesion")
+        sesion.refresh_from_db()
+        self.assertIsNotNone(sesion.fecha_fin)
+        self.assertEqual((sesion.repeticiones_completadas, sesion.grados_alcanzados, sesion.completada), (3, 62, True))
+
+    def test_comando_esp_abre_la_sesion(self):
+        """La ruta heredada /comando_esp/ también abre la sesión del comando que entrega."""
+        self._recibir("iniciar", grados=45, repeticiones=10)
+        self.assertEqual(self.client.get("/comando_esp/?maquina=esp-sesion").json()["accion"], "iniciar")
+        sesion = SesionTerapia.objects.get(maquina=self.maquina)
+        self.assertEqual(sesion.usuario_id, self.paciente.pk)
+
+        self._muestra(1, 40)
+        buffer_telemetria.vaciar()
+        self.assertEqual(TelemetriaMaquina.objects.get(maquina=self.maquina).sesion_id, sesion.pk)
+
+
+# -------------------------------
+# Pacientes: listado paginado e importación
+# -------------------------------
+
+class ListaPacientesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(Usuario.objects.create(username="doctora", nombre="Doctora", rol="doctor"))
+        # Nombres repetidos: el cursor es el id, no el nombre
+        self.anas = [Usuario.objects.create(username=f"ana_{i}", nombre="Ana", rol="paciente").pk for i in range(5)]
+        self.betos = [Usuario.objects.create(username=f"beto_{i}", nombre="Beto", rol="paciente").pk for i in range(2)]
+
+    def _pagina(self, **params):
+        return self.client.get("/api/pacientes/", params)
+
+    def test_paginas_sin_huecos_ni_repetidos(self):
+        vistos, despues = [], 0
+        while True:
+            datos = self._pagina(despues=despues, limite=2, q="an").json()
+            self.assertEqual(datos["total"], 5)
+            vistos += [p["id"] for p in datos["pacientes"]]
+            if datos["siguiente"] is None:
+                break
+            despues = datos["siguiente"]
+        self.assertEqual(vistos, self.anas)
+
+    def test_cursor_con_busqueda(self):
+        datos = self._pagina(despues=self.anas[2], q="BETO").json()
+        self.assertEqual([p["id"] for p in datos["pacientes"]], self.betos)
+        datos = self._pagina(despues=self.betos[0], q="ana").json()
+        self.assertEqual((datos["pacientes"], datos["siguiente"]), ([], None))
+
+    def test_cursor_invalido(self):
+        self.assertEqual(self._pagina(despues="abc").status_code, 400)
+        self.assertEqual(self._pagina(despues="1;DROP").status_code, 400)
+        self.assertEqual(self._pagina(limite="x").status_code, 400)
+        self.assertEqual(self._pagina(fields="id,password").status_code, 400)
+        self.assertEqual(self._pagina(despues=10 ** 9).json()["pacientes"], [])
+        # Un cursor negativo equivale a empezar desde el principio
+        self.assertEqual(len(self._pagina(despues=-5).json()["pacientes"]), 7)
+
+
+class AltaPacientesTests(TestCase):
+    def test_usernames_existentes_y_repetidos_en_el_lote(self):
+        for username in ("ana", "ana_2", "anabel"):
+            Usuario.objects.create(username=username, nombre="Ana", rol="paciente")
+        self.assertEqual(
+            pacientes.asignar_usernames(["Ana", "Luis", "ana", "Luis", "Ana Bel"]),
+            ["ana_3", "luis", "ana_4", "luis_1", "ana_bel"],
+        )
+        contadores = dict(ContadorUsername.objects.values_list("base", "siguiente"))
+        self.assertEqual(contadores, {"ana": 5, "luis": 2, "ana_bel": 1})
+
+    def test_username_creado_por_otra_via_se_salta(self):
+        self.assertEqual(pacientes.asignar_usernames(["Pepe"]), ["pepe"])
+        # Altas fuera de asignar_usernames (admin, shell) no mueven el contador
+        Usuario.objects.create(username="pepe_1", nombre="Pepe", rol="paciente")
+        self.assertEqual(pacientes.asignar_usernames(["Pepe"]), ["pepe_2"])
+
+    def test_importar_bloque_fallido_no_deja_rastro(self):
+        filas = [{"nombre": "Ana"}, {"nombre": ""}, {"nombre": "Ana"}, {"nombre": "Zoe"}, {"nombre": "Zoe"}]
+        bulk_create = Usuario.objects.bulk_create
+        llamadas = []
+
+        def falla_el_segundo(objetos, *args, **kwargs):
+            llamadas.append(len(objetos))
+            if len(llamadas) == 2:
+                raise IntegrityError("fallo simulado")
+            return bulk_create(objetos, *args, **kwargs)
+
+        with mock.patch.object(Usuario.objects, "bulk_create", side_effect=falla_el_segundo):
+            with self.assertRaises(IntegrityError):
+                pacientes.importar(filas, chunk=2)
+        self.assertEqual(sorted(Usuario.objects.values_list("username", flat=True)), ["ana", "ana_1"])
+        # El bloque fallido revierte también sus contadores
+        self.assertFalse(ContadorUsername.objects.filter(base="zoe").exists())
+
+        resultado = pacientes.importar(filas[3:], chunk=2)
+        self.assertEqual((resultado["creados"], resultado["errores"]), (2, []))
+        self.assertEqual(pacientes.importar(filas[1:2])["errores"][0]["fila"], 1)
+
+
+# -------------------------------
+# Analítica por paciente
+# -------------------------------
+
+class AnaliticaPacienteTests(TestCase):
+    def setUp(self):
+        self.paciente = Usuario.objects.create(username="paciente-analitica", nombre="Paciente", rol="paciente")
+        self.maquina = Maquinas.objects.create(numero="esp-analitica", ip="0.0.0.0")
+
+    def _sesion(self, **campos):
+        return SesionTerapia.objects.create(
+            maquina=self.maquina, usuario=self.paciente, grados_objetivo=90, repeticiones_objetivo=10, **campos
+        )
+
+    def test_agregados_al_cerrar(self):
+        self._sesion(completada=True, repeticiones_completadas=10, grados_alcanzados=60)
+        abierta = self._sesion(repeticiones_completadas=3)
+        self._sesion(completada=True, repeticiones_completadas=6, grados_alcanzados=80)
+
+        with self.assertNumQueries(2):
+            datos = analitica.analitica_paciente(self.paciente.pk)
+        totales = datos["totales"]
+        self.assertEqual((totales["sesiones"], totales["repeticiones_completadas"]), (2, 16))
+        self.assertEqual((totales["grados_promedio"], totales["grados_max"]), (70.0, 80))
+        self.assertEqual(totales["adherencia_repeticiones"], 0.8)
+        self.assertEqual(datos["semanas"][0]["sesiones"], 2)
+
+        # Volver a guardar una sesión cerrada no la cuenta dos veces; cerrar la abierta sí suma
+        abierta.save()
+        abierta.completada = True
+        abierta.save()
+        abierta.save()
+        self.assertEqual(analitica.analitica_paciente(self.paciente.pk)["totales"]["sesiones"], 3)
+
+        # Reconstruir desde SesionTerapia da lo mismo que los incrementos
+        incremental = analitica.analitica_paciente(self.paciente.pk)
+        analitica.recalcular([self.paciente.pk])
+        self.assertEqual(analitica.analitica_paciente(self.paciente.pk), incremental)
+
+
+class ExportacionTests(TestCase):
+    def setUp(self):
+        self.client.force_login(Usuario.objects.create(username="doctora", nombre="Doctora", rol="doctor"))
+        self.ana = Usuario.objects.create(username="ana", nombre="Ana", rol="paciente")
+        self.beto = Usuario.objects.create(username="beto", nombre="Beto, hijo", rol="paciente")
+        uno, dos = (Maquinas.objects.create(numero=f"esp-exp-{i}", ip="0.0.0.0") for i in (1, 2))
+        for usuario, maquina, dia in ((self.ana, uno, 1), (self.ana, dos, 2), (self.beto, dos, 3)):
+            sesion = SesionTerapia.objects.create(
+                maquina=maquina, usuario=usuario, grados_objetivo=90, repeticiones_objetivo=10
+            )
+            SesionTerapia.objects.filter(pk=sesion.pk).update(
+                fecha_inicio=timezone.make_aware(datetime.datetime(2026, 3, dia, 10))
+            )
+
+    def _exportar(self, tipo, **params):
+        respuesta = self.client.get(f"/api/{tipo}/exportar/", params)
+        return respuesta, b"".join(respuesta.streaming_content).decode() if respuesta.streaming else None
+
+    def test_sesiones_ndjson_por_fecha_y_maquina(self):
+        # Una fecha sola en "hasta" incluye ese día entero
+        _, cuerpo = self._exportar(
+            "sesiones", formato="ndjson", maquina="esp-exp-2", desde="2026-03-02", hasta="2026-03-02"
+        )
+        filas = [json.loads(linea) for linea in cuerpo.splitlines()]
+        self.assertEqual([(f["usuario_id"], f["maquina_numero"]) for f in filas], [(self.ana.pk, "esp-exp-2")])
+        _, cuerpo = self._exportar("sesiones", formato="ndjson", paciente=self.beto.pk)
+        self.assertEqual(len(cuerpo.splitlines()), 1)
+
+    def test_pacientes_csv_por_maquina(self):
+        respuesta, cuerpo = self._exportar("pacientes", maquina="esp-exp-2")
+        self.assertEqual(respuesta["Content-Disposition"], 'attachment; filename="pacientes.csv"')
+        filas = list(csv.DictReader(io.StringIO(cuerpo)))
+        self.assertEqual([f["nombre"] for f in filas], ["Ana", "Beto, hijo"])
+        _, cuerpo = self._exportar("pacientes", maquina="esp-exp-1")
+        self.assertEqual(len(cuerpo.splitlines()), 2)   # cabecera + Ana
+
+    def test_filtros_invalidos(self):
+        self.assertEqual(self._exportar("sesiones", formato="xml")[0].status_code, 400)
+        self.assertEqual(self._exportar("sesiones", desde="ayer")[0].status_code, 400)
+        self.assertEqual(self._exportar("sesiones", hasta="2026-13-02")[0].status_code, 400)
+        self.assertEqual(self._exportar("sesiones", paciente="x")[0].status_code, 400)
+
+
+# -------------------------------
+# Programas de terapia
+# -------------------------------
+
+class ProgramasTests(TestCase):
+    def setUp(self):
+        self.maquina = Maquinas.objects.create(numero="esp-programa", ip="0.0.0.0")
+        programa, errores = programas.crear("rutina", [
+            {"grados": 60, "repeticiones": 10, "series": 2, "descanso": 30},
+            {"grados": 90, "repeticiones": 5},
+        ])
+        self.assertEqual(errores, [])
+        self.ejecucion = programas.enviar(programa, self.maquina)
+
+    def _informar(self, **evento):
+        return self.client.post(
+            "/progreso_programa/", {"nombre": self.maquina.numero, "comando": self.ejecucion.comando_id, **evento},
+            content_type="application/json", HTTP_AUTHORIZATION=f"Token {settings.ESP32_API_TOKEN}",
+        )
+
+    def test_plan_desplegado(self):
+        plan = self.ejecucion.comando.plan
+        self.assertEqual([(p["grados"], p["descanso"]) for p in plan["pasos"]], [(60, 30), (60, 30), (90, 0)])
+        self.assertEqual((plan["repeticiones"], plan["grados_max"]), (25, 90))
+
+    def test_avance_hasta_completar(self):
+        self.assertEqual(self._informar(i=0, estado="iniciado").json()["estado"], "en_curso")
+        respuesta = self._informar(eventos=[
+            {"i": 0, "estado": "completado", "repeticiones": 10},
+            {"i": 1, "estado": "completado", "repeticiones": 10},
+            {"i": 2, "estado": "completado", "repeticiones": 5},
+        ])
+        self.assertEqual(respuesta.json(), {"status": "ok", "estado": "completada", "paso_actual": 2})
+        self.assertEqual(self._informar(i=5, estado="completado").status_code, 200)   # ya terminada: se ignora
+        self.assertEqual(programas.resumen(EjecucionPrograma.objects.get(pk=self.ejecucion.pk))["series_completadas"], 3)
+
+    def test_evento_invalido(self):
+        self.assertEqual(self._informar(i=7, estado="completado").status_code, 400)
+
+
+# -------------------------------
+# Bus de eventos y stream de estado
+# -------------------------------
+
+@override_settings(ESTADO_STREAM_WSGI_DURACION=1)
+class StreamEstadoTests(TestCase):
+    def _enviar(self, **muestra):
+        respuesta = self.client.post(
+            "/recibir_datos_esp/", {"nombre": "esp-stream", **muestra},
+            content_type="application/json", HTTP_AUTHORIZATION=f"Token {settings.ESP32_API_TOKEN}",
+        )
+        self.assertEqual(respuesta.status_code, 200)
+
+    @staticmethod
+    def _leer(evento):
+        campos = dict(linea.split(": ", 1) for linea in evento.decode().strip().split("\n"))
+        return campos.get("id"), campos["event"], json.loads(campos["data"])
+
+    def test_snapshot_deltas_y_reanudar(self):
+        self._enviar(grados_actuales=10, repeticiones=1, activo=True)
+        eventos = iter(self.client.get("/stream_estado/?numero=esp-stream").streaming_content)
+        self.assertTrue(next(eventos).startswith(b"retry:"))
+        _, tipo, snapshot = self._leer(next(eventos))
+        self.assertEqual((tipo, snapshot["grados_actuales"]), ("estado", 10))
+
+        # Solo viaja lo que cambió; repetir la misma muestra no genera eventos
+        self._enviar(grados_actuales=35, repeticiones=1, activo=True)
+        id_delta, tipo, delta = self._leer(next(eventos))
+        self.assertEqual(tipo, "delta")
+        self.assertEqual(delta["grados_actuales"], 35)
+        self.assertNotIn("repeticiones", delta)
+        self._enviar(grados_actuales=35, repeticiones=1, activo=True)
+        self.assertEqual(list(eventos), [])
+
+        # Al reconectar con Last-Event-ID se reanuda con deltas, sin snapshot
+        eventos = iter(self.client.get(
+            "/stream_estado/?numero=esp-stream", HTTP_LAST_EVENT_ID=str(int(id_delta) - 1)
+        ).streaming_content)
+        next(eventos)
+        self.assertEqual(self._leer(next(eventos)), (id_delta, "delta", delta))
+
+
+class AlmacenEstadoTests(SimpleTestCase):
+    def _almacenes(self):
+        yield AlmacenMemoria()
+        if fakeredis is not None:
+            with mock.patch("redis.Redis.from_url", return_value=fakeredis.FakeRedis()):
+                yield AlmacenRedis(prefijo="prueba")
+
+    def test_contrato(self):
+        for almacen in self._almacenes():
+            with self.subTest(almacen.__class__.__name__):
+                self.assertIsNone(almacen.obtener("esp-a"))
+                self.assertEqual(almacen.inicializar("esp-a", {"grados_actuales": 0}), {"grados_actuales": 0})
+                # Con estado ya guardado inicializar no pisa nada
+                self.assertEqual(almacen.inicializar("esp-a", {"grados_actuales": 99}), {"grados_actuales": 0})
+
+                anterior, nuevo = almacen.actualizar("esp-a", {"activo": True})
+                self.assertEqual((anterior, nuevo), ({"grados_actuales": 0}, {"grados_actuales": 0, "activo": True}))
+                self.assertEqual(almacen.actualizar("esp-a", {"modo": "x"}, reemplazar=True)[1], {"modo": "x"})
+                self.assertEqual(almacen.obtener("esp-a"), {"modo": "x"})
+                almacen.actualizar("esp-b", {"activo": False})
+                self.assertEqual(almacen.todos(), {"esp-a": {"modo": "x"}, "esp-b": {"activo": False}})
+
+                almacen.limpiar()
+                self.assertEqual(almacen.todos(), {})
+
+    def test_actualizaciones_concurrentes_no_se_pisan(self):
+        for almacen in self._almacenes():
+            with self.subTest(almacen.__class__.__name__):
+                hilos = [
+                    threading.Thread(target=almacen.actualizar, args=("esp-c", {f"campo{i}": i})) for i in range(20)
+                ]
+                for hilo in hilos:
+                    hilo.start()
+                for hilo in hilos:
+                    hilo.join()
+                self.assertEqual(almacen.obtener("esp-c"), {f"campo{i}": i for i in range(20)})
+
+    def test_conectividad_por_ttl(self):
+        ttl = almacen_estado.ttl_conexion
+        self.assertTrue(conectado_por_tiempo({"ultimo_timestamp": 1000}, ahora=1000 + ttl))
+        self.assertFalse(conectado_por_tiempo({"ultimo_timestamp": 1000}, ahora=1001 + ttl))
+        self.assertFalse(conectado_por_tiempo({}))
+
+
+class BusEventosTests(SimpleTestCase):
+    @skipUnless(fakeredis, "requiere fakeredis")
+    def test_relevo_entre_procesos(self):
+        servidor = fakeredis.FakeServer()
+        origen, destino = (
+            BusEventos(relevo=RelevoRedis(fakeredis.FakeRedis(server=servidor), "eventos")) for _ in range(2)
+        )
+        destino.escuchar()
+        limite = time.monotonic() + 5
+        while not origen.relevo.cliente.pubsub_numsub("eventos")[0][1] and time.monotonic() < limite:
+            time.sleep(0.01)
+
+        origen.publicar("esp-relevo", {"activo": True})
+        while not destino.desde(0) and time.monotonic() < limite:
+            time.sleep(0.01)
+        self.assertEqual([(e.nombre, e.datos) for e in destino.desde(0)], [("esp-relevo", {"activo": True})])
+        self.assertEqual(len(origen.desde(0)), 1)   # no recibe su propio mensaje
+
+
+# -------------------------------
+# Métricas y conectividad
+# -------------------------------
+
+class MetricasTests(TestCase):
+    def test_dispositivo_solo_de_vistas_autenticadas(self):
+        self.client.get("/no-existe/?numero=inventado")
+        self.assertNotIn("inventado", metricas.registro.snapshot()["dispositivos"])
+
+    def test_sondeos_cuentan_por_dispositivo(self):
+        self.client.get("/controlar_sesion/?numero=esp-metricas")
+        self.client.get("/comando_esp/?maquina=esp-metricas")
+        self.assertGreaterEqual(metricas.registro.snapshot()["dispositivos"].get("esp-metricas", 0), 2)
+
+    @override_settings(METRICAS_TOKEN=None)
+    def test_sin_token_solo_localhost(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.5").status_code, 403)
+
+    @override_settings(METRICAS_TOKEN="secreto")
+    def test_con_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secreto").status_code, 200)
+
+    def test_snapshots_vencidos_se_borran(self):
+        with tempfile.TemporaryDirectory() as directorio, override_settings(METRICAS_DIR=directorio):
+            snapshot = metricas.registro.snapshot()
+            snapshot["errores"] = {"prueba": 1}
+            for nombre in ("vivo.json", "muerto.json"):
+                with open(os.path.join(directorio, nombre), "w") as f:
+                    json.dump(snapshot, f)
+            viejo = time.time() - settings.METRICAS_EXPIRA - 1
+            os.utime(os.path.join(directorio, "muerto.json"), (viejo, viejo))
+
+            total = metricas.agregado()
+            self.assertEqual(total["errores"]["prueba"], 1 + metricas.registro.snapshot()["errores"].get("prueba", 0))
+            self.assertEqual(os.listdir(directorio), ["vivo.json"])
+
+
+class ConectividadTests(TestCase):
+    def test_barrer_devuelve_lo_pendiente_si_falla_la_bd(self):
+        monitor = MonitorConectividad(ttl=10)
+        monitor._cargado = True
+        monitor.contacto(1, "esp-barrer", ts=100)
+
+        with mock.patch.object(EstadoMaquina.objects, "filter", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                monitor.barrer(ahora=200)
+        self.assertEqual(monitor._heap, [(110, "esp-barrer")])
+        self.assertTrue(monitor.conectado("esp-barrer"))
+
+        with mock.patch.object(monitor, "_guardar", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                monitor.barrer(ahora=200)
+        self.assertFalse(monitor.conectado("esp-barrer"))
+        self.assertEqual(monitor._transiciones, {1: False})
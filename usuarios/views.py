@@ -1,15 +1,36 @@
-from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
-from .models import Usuario, Maquinas, EstadoMaquina, ComandoMaquina, SesionTerapia
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Lower
+from .models import (
+    Usuario, Maquinas, EstadoMaquina, ComandoMaquina, EnvioComandos, SesionTerapia, ProgramaTerapia, EjecucionPrograma,
+)
+from . import analitica, cola, compactacion, exportacion, graficas, metricas, pacientes, programas, protocolo
+from .estado import almacen_estado
+from .maquinas import resumen_maquinas
+from .eventos import bus_estado, bus_comandos
+from .conectividad import esta_conectada, monitor_conectividad
+from .latidos import latidos
+from .registro import registro_maquinas
+from .sesiones import gestor_sesiones
+from .telemetria import buffer_telemetria, descomprimir, leer_muestra, guardar_lote
 from django.views.decorators.csrf import csrf_exempt
-import json, re
+from asgiref.sync import sync_to_async
+import hashlib, json, logging
 import requests
 import time
 from django.conf import settings
 
+logger = logging.getLogger("usuarios")
+
 # -------------------------------
 # Vistas principales (CON autenticación)
 # -------------------------------
@@ -68,53 +89,244 @@ def gestion_pacientes(request):
         nombre = user.username
     return render(request, "gestion_pacientes.html", {"nombre": nombre})
 
+CAMPOS_PACIENTE = (
+    "id", "username", "nombre", "email", "peso", "altura", "tamano_de_la_pantorrilla", "sesiones",
+    "activacion_muscular", "descripcion_de_la_ultima_sesion",
+)
+CAMPOS_PACIENTE_DEFECTO = ("id", "nombre", "peso", "tamano_de_la_pantorrilla", "sesiones", "altura")
+
+def buscar_pacientes(consulta, texto):
+    """Prefijo de nombre o username sin distinguir mayúsculas, como rango sobre lower(...)
+    para que use los índices funcionales (LIKE no los aprovecha en todos los motores)."""
+    desde = texto.lower()
+    hasta = desde + "\uffff"
+    return consulta.annotate(nombre_min=Lower("nombre"), username_min=Lower("username")).filter(
+        Q(nombre_min__gte=desde, nombre_min__lt=hasta) | Q(username_min__gte=desde, username_min__lt=hasta)
+    )
+
 @login_required
 def lista_pacientes(request):
-    pacientes = list(Usuario.objects.filter(rol='paciente').values(
-        "id", "nombre", "peso", "tamano_de_la_pantorrilla", "sesiones", "altura"
-    ))
-    return JsonResponse(pacientes, safe=False)
+    """Pacientes paginados por id: ?despues=<id>&limite=&q=<prefijo>&fields=id,nombre,...
+
+    Devuelve {"pacientes", "siguiente" (cursor de la próxima página o null), "total"}.
+    """
+    try:
+        despues = int(request.GET.get("despues") or 0)
+        limite = max(1, min(int(request.GET.get("limite", 50)), 200))
+    except ValueError:
+        return JsonResponse({"error": "Parámetros 'despues'/'limite' inválidos"}, status=400)
+    campos = [c for c in request.GET.get("fields", "").split(",") if c] or list(CAMPOS_PACIENTE_DEFECTO)
+    invalidos = set(campos) - set(CAMPOS_PACIENTE)
+    if invalidos:
+        return JsonResponse({"error": f"Campos no permitidos: {', '.join(sorted(invalidos))}"}, status=400)
+    if "id" not in campos:
+        campos.insert(0, "id")
+
+    consulta = Usuario.objects.filter(rol='paciente')
+    texto = request.GET.get("q", "").strip()
+    if texto:
+        consulta = buscar_pacientes(consulta, texto)
+    # Una fila de más para saber si hay otra página sin contar
+    filas = list(consulta.filter(pk__gt=despues).order_by("pk").values(*campos)[:limite + 1])
+    siguiente = filas[limite - 1]["id"] if len(filas) > limite else None
+
+    clave = "pacientes_total:" + hashlib.md5(texto.lower().encode()).hexdigest()
+    total = cache.get_or_set(clave, consulta.count, getattr(settings, "PACIENTES_TOTAL_TTL", 30))
+    return JsonResponse({"pacientes": filas[:limite], "siguiente": siguiente, "total": total})
+
+@login_required
+def exportar_datos(request, tipo):
+    """Descarga en streaming de pacientes o sesiones: ?formato=csv|ndjson, ?desde=, ?hasta=, ?paciente=, ?maquina=."""
+    formato = request.GET.get("formato", "csv")
+    if formato not in exportacion.FORMATOS:
+        return JsonResponse({"error": "Formato inválido (csv o ndjson)"}, status=400)
+    try:
+        filtros = {
+            "desde": exportacion.leer_fecha(request.GET.get("desde")),
+            "hasta": exportacion.leer_fecha(request.GET.get("hasta"), fin=True),
+            "paciente": int(request.GET["paciente"]) if request.GET.get("paciente") else None,
+            "maquina": request.GET.get("maquina") or None,
+        }
+    except ValueError:
+        return JsonResponse({"error": "Filtros inválidos"}, status=400)
+    respuesta = StreamingHttpResponse(
+        exportacion.exportar(tipo, formato, **filtros), content_type=exportacion.FORMATOS[formato]
+    )
+    respuesta["Content-Disposition"] = f'attachment; filename="{tipo}.{formato}"'
+    respuesta["X-Accel-Buffering"] = "no"
+    return respuesta
+
+@login_required
+def analitica_paciente(request, paciente_id):
+    """Progreso del paciente desde los agregados precalculados (tiempo constante)."""
+    if not Usuario.objects.filter(pk=paciente_id, rol='paciente').exists():
+        return JsonResponse({"error": "Paciente no encontrado"}, status=404)
+    try:
+        semanas = max(1, min(int(request.GET.get("semanas", 12)), 104))
+    except ValueError:
+        return JsonResponse({"error": "Parámetro 'semanas' inválido"}, status=400)
+    return JsonResponse(analitica.analitica_paciente(paciente_id, semanas))
+
+@login_required
+def telemetria_maquina(request, numero):
+    """Serie de telemetría de una máquina: ?desde=&hasta= (epoch) y ?resolucion= (segundos)."""
+    entrada = registro_maquinas.obtener(numero)
+    if entrada is None:
+        return JsonResponse({"error": "Máquina no encontrada"}, status=404)
+    try:
+        hasta = float(request.GET.get("hasta") or time.time())
+        desde = float(request.GET.get("desde") or hasta - 3600)
+        maximo = getattr(settings, "TELEMETRIA_SERIE_MAX_PUNTOS", 5000)
+        # Por defecto la resolución que deja la ventana en ~500 puntos
+        resolucion = float(request.GET.get("resolucion") or max(1, (hasta - desde) // 500))
+    except ValueError:
+        return JsonResponse({"error": "Parámetros inválidos"}, status=400)
+    if desde >= hasta or resolucion < 0:
+        return JsonResponse({"error": "Rango inválido"}, status=400)
+    if resolucion and (hasta - desde) / resolucion > maximo:
+        return JsonResponse({"error": f"Demasiados puntos: máximo {maximo}"}, status=400)
+    nivel, puntos = compactacion.serie(entrada.id, desde, hasta, resolucion, limite=maximo)
+    return JsonResponse({
+        "maquina": numero, "desde": desde, "hasta": hasta,
+        "resolucion": resolucion, "nivel": nivel.nombre, "puntos": puntos,
+    })
+
+@login_required
+def analisis_sesion(request, sesion_id):
+    """Métricas por repetición de la sesión (ROM, velocidad, sostén, suavidad, fatiga)."""
+    # Import diferido: NumPy es opcional y pesado, solo lo cargan los procesos que lo usan
+    from . import analisis
+    if not analisis.disponible():
+        return JsonResponse({"error": "Análisis no disponible: falta numpy en el servidor"}, status=503)
+    if not SesionTerapia.objects.filter(pk=sesion_id).exists():
+        return JsonResponse({"error": "Sesión no encontrada"}, status=404)
+    return JsonResponse({"sesion": sesion_id, **analisis.analisis_sesion(sesion_id)})
+
+@login_required
+def grafica_grados(request):
+    """Serie de grados para graficar: ?maquina=<numero> o ?sesion=<id>, ?desde=&hasta= (epoch), ?ancho=<px>.
+
+    Los puntos salen como [t - t0, grados] para que la respuesta pese pocos KB.
+    """
+    try:
+        ancho = max(10, min(int(request.GET.get("ancho", 400)), 2000))
+        if request.GET.get("sesion"):
+            sesion = SesionTerapia.objects.filter(pk=int(request.GET["sesion"])).select_related("maquina").first()
+            if sesion is None:
+                return JsonResponse({"error": "Sesión no encontrada"}, status=404)
+            maquina_id, numero = sesion.maquina_id, sesion.maquina.numero
+            desde = sesion.fecha_inicio.timestamp()
+            hasta = sesion.fecha_fin.timestamp() if sesion.fecha_fin else time.time()
+        else:
+            entrada = registro_maquinas.obtener(request.GET.get("maquina", ""))
+            if entrada is None:
+                return JsonResponse({"error": "Máquina no encontrada"}, status=404)
+            maquina_id, numero = entrada.id, entrada.numero
+            hasta = time.time()
+            desde = hasta - 1800
+        hasta = float(request.GET.get("hasta") or hasta)
+        desde = float(request.GET.get("desde") or desde)
+    except ValueError:
+        return JsonResponse({"error": "Parámetros inválidos"}, status=400)
+    if desde >= hasta:
+        return JsonResponse({"error": "Rango inválido"}, status=400)
+
+    nivel, puntos = graficas.grafica_grados(maquina_id, desde, hasta, ancho)
+    t0 = puntos[0][0] if puntos else desde
+    respuesta = json_con_etag(request, {
+        "maquina": numero, "desde": desde, "hasta": hasta, "nivel": nivel.nombre, "t0": t0,
+        "puntos": [[round(t - t0, 2), round(g, 1)] for t, g in puntos],
+    })
+    # Ventanas pasadas se pueden reutilizar un buen rato; las en vivo, pocos segundos
+    patch_cache_control(respuesta, private=True, max_age=3600 if graficas.es_historica(hasta) else 5)
+    return respuesta
 
 @login_required
 def lista_maquinas(request):
     maquinas = list(Maquinas.objects.values("numero"))
     return JsonResponse(maquinas, safe=False)
 
+def filtro_booleano(request, nombre):
+    """Lee ?nombre=1/0 como True/False; None si no viene."""
+    valor = request.GET.get(nombre)
+    if valor is None or valor == "":
+        return None
+    return valor.lower() in ("1", "true", "si", "sí")
+
+def json_con_etag(request, datos, safe=True):
+    """JsonResponse con ETag; responde 304 si el cliente ya tiene esta versión."""
+    respuesta = JsonResponse(datos, safe=safe)
+    etag = quote_etag(hashlib.md5(respuesta.content).hexdigest())
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        respuesta = HttpResponseNotModified()
+    respuesta["ETag"] = etag
+    return respuesta
+
 @login_required
 def listar_maquinas_estado(request):
-    maquinas = Maquinas.objects.all()
-    resultado = []
-    
-    for maquina in maquinas:
-        estado_memoria = ULTIMO_ESTADO_POR_DISP.get(maquina.numero, {})
-        estado_bd = EstadoMaquina.objects.filter(maquina=maquina).first()
-        
-        tiempo_ahora = time.time()
-        conectado = False
-        
-        if estado_memoria:
-            conectado = (tiempo_ahora - estado_memoria.get("ultimo_timestamp", 0)) <= 60
-        elif estado_bd:
-            conectado = (tiempo_ahora - estado_bd.ultimo_timestamp) <= 60
-        
-        resultado.append({
-            "numero": maquina.numero,
-            "ip": maquina.ip,
-            "conectado": conectado,
-            "activo": estado_memoria.get("activo", estado_bd.activo if estado_bd else False),
-            "grados_actuales": estado_memoria.get("grados_actuales", estado_bd.grados_actuales if estado_bd else 0),
-            "repeticiones": estado_memoria.get("repeticiones", estado_bd.repeticiones if estado_bd else 0),
-        })
-    
-    return JsonResponse({"maquinas": resultado})
+    maquinas = resumen_maquinas(
+        conectado=filtro_booleano(request, "conectado"),
+        activo=filtro_booleano(request, "activo"),
+    )
+    return json_con_etag(request, {"maquinas": maquinas})
 
 # -------------------------------
 # VISTAS DEL ESP32 - SIN AUTENTICACIÓN (CORREGIDAS)
 # -------------------------------
 
-# MEMORIA EN PROCESO
-ULTIMO_ESTADO_POR_DISP = {}
-COMANDOS_PENDIENTES = {}
+# ESTADO EN VIVO (compartido entre procesos, ver usuarios/estado.py)
+
+def estado_en_memoria(nombre):
+    """Devuelve el estado en vivo de la máquina, cargándolo de la BD si hace falta."""
+    estado = almacen_estado.obtener(nombre)
+    if estado is not None:
+        return estado
+
+    # Inicializar desde la BD si no existe
+    entrada = registro_maquinas.obtener(nombre)
+    if entrada is not None:
+        estado_bd = EstadoMaquina.objects.filter(maquina_id=entrada.id).first()
+        if estado_bd:
+            estado = {
+                "nombre": nombre,
+                "activo": estado_bd.activo,
+                "grados_actuales": estado_bd.grados_actuales,
+                "repeticiones": estado_bd.repeticiones,
+                "ultimo_timestamp": estado_bd.ultimo_timestamp or 0,
+                "conectado": estado_bd.conectado
+            }
+        else:
+            estado = {
+                "ultimo_timestamp": 0,
+                "conectado": False,
+                "activo": False,
+                "grados_actuales": 0,
+                "repeticiones": 0,
+                "estado": "sin_datos",
+            }
+    else:
+        estado = {
+            "ultimo_timestamp": 0,
+            "conectado": False,
+            "activo": False,
+            "grados_actuales": 0,
+            "repeticiones": 0,
+            "estado": "maquina_no_registrada",
+        }
+    # Otro proceso pudo inicializarla mientras tanto: gana el que llegó primero
+    return almacen_estado.inicializar(nombre, estado)
+
+def publicar_cambios(nombre, anterior, nuevo):
+    """Publica en el bus solo los campos que cambiaron (sin contar el timestamp).
+
+    Las transiciones de "conectado" las publica conectividad.py.
+    """
+    cambios = {
+        k: v for k, v in nuevo.items()
+        if k not in ("ultimo_timestamp", "conectado") and anterior.get(k) != v
+    }
+    if cambios:
+        bus_estado.publicar(nombre, cambios)
 
 def esp32_authorize(request):
     """Solo verifica token API, NO autenticación de usuario Django"""
@@ -134,113 +346,279 @@ def esp32_authorize(request):
 def recibir_datos_esp(request):
     if request.method != "POST":
         return JsonResponse({"success": False, "error": "Método no permitido"}, status=405)
-    print("Datos crudos:", request.body)
     # Solo verifica token API
     auth = esp32_authorize(request)
     if auth is not True:
         return auth
+    if protocolo.es_binario(request):
+        return _recibir_binario(request)
 
     try:
         data = json.loads(request.body)
     except json.JSONDecodeError:
         return JsonResponse({"success": False, "error": "JSON inválido"}, status=400)
 
-    nombre = data.get("nombre")
-    if not nombre:
-        return JsonResponse({"success": False, "error": "Falta 'nombre' del dispositivo"}, status=400)
-
-    activo = data.get("activo", False)
-    grados_actuales = int(data.get("grados_actuales", 0))
-    repeticiones = int(data.get("repeticiones", 0))
-
-    # Guardar en memoria
-    ULTIMO_ESTADO_POR_DISP[nombre] = {
+    try:
+        muestra = leer_muestra(data)
+    except ValueError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+    nombre = muestra["nombre"]
+    request.dispositivo = nombre
+
+    activo = muestra["activo"]
+    grados_actuales = muestra["grados_actuales"]
+    repeticiones = muestra["repeticiones"]
+
+    # Guardar en el estado en vivo
+    anterior, nuevo_estado = almacen_estado.actualizar(nombre, {
         "nombre": nombre,
         "activo": bool(activo),
         "grados_actuales": grados_actuales,
         "repeticiones": repeticiones,
         "ultimo_timestamp": time.time()
-    }
+    }, reemplazar=True)
+    publicar_cambios(nombre, anterior, nuevo_estado)
 
-    # Guardar en base de datos
+    # Guardar en base de datos (la máquina sale de la caché de registro.py)
+    entrada = None
     try:
-        maquina, created = Maquinas.objects.get_or_create(numero=nombre)
-        estado_maquina, created = EstadoMaquina.objects.get_or_create(
-            maquina=maquina,
-            defaults={
-                'activo': activo,
-                'grados_actuales': grados_actuales,
-                'repeticiones': repeticiones,
-                'ultimo_timestamp': time.time(),
-                'conectado': True
-            }
+        entrada = registro_maquinas.obtener_o_crear(nombre, request.META.get("REMOTE_ADDR"))
+        registro_maquinas.actualizar_estado(
+            entrada,
+            activo=bool(activo),
+            grados_actuales=grados_actuales,
+            repeticiones=repeticiones,
+            ultimo_timestamp=time.time(),
+            conectado=True,
         )
-        if not created:
-            estado_maquina.activo = activo
-            estado_maquina.grados_actuales = grados_actuales
-            estado_maquina.repeticiones = repeticiones
-            estado_maquina.ultimo_timestamp = time.time()
-            estado_maquina.conectado = True
-            estado_maquina.save()
-    except Exception as e:
-        print(f"Error guardando en BD: {e}")
+        monitor_conectividad.contacto(entrada.id, nombre)
+        buffer_telemetria.agregar(entrada.id, muestra)
+    except Exception:
+        metricas.reportar_error("recibir_datos_esp", "Error guardando %s en BD", nombre)
 
     return JsonResponse({
         "status": "ok",
         "nombre": nombre,
-        "nuevo_estado": ULTIMO_ESTADO_POR_DISP[nombre]
+        # id corto para el formato binario (ver protocolo.py)
+        "id": entrada.id if entrada else None,
+        "nuevo_estado": nuevo_estado
     })
 
-# ✅ VISTA CORREGIDA - SIN @login_required
 @csrf_exempt
-def controlar_sesion(request):
-    numero = request.GET.get("numero")  # nombre de la máquina
-    if not numero:
-        return JsonResponse({"error": "Falta numero"}, status=400)
-
-    # 1. Buscar o crear máquina
-    maquina, creada = Maquinas.objects.get_or_create(
-        numero=numero,
-        defaults={"ip": request.META.get("REMOTE_ADDR")}
-    )
+def recibir_datos_esp_lote(request):
+    """Recibe varias muestras (de una o varias máquinas) en un solo POST.
+
+    Cuerpo: {"nombre": "...", "muestras": [{"ts", "activo", "grados_actuales",
+    "repeticiones", "nombre"?}, ...]} o directamente la lista de muestras; puede
+    venir con Content-Encoding: gzip. Responde un acuse por muestra para que la
+    firmware sepa qué descartar de su buffer. También acepta el formato binario
+    de protocolo.py.
+    """
+    if request.method != "POST":
+        return JsonResponse({"success": False, "error": "Método no permitido"}, status=405)
+    auth = esp32_authorize(request)
+    if auth is not True:
+        return auth
+    if protocolo.es_binario(request):
+        return _recibir_binario(request)
 
-    # 2. Buscar o crear estado
-    estado, _ = EstadoMaquina.objects.get_or_create(
-        maquina=maquina,
-        defaults={"conectado": True, "ultimo_timestamp": time.time()}
-    )
+    try:
+        cuerpo = descomprimir(request.body, request.headers.get("Content-Encoding"))
+        data = json.loads(cuerpo)
+    except ValueError:
+        return JsonResponse({"success": False, "error": "Cuerpo inválido"}, status=400)
+
+    nombre_defecto = None
+    if isinstance(data, dict):
+        nombre_defecto = data.get("nombre")
+        data = data.get("muestras")
+    if not isinstance(data, list):
+        return JsonResponse({"success": False, "error": "Falta la lista 'muestras'"}, status=400)
+    maximo = getattr(settings, "LOTE_MAX_MUESTRAS", 1000)
+    if len(data) > maximo:
+        return JsonResponse({"success": False, "error": f"Máximo {maximo} muestras por lote"}, status=413)
+
+    # Validación en una sola pasada
+    muestras, acuses = [], []
+    for i, item in enumerate(data):
+        try:
+            muestras.append(leer_muestra(item, nombre_defecto))
+            acuses.append({"i": i, "ok": True})
+        except ValueError as e:
+            acuses.append({"i": i, "ok": False, "error": str(e)})
 
-    # Marcar como conectada
-    estado.conectado = True
-    estado.ultimo_timestamp = time.time()
-    estado.save()
+    error = _guardar_muestras(request, muestras)
+    if error:
+        return error
 
-    # 3. Buscar comando NO ejecutado más reciente
-    comando = ComandoMaquina.objects.filter(
-        maquina=maquina,
-        ejecutado=False
-    ).order_by("timestamp_creacion").first()
+    return JsonResponse({
+        "status": "ok",
+        "recibidas": len(muestras),
+        "rechazadas": len(acuses) - len(muestras),
+        "acuses": acuses,
+    })
 
-    if comando:
-        print("📤 Enviando comando:", comando.accion)
+def _guardar_muestras(request, muestras):
+    """Persiste un lote validado y actualiza el estado en vivo; devuelve la respuesta de error si falla."""
+    try:
+        ultimas = guardar_lote(muestras, ip=request.META.get("REMOTE_ADDR") or "0.0.0.0")
+    except Exception:
+        metricas.reportar_error("recibir_datos_esp_lote", "Error guardando lote en BD")
+        return JsonResponse({"success": False, "error": "Error guardando el lote"}, status=500)
+
+    # Guardar en memoria y avisar al stream solo con el último estado por máquina
+    ahora = time.time()
+    for nombre, muestra in ultimas.items():
+        anterior, nuevo_estado = almacen_estado.actualizar(nombre, {
+            "nombre": nombre,
+            "activo": muestra["activo"],
+            "grados_actuales": muestra["grados_actuales"],
+            "repeticiones": muestra["repeticiones"],
+            "ultimo_timestamp": ahora
+        }, reemplazar=True)
+        publicar_cambios(nombre, anterior, nuevo_estado)
+    return None
+
+def _recibir_binario(request):
+    """Ingesta en formato binario (ver protocolo.py), para ambas rutas de telemetría."""
+    try:
+        cuerpo = descomprimir(request.body, request.headers.get("Content-Encoding"))
+        maquina_id, muestras = protocolo.decodificar(cuerpo, getattr(settings, "LOTE_MAX_MUESTRAS", 1000))
+    except ValueError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+
+    entrada = registro_maquinas.por_id(maquina_id)
+    if entrada is None:
+        return JsonResponse({"success": False, "error": "Máquina no registrada"}, status=404)
+    nombre = entrada.numero
+    request.dispositivo = nombre
+    for muestra in muestras:
+        muestra["nombre"] = nombre
+
+    error = _guardar_muestras(request, muestras)
+    if error:
+        return error
+    if protocolo.acepta_binario(request):
+        return HttpResponse(protocolo.acuse(len(muestras)), content_type=protocolo.TIPO_CONTENIDO)
+    return JsonResponse({"status": "ok", "recibidas": len(muestras), "rechazadas": 0})
+
+def segundos_espera(request):
+    """Segundos de long-poll pedidos con ?espera=, acotados por ESP32_LONG_POLL_MAX."""
+    try:
+        espera = float(request.GET.get("espera", 0))
+    except ValueError:
+        return 0
+    return max(0, min(espera, getattr(settings, "ESP32_LONG_POLL_MAX", 30)))
+
+def _registrar_latido(numero, ip):
+    """Busca o crea la máquina y anota el contacto (se vuelca a la BD por lotes, ver latidos.py).
+
+    Devuelve el id de la máquina, que es lo que usa la cola.
+    """
+    entrada = registro_maquinas.obtener_o_crear(numero, ip)
+    latidos.registrar(entrada.id, numero)
+    return entrada.id
+
+def _entregar_comandos(maquina, limite=1, confirmar_ya=True):
+    """Reclama los comandos pendientes más antiguos (ver cola.py).
+
+    Sin confirmación explícita se confirman al entregarlos, como antes.
+    """
+    token, comandos = cola.reclamar(maquina, limite=limite)
+    if comandos:
+        logger.debug("Enviando comando: %s", ", ".join(c.accion for c in comandos))
+        if confirmar_ya:
+            cola.confirmar(token, maquina)
+        # iniciar/detener abren y cierran la SesionTerapia (ver sesiones.py)
+        for comando in comandos:
+            gestor_sesiones.comando_entregado(comando)
+    return token, comandos
+
+def _comando_json(comando):
+    datos = {
+        "id": comando.pk,
+        "accion": comando.accion,
+        "grados": comando.grados,
+        "repeticiones": comando.repeticiones
+    }
+    if comando.plan is not None:
+        # Programa completo: la máquina recorre los pasos sin volver a sondear
+        datos["plan"] = comando.plan
+    return datos
 
-        # Marcar como ejecutado
-        comando.ejecutado = True
-        comando.timestamp_ejecucion = time.time()
-        comando.save()
+# ✅ VISTA CORREGIDA - SIN @login_required
+@csrf_exempt
+async def controlar_sesion(request):
+    """Entrega el siguiente comando de la máquina.
+
+    Con ?espera=<segundos> la petición queda abierta (long-poll) hasta que se
+    encole un ComandoMaquina para esta máquina o se agote el tiempo.
+    Con ?lote=N entrega hasta N comandos a la vez; con ?ack=1 la máquina debe
+    confirmarlos en /confirmar_comando/ con el token recibido, o se reintentan.
+    """
+    numero = request.GET.get("numero")  # nombre de la máquina
+    if not numero:
+        return JsonResponse({"error": "Falta numero"}, status=400)
 
-        return JsonResponse({
-            "accion": comando.accion,
-            "grados": comando.grados,
-            "repeticiones": comando.repeticiones
-        })
+    try:
+        lote = max(1, min(int(request.GET.get("lote", 1)), 50))
+    except ValueError:
+        return JsonResponse({"error": "Parámetro 'lote' inválido"}, status=400)
+    ack = request.GET.get("ack") == "1"
+    limite = time.monotonic() + segundos_espera(request)
+
+    # 1-2. Buscar o crear máquina y marcarla como conectada (una vez por petición)
+    maquina = await sync_to_async(_registrar_latido)(numero, request.META.get("REMOTE_ADDR"))
+    request.dispositivo = numero  # ya registrada: se cuenta en /metrics
+
+    # 3. Reclamar comandos pendientes, esperando si se pidió long-poll
+    while True:
+        # Se toma el id antes de consultar para no perder un aviso intermedio
+        ultimo_id = bus_comandos.ultimo_id
+        token, comandos = await sync_to_async(_entregar_comandos)(maquina, lote, not ack)
+        restante = limite - time.monotonic()
+        if comandos or restante <= 0:
+            break
+        await bus_comandos.esperar(ultimo_id, numero, timeout=restante)
+
+    if comandos and "lote" in request.GET:
+        respuesta = {"comandos": [_comando_json(c) for c in comandos]}
+        if ack:
+            respuesta["token"] = token
+        return JsonResponse(respuesta)
+
+    if comandos:
+        respuesta = _comando_json(comandos[0])
+        if ack:
+            respuesta["token"] = token
+        return JsonResponse(respuesta)
 
     # 4. Si NO hay comandos
+    if "lote" in request.GET:
+        return JsonResponse({"comandos": []})
     return JsonResponse({
         "accion": None,
         "mensaje": "No hay comandos"
     })
 
+@csrf_exempt
+def confirmar_comando(request):
+    """La ESP32 confirma (ack) los comandos que reclamó con ?ack=1."""
+    if request.method != "POST":
+        return JsonResponse({"error": "Método no permitido"}, status=405)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "JSON inválido"}, status=400)
+
+    numero, token = data.get("numero"), data.get("token")
+    if not numero or not token:
+        return JsonResponse({"error": "Faltan 'numero' o 'token'"}, status=400)
+    entrada = registro_maquinas.obtener(numero)
+    if entrada is None:
+        return JsonResponse({"error": "Máquina no registrada"}, status=404)
+    return JsonResponse({"confirmados": cola.confirmar(token, entrada.id)})
+
 # ✅ VISTA CORREGIDA - SIN @login_required
 @csrf_exempt
 def estado_arduino(request):
@@ -260,65 +638,154 @@ def estado_arduino(request):
     if not nombre:
         return JsonResponse({"error": "Falta parámetro 'numero'"}, status=400)
 
-    # Inicializar en memoria si no existe
-    if nombre not in ULTIMO_ESTADO_POR_DISP:
-        try:
-            maquina = Maquinas.objects.get(numero=nombre)
-            estado_bd = EstadoMaquina.objects.filter(maquina=maquina).first()
-            if estado_bd:
-                ULTIMO_ESTADO_POR_DISP[nombre] = {
-                    "nombre": nombre,
-                    "activo": estado_bd.activo,
-                    "grados_actuales": estado_bd.grados_actuales,
-                    "repeticiones": estado_bd.repeticiones,
-                    "ultimo_timestamp": estado_bd.ultimo_timestamp or 0,
-                    "conectado": estado_bd.conectado
-                }
-            else:
-                ULTIMO_ESTADO_POR_DISP[nombre] = {
-                    "ultimo_timestamp": 0,
-                    "conectado": False,
-                    "activo": False,
-                    "grados_actuales": 0,
-                    "repeticiones": 0,
-                    "estado": "sin_datos",
-                }
-        except Maquinas.DoesNotExist:
-            ULTIMO_ESTADO_POR_DISP[nombre] = {
-                "ultimo_timestamp": 0,
-                "conectado": False,
-                "activo": False,
-                "grados_actuales": 0,
-                "repeticiones": 0,
-                "estado": "maquina_no_registrada",
-            }
-
-    estado = ULTIMO_ESTADO_POR_DISP[nombre]
+    estado = estado_en_memoria(nombre)
 
     # Si es POST, actualizar estado recibido
     if request.method == "POST":
         if estado_enviado is not None:
-            estado["activo"] = bool(estado_enviado)
-            estado["ultimo_timestamp"] = time.time()
+            anterior, estado = almacen_estado.actualizar(nombre, {
+                "activo": bool(estado_enviado),
+                "ultimo_timestamp": time.time(),
+            })
+            publicar_cambios(nombre, anterior, estado)
             # Guardar también en BD
             try:
-                maquina = Maquinas.objects.get(numero=nombre)
-                estado_bd, created = EstadoMaquina.objects.get_or_create(maquina=maquina)
-                estado_bd.activo = estado["activo"]
-                estado_bd.ultimo_timestamp = estado["ultimo_timestamp"]
-                estado_bd.conectado = True
-                estado_bd.save()
-            except Exception as e:
-                print("Error guardando estado POST:", e)
-
-    # Conectividad según tiempo
-    tiempo_ahora = time.time()
+                entrada = registro_maquinas.obtener(nombre)
+                if entrada is None:
+                    raise Maquinas.DoesNotExist(nombre)
+                registro_maquinas.actualizar_estado(
+                    entrada,
+                    activo=estado["activo"],
+                    ultimo_timestamp=estado["ultimo_timestamp"],
+                    conectado=True,
+                )
+            except Exception:
+                metricas.reportar_error("estado_arduino", "Error guardando estado POST de %s", nombre)
+
+    # Conectividad: set del monitor (telemetría o sondeo) o el estado compartido
     estado_copy = dict(estado)
-    estado_copy["conectado"] = (tiempo_ahora - estado.get("ultimo_timestamp", 0) <= 60)
+    estado_copy["conectado"] = esta_conectada(nombre, estado)
 
     return JsonResponse(estado_copy)
 
 
+def _evento_sse(tipo, datos, id_evento=None):
+    lineas = []
+    if id_evento is not None:
+        lineas.append(f"id: {id_evento}")
+    lineas.append(f"event: {tipo}")
+    lineas.append(f"data: {json.dumps(datos)}")
+    return "\n".join(lineas) + "\n\n"
+
+def _snapshot_estado(nombre):
+    estado = dict(estado_en_memoria(nombre))
+    estado["conectado"] = esta_conectada(nombre, estado)
+    return estado
+
+def _cambios_estado(enviado, actual):
+    return {k: v for k, v in actual.items() if k != "ultimo_timestamp" and enviado.get(k) != v}
+
+def _eventos_estado_wsgi(nombre, ultimo_id, latido, duracion, intervalo=0.5):
+    """Versión síncrona del stream para servidores WSGI.
+
+    Un generador async no se puede consumir bajo WSGI; este sondea el bus cada
+    ``intervalo`` segundos y termina a los ``duracion`` segundos para liberar
+    el worker. EventSource reconecta solo con Last-Event-ID y se reanuda.
+    """
+    # Sin esto los deltas de otros workers solo llegarían con el latido
+    bus_estado.escuchar()
+    yield "retry: 1000\n\n"
+    pendientes = bus_estado.desde(ultimo_id, nombre) if ultimo_id >= 0 else None
+    enviado = None
+    fin = time.monotonic() + duracion
+    proximo_latido = time.monotonic() + latido
+    while True:
+        if pendientes is None:
+            ultimo_id = bus_estado.ultimo_id
+            enviado = _snapshot_estado(nombre)
+            yield _evento_sse("estado", enviado, ultimo_id)
+        else:
+            for evento in pendientes:
+                ultimo_id = evento.id
+                if enviado is not None:
+                    enviado.update(evento.datos)
+                yield _evento_sse(evento.tipo, evento.datos, evento.id)
+        if time.monotonic() >= fin:
+            return
+        time.sleep(intervalo)
+        if time.monotonic() >= proximo_latido:
+            proximo_latido = time.monotonic() + latido
+            cambios = {}
+            if enviado is not None:
+                actual = _snapshot_estado(nombre)
+                cambios, enviado = _cambios_estado(enviado, actual), actual
+            yield _evento_sse("delta", cambios) if cambios else ": latido\n\n"
+        pendientes = bus_estado.desde(ultimo_id, nombre)
+
+async def stream_estado(request):
+    """Stream SSE del estado de una máquina: snapshot inicial y luego solo deltas.
+
+    Bajo ASGI la respuesta espera eventos del bus sin ocupar hilos (ver
+    rehabilitaweb/asgi.py); bajo WSGI se sirve un generador síncrono que cierra
+    cada ``ESTADO_STREAM_WSGI_DURACION`` segundos. El navegador reenvía
+    Last-Event-ID al reconectar y se reanuda desde ese evento si sigue en el
+    historial del bus; si no, se manda un snapshot nuevo.
+    """
+    nombre = request.GET.get("numero")
+    if not nombre:
+        return JsonResponse({"error": "Falta parámetro 'numero'"}, status=400)
+
+    latido = getattr(settings, "ESTADO_STREAM_LATIDO", 15)
+    try:
+        ultimo_id = int(request.headers.get("Last-Event-ID") or request.GET.get("ultimo_id") or -1)
+    except ValueError:
+        ultimo_id = -1
+
+    async def snapshot():
+        return await sync_to_async(_snapshot_estado)(nombre)
+
+    async def eventos():
+        nonlocal ultimo_id
+        yield "retry: 3000\n\n"
+        pendientes = bus_estado.desde(ultimo_id, nombre) if ultimo_id >= 0 else None
+        enviado = None
+        while True:
+            if pendientes is None:
+                ultimo_id = bus_estado.ultimo_id
+                enviado = await snapshot()
+                yield _evento_sse("estado", enviado, ultimo_id)
+            else:
+                for evento in pendientes:
+                    ultimo_id = evento.id
+                    if enviado is not None:
+                        enviado.update(evento.datos)
+                    yield _evento_sse(evento.tipo, evento.datos, evento.id)
+
+            if not await bus_estado.esperar(ultimo_id, nombre, timeout=latido):
+                # Cambios hechos en otro worker (el bus es por proceso) y la
+                # desconexión, que no genera POST, se detectan al vencer el latido
+                cambios = {}
+                if enviado is not None:
+                    actual = await snapshot()
+                    cambios, enviado = _cambios_estado(enviado, actual), actual
+                if cambios:
+                    yield _evento_sse("delta", cambios)
+                else:
+                    yield ": latido\n\n"
+            pendientes = bus_estado.desde(ultimo_id, nombre)
+
+    if isinstance(request, ASGIRequest):
+        respuesta = StreamingHttpResponse(eventos(), content_type="text/event-stream")
+    else:
+        duracion = getattr(settings, "ESTADO_STREAM_WSGI_DURACION", 25)
+        respuesta = StreamingHttpResponse(
+            _eventos_estado_wsgi(nombre, ultimo_id, latido, duracion), content_type="text/event-stream"
+        )
+    respuesta["Cache-Control"] = "no-cache"
+    respuesta["X-Accel-Buffering"] = "no"
+    return respuesta
+
+
 # -------------------------------
 # Otras vistas
 # -------------------------------
@@ -334,7 +801,6 @@ def recibir_datos(request):
 
     try:
         data = json.loads(request.body)
-        print("Datos recibidos:", data)
 
         # Tu frontend ENVÍA "maquina", NO "numero"
         numero_maquina = data.get('maquina')
@@ -342,26 +808,32 @@ def recibir_datos(request):
             return JsonResponse({'error': "Falta 'maquina' en el JSON"}, status=400)
 
         # Crear la máquina si no existe
-        maquina, created = Maquinas.objects.get_or_create(
-            numero=numero_maquina,
-            defaults={'ip': '0.0.0.0'}
-        )
-
-        # Obtener o crear el estado
-        estado, estado_creado = EstadoMaquina.objects.get_or_create(
-            maquina=maquina
-        )
+        entrada = registro_maquinas.obtener_o_crear(numero_maquina)
+        maquina = entrada.instancia()
 
         # Guardar SOLO lo que envías
-        estado.activo = True if data.get("accion") == "iniciar" else False
-        estado.grados_actuales = int(data.get("grados", 0))
-        estado.repeticiones = int(data.get("repeticiones", 0))
-        estado.stop_grados = int(data.get("stop_grados", 0))
-        estado.modo = data.get("modo", "normal")
-        estado.conectado = True
-        estado.save()
-
-        print(f"Estado de máquina {numero_maquina} actualizado")
+        campos = {
+            "activo": data.get("accion") == "iniciar",
+            "grados_actuales": int(data.get("grados", 0)),
+            "repeticiones": int(data.get("repeticiones", 0)),
+            "stop_grados": int(data.get("stop_grados", 0)),
+            "modo": data.get("modo", "normal"),
+            "conectado": True,
+        }
+        registro_maquinas.actualizar_estado(entrada, **campos)
+
+        # Encolar el comando: despierta al long-poll de la máquina (ver signals.py)
+        if data.get("accion") in dict(ComandoMaquina.TIPO_ACCIONES):
+            paciente = None
+            if data.get("paciente"):
+                paciente = Usuario.objects.filter(pk=data["paciente"], rol="paciente").first()
+            cola.encolar(
+                maquina,
+                data["accion"],
+                grados=campos["grados_actuales"],
+                repeticiones=campos["repeticiones"],
+                usuario=paciente,
+            )
 
         return JsonResponse({
             'mensaje': 'Datos recibidos correctamente',
@@ -373,11 +845,147 @@ def recibir_datos(request):
     except json.JSONDecodeError:
         return JsonResponse({'error': 'JSON mal formado'}, status=400)
     except Exception as e:
-        print("Error:", e)
+        metricas.reportar_error("recibir_datos", "Error en recibir_datos")
         return JsonResponse({'error': str(e)}, status=400)
 
 
 
+SELECTORES_ENVIO = ("todas", "conectadas")
+
+def _maquinas_envio(selector):
+    """Pares (id, numero) del selector y los números que no existen."""
+    if selector == "todas":
+        return list(Maquinas.objects.order_by("id").values_list("id", "numero")), []
+    if selector == "conectadas":
+        return [(m["id"], m["numero"]) for m in resumen_maquinas(conectado=True)], []
+    numeros = list(dict.fromkeys(str(n) for n in selector))
+    encontradas = dict(Maquinas.objects.filter(numero__in=numeros).values_list("numero", "id"))
+    return (
+        [(encontradas[n], n) for n in numeros if n in encontradas],
+        [n for n in numeros if n not in encontradas],
+    )
+
+@login_required
+def crear_envio_comandos(request):
+    """Encola un comando en muchas máquinas con una sola petición.
+
+    JSON: {"accion", "grados", "repeticiones", "maquinas": [<numero>, ...] o
+    "todas"/"conectadas", "pacientes": {<numero>: <paciente_id>} (opcional)}.
+    Responde el id del envío; su estado se consulta en /api/comandos/envios/<id>/.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Método no permitido"}, status=405)
+    try:
+        data = json.loads(request.body)
+        grados = int(data["grados"]) if data.get("grados") is not None else None
+        repeticiones = int(data["repeticiones"]) if data.get("repeticiones") is not None else None
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return JsonResponse({"error": "JSON inválido"}, status=400)
+    accion = data.get("accion")
+    if accion not in dict(ComandoMaquina.TIPO_ACCIONES):
+        return JsonResponse({"error": "Acción inválida"}, status=400)
+    selector = data.get("maquinas")
+    if not (selector in SELECTORES_ENVIO or isinstance(selector, list) and selector):
+        return JsonResponse({"error": "'maquinas' debe ser una lista de números, 'todas' o 'conectadas'"}, status=400)
+
+    maquinas, desconocidas = _maquinas_envio(selector)
+    if not maquinas:
+        return JsonResponse({"error": "Ninguna máquina coincide", "desconocidas": desconocidas}, status=400)
+    maximo = getattr(settings, "ENVIO_MAX_MAQUINAS", 5000)
+    if len(maquinas) > maximo:
+        return JsonResponse({"error": f"Demasiadas máquinas: máximo {maximo}"}, status=413)
+
+    # Un paciente por máquina (clase grupal): sin él, "iniciar" no abre sesión
+    ids = {numero: maquina_id for maquina_id, numero in maquinas}
+    try:
+        pedidos = {str(n): int(p) for n, p in (data.get("pacientes") or {}).items()}
+    except (AttributeError, TypeError, ValueError):
+        return JsonResponse({"error": "'pacientes' debe ser un objeto {maquina: paciente_id}"}, status=400)
+    validos = set(Usuario.objects.filter(pk__in=pedidos.values(), rol="paciente").values_list("pk", flat=True))
+    invalidos = [n for n, p in pedidos.items() if n not in ids or p not in validos]
+    if invalidos:
+        return JsonResponse({"error": "Pacientes inválidos", "maquinas": invalidos}, status=400)
+
+    envio = cola.encolar_envio(
+        maquinas,
+        accion,
+        grados=grados,
+        repeticiones=repeticiones,
+        pacientes={ids[n]: p for n, p in pedidos.items()},
+        selector="maquinas" if isinstance(selector, list) else selector,
+        creado_por=request.user,
+    )
+    return JsonResponse({"envio": envio.pk, "total": envio.total, "desconocidas": desconocidas}, status=201)
+
+@login_required
+def estado_envio_comandos(request, envio_id):
+    """Estado de entrega por máquina de un envío; ?detalle=0 solo devuelve los conteos."""
+    envio = EnvioComandos.objects.filter(pk=envio_id).values(
+        "id", "accion", "grados", "repeticiones", "selector", "total", "timestamp_creacion"
+    ).first()
+    if envio is None:
+        return JsonResponse({"error": "Envío no encontrado"}, status=404)
+    detalle = filtro_booleano(request, "detalle")
+    return json_con_etag(request, {**envio, **cola.estado_envio(envio_id, detalle is not False)})
+
+@login_required
+def programas_terapia(request):
+    """GET: lista de programas. POST: crea uno con {"nombre", "descripcion"?, "pasos": [...]}.
+
+    Cada paso: {"grados", "repeticiones", "series"?, "stop_grados"?, "modo"?, "descanso"? (segundos)}.
+    """
+    if request.method == "GET":
+        filas = ProgramaTerapia.objects.order_by("id").annotate(n_pasos=Count("pasos")).values(
+            "id", "nombre", "descripcion", "n_pasos"
+        )
+        return json_con_etag(request, {"programas": list(filas)})
+    if request.method != "POST":
+        return JsonResponse({"error": "Método no permitido"}, status=405)
+    try:
+        data = json.loads(request.body)
+        pasos = list(data.get("pasos") or [])
+    except (json.JSONDecodeError, AttributeError, TypeError):
+        return JsonResponse({"error": "JSON inválido"}, status=400)
+    programa, errores = programas.crear(
+        str(data.get("nombre") or "").strip()[:100], pasos, str(data.get("descripcion") or "")[:255], request.user
+    )
+    if errores:
+        return JsonResponse({"error": "Programa inválido", "errores": errores}, status=400)
+    return JsonResponse({"id": programa.pk, "plan": programas.compilar(programa)}, status=201)
+
+@login_required
+def enviar_programa(request, programa_id):
+    """Encola el programa en una máquina: {"maquina": <numero>, "paciente": <id>?}."""
+    if request.method != "POST":
+        return JsonResponse({"error": "Método no permitido"}, status=405)
+    programa = ProgramaTerapia.objects.filter(pk=programa_id).first()
+    if programa is None:
+        return JsonResponse({"error": "Programa no encontrado"}, status=404)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "JSON inválido"}, status=400)
+    entrada = registro_maquinas.obtener(str(data.get("maquina") or ""))
+    if entrada is None:
+        return JsonResponse({"error": "Máquina no encontrada"}, status=404)
+    paciente = None
+    if data.get("paciente") is not None:
+        paciente = Usuario.objects.filter(pk=data["paciente"], rol="paciente").first()
+        if paciente is None:
+            return JsonResponse({"error": "Paciente no encontrado"}, status=400)
+    ejecucion = programas.enviar(programa, entrada.instancia(), paciente)
+    return JsonResponse({
+        "ejecucion": ejecucion.pk, "comando": ejecucion.comando_id, "series": len(ejecucion.progreso),
+    }, status=201)
+
+@login_required
+def ejecucion_programa(request, ejecucion_id):
+    """Avance de un programa enviado: estado de la entrega y de cada serie del plan."""
+    ejecucion = EjecucionPrograma.objects.select_related("comando", "maquina").filter(pk=ejecucion_id).first()
+    if ejecucion is None:
+        return JsonResponse({"error": "Ejecución no encontrada"}, status=404)
+    return json_con_etag(request, programas.resumen(ejecucion))
+
 @csrf_exempt
 @login_required
 def agregar_paciente(request):
@@ -389,94 +997,60 @@ def agregar_paciente(request):
         peso = data.get("peso")
         altura = data.get("altura")
 
-        base = nombre.lower().replace(" ", "_")
-        if not Usuario.objects.filter(username=base).exists():
-            username = base
-        else:
-            usuarios = Usuario.objects.filter(username__startswith=base)
-            max_num = 0
-            for u in usuarios:
-                match = re.match(rf"{base}_?(\d+)$", u.username)
-                if match:
-                    num = int(match.group(1))
-                    if num > max_num:
-                        max_num = num
-            username = f"{base}_{max_num + 1}"
-
-        Usuario.objects.create(
-            nombre=nombre,
-            tamano_de_la_pantorrilla=tamano_de_la_pantorrilla,
-            peso=peso,
-            altura=altura,
-            username=username,
-            rol="paciente",
-        )
+        with transaction.atomic():
+            username = pacientes.asignar_usernames([nombre])[0]
+            Usuario.objects.create(
+                nombre=nombre,
+                tamano_de_la_pantorrilla=tamano_de_la_pantorrilla,
+                peso=peso,
+                altura=altura,
+                username=username,
+                rol="paciente",
+            )
         return JsonResponse({"status": "ok", "username": username})
     return JsonResponse({"error": "Método no permitido"}, status=400)
 
 
-def lista_maquinas_json(request):
-    maquinas = []
-
-    for m in Maquinas.objects.all():
-        estado = getattr(m, "estado_actual", None)
-
-        maquinas.append({
-            "id": m.id,
-            "numero": m.numero,
-            "ip": m.ip,
-            "conectado": estado.conectado if estado else False,
-            "activo": estado.activo if estado else False,
-            "grados_actuales": estado.grados_actuales if estado else 0,
-            "repeticiones": estado.repeticiones if estado else 0,
-        })
-
-    return JsonResponse(maquinas, safe=False)
-
-# Guardas los datos del frontend en un dict global
-ULTIMOS_COMANDOS = {}
-
-@csrf_exempt
-def guardar_comando(request):
-    if request.method == "POST":
-        data = json.loads(request.body)
-        maquina = data.get("maquina")
-        if not maquina:
-            return JsonResponse({"error": "Falta 'maquina'"}, status=400)
-        ULTIMOS_COMANDOS[maquina] = {
-            "accion": data.get("accion"),
-            "grados": int(data.get("grados", 0)),
-            "repeticiones": int(data.get("repeticiones", 0)),
-            "stop_grados": int(data.get("stop_grados", 0)),
-            "modo": data.get("modo", "normal")
-        }
-        return JsonResponse({"status": "ok"})
-    return JsonResponse({"error": "Método no permitido"}, status=405)
+@login_required
+def importar_pacientes(request):
+    """Alta masiva: CSV con cabecera o JSON, en el cuerpo o como archivo "archivo".
 
-@csrf_exempt
-def comando_esp(request):
-    numero = request.GET.get('maquina')
-    if not numero:
-        return JsonResponse({"error": "Falta parámetro 'maquina'"}, status=400)
+    ?simular=1 solo valida. Responde el resumen con los errores por fila.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Método no permitido"}, status=405)
+    archivo = request.FILES.get("archivo")
+    if archivo is not None:
+        contenido = archivo.read()
+        es_csv = archivo.name.lower().endswith(".csv") or "csv" in (archivo.content_type or "")
+    else:
+        contenido = request.body
+        es_csv = "csv" in request.content_type
+    try:
+        filas = pacientes.leer_archivo(contenido, "csv" if es_csv else "json")
+    except (ValueError, UnicodeDecodeError) as error:
+        return JsonResponse({"error": f"Archivo inválido: {error}"}, status=400)
+    maximo = getattr(settings, "IMPORTACION_MAX_FILAS", 10000)
+    if len(filas) > maximo:
+        return JsonResponse({"error": f"Demasiadas filas: máximo {maximo}"}, status=413)
+    resumen = pacientes.importar(filas, simular=filtro_booleano(request, "simular") or False)
+    return JsonResponse(resumen, status=200 if resumen["validos"] or not resumen["errores"] else 400)
 
-    # Obtener o crear máquina
-    maquina, _ = Maquinas.objects.get_or_create(
-        numero=numero,
-        defaults={'ip': '0.0.0.0'}
+def lista_maquinas_json(request):
+    maquinas = resumen_maquinas(
+        conectado=filtro_booleano(request, "conectado"),
+        activo=filtro_booleano(request, "activo"),
     )
+    return json_con_etag(request, maquinas, safe=False)
+
+def _comando_desde_estado(numero):
+    """Lee el comando guardado en EstadoMaquina y lo reinicia para no reenviarlo."""
+    # Obtener o crear máquina (caché de registro.py)
+    entrada = registro_maquinas.obtener_o_crear(numero)
+    latidos.registrar(entrada.id, numero)
 
     # Obtener o crear estado de la máquina
-    estado, _ = EstadoMaquina.objects.get_or_create(
-        maquina=maquina,
-        defaults={
-            'activo': False,
-            'grados_actuales': 0,
-            'repeticiones': 0,
-            'stop_grados': 0,
-            'modo': 'normal',
-            'conectado': True
-        }
-    )
+    estado = registro_maquinas.estado(entrada, defaults={'conectado': True})
 
     # Construir respuesta usando solo lo que viene de la BD
     # Se asume que lo que guardaste desde el frontend son los valores "grados_actuales", "repeticiones", etc.
@@ -488,15 +1062,45 @@ def comando_esp(request):
         "modo": estado.modo
     }
 
-    # Reiniciar valores para que no se reenvíen
-    estado.activo = False
-    estado.grados_actuales = 0
-    estado.repeticiones = 0
-    estado.stop_grados = 0
-    estado.modo = "normal"
-    estado.save()
+    # El comando ya viajó por esta ruta: se reclama y confirma en la cola solo el
+    # que encoló recibir_datos con estos valores, para no entregarlo dos veces.
+    # Los demás (envíos, programas, otros sondeos) siguen pendientes.
+    if respuesta["accion"] != "normal":
+        token, comandos = cola.reclamar(entrada.id, filtro=Q(
+            envio__isnull=True, plan__isnull=True,
+            grados=estado.grados_actuales, repeticiones=estado.repeticiones,
+        ))
+        cola.confirmar(token, entrada.id)
+        # Igual que en /controlar_sesion/: "iniciar" con paciente abre la SesionTerapia
+        for comando in comandos:
+            gestor_sesiones.comando_entregado(comando)
+
+    # Reiniciar valores para que no se reenvíen (solo se escribe lo que cambió)
+    reinicio = {"activo": False, "grados_actuales": 0, "repeticiones": 0, "stop_grados": 0, "modo": "normal"}
+    cambiados = [campo for campo, valor in reinicio.items() if getattr(estado, campo) != valor]
+    for campo in cambiados:
+        setattr(estado, campo, reinicio[campo])
+    if cambiados:
+        estado.save(update_fields=cambiados)
+
+    return respuesta
 
-    return JsonResponse(respuesta)
+@csrf_exempt
+async def comando_esp(request):
+    """Comando pendiente de la máquina; admite long-poll con ?espera=<segundos>."""
+    numero = request.GET.get('maquina')
+    if not numero:
+        return JsonResponse({"error": "Falta parámetro 'maquina'"}, status=400)
+
+    limite = time.monotonic() + segundos_espera(request)
+    while True:
+        ultimo_id = bus_comandos.ultimo_id
+        respuesta = await sync_to_async(_comando_desde_estado)(numero)
+        request.dispositivo = numero
+        restante = limite - time.monotonic()
+        if respuesta["accion"] != "normal" or restante <= 0:
+            return JsonResponse(respuesta)
+        await bus_comandos.esperar(ultimo_id, numero, timeout=restante)
 
 @csrf_exempt
 def comando_esp_detener(request):
@@ -504,24 +1108,9 @@ def comando_esp_detener(request):
     if not numero:
         return JsonResponse({"error": "Falta parámetro 'maquina'"}, status=400)
 
-    # Obtener o crear máquina
-    maquina, _ = Maquinas.objects.get_or_create(
-        numero=numero,
-        defaults={'ip': '0.0.0.0'}
-    )
-
-    # Obtener o crear estado de la máquina
-    estado, _ = EstadoMaquina.objects.get_or_create(
-        maquina=maquina,
-        defaults={
-            'activo': False,
-            'grados_actuales': 0,
-            'repeticiones': 0,
-            'stop_grados': 0,
-            'modo': 'normal',
-            'conectado': True
-        }
-    )
+    # Obtener o crear máquina (caché de registro.py)
+    entrada = registro_maquinas.obtener_o_crear(numero)
+    request.dispositivo = entrada.numero
 
     # Construir respuesta: DETENER con todos los valores en 0
     respuesta = {
@@ -533,13 +1122,61 @@ def comando_esp_detener(request):
     }
 
     # Reiniciamos todo para que no se vuelva a enviar
-    estado.activo = False
-    estado.grados_actuales = 0
-    estado.repeticiones = 0
-    estado.stop_grados = 0
-    estado.modo = "normal"
-    estado.save()
+    registro_maquinas.actualizar_estado(
+        entrada, activo=False, grados_actuales=0, repeticiones=0, stop_grados=0, modo="normal"
+    )
+    gestor_sesiones.cerrar(entrada.id)
 
     return JsonResponse(respuesta)
 
 
+@csrf_exempt
+def progreso_programa(request):
+    """La ESP32 informa el avance de un programa.
+
+    Cuerpo: {"nombre", "comando": <id del comando "programa">, "i", "estado",
+    "repeticiones"?, "grados_max"?} o {"nombre", "comando", "eventos": [...]}
+    para mandar varios juntos (p. ej. tras un corte de red).
+    """
+    if request.method != "POST":
+        return JsonResponse({"success": False, "error": "Método no permitido"}, status=405)
+    auth = esp32_authorize(request)
+    if auth is not True:
+        return auth
+    try:
+        data = json.loads(request.body)
+        comando_id = int(data["comando"])
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return JsonResponse({"success": False, "error": "Falta 'comando' o JSON inválido"}, status=400)
+    entrada = registro_maquinas.obtener(str(data.get("nombre") or ""))
+    if entrada is None:
+        return JsonResponse({"success": False, "error": "Máquina no registrada"}, status=404)
+    request.dispositivo = entrada.numero
+    eventos = data["eventos"] if "eventos" in data else [data]
+    if not isinstance(eventos, list):
+        return JsonResponse({"success": False, "error": "'eventos' debe ser una lista"}, status=400)
+    try:
+        ejecucion = programas.informar(comando_id, entrada.id, eventos)
+    except ValueError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+    if ejecucion is None:
+        return JsonResponse({"success": False, "error": "Programa no encontrado"}, status=404)
+    return JsonResponse({"status": "ok", "estado": ejecucion.estado, "paso_actual": ejecucion.paso_actual})
+
+# -------------------------------
+# Métricas (Prometheus)
+# -------------------------------
+
+def metricas_prometheus(request):
+    """Métricas de todos los workers en formato de texto de Prometheus.
+
+    Exponen nombres de máquinas y su tráfico: sin METRICAS_TOKEN solo se
+    sirven a localhost.
+    """
+    token = getattr(settings, "METRICAS_TOKEN", None)
+    if token:
+        if request.headers.get("Authorization") != f"Bearer {token}":
+            return HttpResponse(status=403)
+    elif request.META.get("REMOTE_ADDR") not in ("127.0.0.1", "::1"):
+        return HttpResponse(status=403)
+    return HttpResponse(metricas.texto_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")